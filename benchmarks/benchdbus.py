@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+# Benchmark for the round trip latency of ExecuteBuddyCommand in the DBus
+# service (py3buddydbus.py), on a private session bus that is started for
+# the benchmark, with a simulated device. Needs pydbus, gi and dbus-daemon,
+# otherwise the benchmark is skipped.
+#
+# Copyright 2017-2019 - Armijn Hemel for Tjaldur Software Governance Solutions
+# SPDX-Identifier: MIT
+
+import sys
+import shutil
+import subprocess
+import threading
+import time
+from benchutil import skipped
+
+import py3buddy
+import py3buddysim
+from py3buddyplayer import percentile
+
+# amount of calls per measurement
+calls = 1000
+
+
+def main(argv):
+    results = {}
+    try:
+        import pydbus
+        import gi.repository.GLib
+        import py3buddydbus
+    except ImportError as e:
+        skipped('dbus ExecuteBuddyCommand', e)
+        return results
+
+    if shutil.which('dbus-daemon') is None:
+        skipped('dbus ExecuteBuddyCommand', 'dbus-daemon not found')
+        return results
+
+    # start a private session bus
+    daemon = subprocess.Popen(['dbus-daemon', '--session', '--nofork',
+                               '--print-address'], stdout=subprocess.PIPE)
+    address = daemon.stdout.readline().decode().strip()
+    try:
+        sim = py3buddysim.SimulatedDevice()
+        ibuddy = py3buddy.iBuddy({}, find=sim.find)
+
+        # publish the service and run its main loop in a separate thread
+        loop = gi.repository.GLib.MainLoop()
+        service = py3buddydbus.IBuddyDbusService(ibuddy, loop)
+        serverbus = pydbus.connect(address)
+        serverbus.publish("nl.tjaldur.IBuddy", service)
+        thread = threading.Thread(target=loop.run, daemon=True)
+        thread.start()
+
+        clientbus = pydbus.connect(address)
+        proxy = clientbus.get("nl.tjaldur.IBuddy", "/nl/tjaldur/IBuddy")
+
+        for (name, command) in [('empty', ''), ('frame', 'RED:HEART:GO')]:
+            latencies = []
+            for i in range(calls):
+                start = time.perf_counter()
+                proxy.ExecuteBuddyCommand(command)
+                latencies.append(time.perf_counter() - start)
+            # wait until the player has executed all the commands
+            while service.player.queuedepth() != 0:
+                time.sleep(0.001)
+            median = percentile(latencies, 0.5) * 1000000
+            p99 = percentile(latencies, 0.99) * 1000000
+            print("%-50s %12.1f us (p99 %.1f us)" % ('dbus ExecuteBuddyCommand %s' % name, median, p99))
+            results['dbus.%s.median' % name] = {'value': median, 'unit': 'us', 'better': 'lower'}
+            results['dbus.%s.p99' % name] = {'value': p99, 'unit': 'us', 'better': 'lower'}
+
+        service.player.shutdown()
+        loop.quit()
+        thread.join()
+    finally:
+        daemon.terminate()
+        daemon.wait()
+    return results
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+# Benchmark for the fair scheduling of the player (py3buddyplayer.py): a
+# busy client keeps the queue full with short commands, while a quiet client
+# submits a command once in a while. The wait of the quiet client should
+# stay in the order of a few commands, no matter how long the queue is.
+#
+# Copyright 2017-2019 - Armijn Hemel for Tjaldur Software Governance Solutions
+# SPDX-Identifier: MIT
+
+import sys
+import time
+from benchutil import measured
+
+import py3buddy
+import py3buddyplayer
+import py3buddysim
+
+# the command of the busy client, and the amount it keeps queued
+busycommand = 'RED:GO:2MS'
+busyqueued = 200
+
+# amount of commands of the quiet client, and the time between them
+quietcommands = 50
+quietinterval = 0.01
+
+
+def main(argv):
+    results = {}
+    sim = py3buddysim.SimulatedDevice()
+    ibuddy = py3buddy.iBuddy({}, find=sim.find)
+    player = py3buddyplayer.Player(ibuddy, resetafter=False)
+    player.start()
+
+    playbacks = []
+    for i in range(quietcommands):
+        while player.queuedepth() < busyqueued:
+            player.submit(busycommand, client='busy')
+        playbacks.append(player.submit('BLUE:GO', client='quiet'))
+        time.sleep(quietinterval)
+    for playback in playbacks:
+        playback.wait()
+    player.shutdown()
+
+    stats = player.clientstats()['quiet']
+    for quantile in ['p50', 'p99']:
+        wait = stats['wait_' + quantile] * 1000
+        name = 'player quiet client wait %s' % quantile
+        results['fair.wait.%s' % quantile] = measured(name, wait, 'ms', 'lower',
+                                                      '%d commands queued' % busyqueued)
+    return results
+
+if __name__ == "__main__":
+    main(sys.argv)
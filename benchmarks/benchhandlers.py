@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+# Benchmark for the event handlers of the monitors: matching messages from
+# Pidgin and processing earthquake feeds. The Pidgin monitor needs extra
+# modules (pydbus, gi), it is skipped if it cannot be imported.
+#
+# Copyright 2017-2019 - Armijn Hemel for Tjaldur Software Governance Solutions
+# SPDX-Identifier: MIT
+
+import sys
+import json
+import os
+import tempfile
+import time
+from benchutil import rate, skipped
+
+import py3buddy
+import py3buddycompositor
+import py3buddyfeeds
+import py3buddysim
+
+# amount of events per measurement
+events = 10000
+
+# messages without and with a smiley
+plainmessages = ['hello, how are you doing today?', 'meeting at 3',
+                 'see <a href="http://example.com/">this</a>', 'ok']
+smileymessages = ['hello :)', 'great news :D', 'thanks ^_^', 'ok :-)']
+
+quakes = ['4.5 magnitude #earthquake. 12 km from Somewhere, Country',
+          'no quake here', '1.2 magnitude #earthquake. 5 km from Elsewhere',
+          'Some other text about an #earthquake']
+
+
+def main(argv):
+    results = {}
+    sim = py3buddysim.SimulatedDevice()
+    ibuddy = py3buddy.iBuddy({}, find=sim.find)
+
+    try:
+        import py3buddypidgin
+    except ImportError as e:
+        skipped('pidgin processmsg', e)
+        py3buddypidgin = None
+
+    if py3buddypidgin is not None:
+        # the compositor is not started, so
+        # nothing is sent to the device
+        py3buddypidgin.compositor = py3buddycompositor.Compositor(ibuddy)
+
+        def plain():
+            for i in range(events):
+                py3buddypidgin.processmsg(None, None, plainmessages[i % 4], None, 0)
+        results['handlers.pidgin.plain'] = rate('pidgin processmsg (no smiley)', plain, events, 'events/s')
+
+        def smiley():
+            for i in range(events):
+                py3buddypidgin.processmsg(None, None, smileymessages[i % 4], None, 0)
+        results['handlers.pidgin.smiley'] = rate('pidgin processmsg (smiley)', smiley, events, 'events/s')
+
+    # a local text feed to which lines are appended: only the new
+    # lines are read and parsed
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'quakes.txt')
+        open(path, 'wb').close()
+        lines = ''.join([quakes[i % 4] + '\n' for i in range(events)]).encode()
+
+        def textfeed():
+            feed = py3buddyfeeds.FileFeed(path)
+            with open(path, 'wb') as feedfile:
+                feedfile.write(lines)
+            feed.fetch()
+        results['handlers.earthquake.text'] = rate('earthquake text feed', textfeed, events, 'lines/s')
+
+    # a GeoJSON feed with quakes that are all weaker than the minimum
+    # magnitude (skipped before parsing) and one that is parsed
+    now = time.time() * 1000
+    features = [{'type': 'Feature', 'id': 'quake%d' % i,
+                 'properties': {'mag': 1.0 + (i % 30) / 10, 'place': 'Somewhere',
+                                'time': now}} for i in range(events)]
+    geojson = json.dumps({'type': 'FeatureCollection', 'features': features}).encode()
+
+    def weakfeed():
+        py3buddyfeeds.Feed(minmagnitude=5.0).parsegeojson(geojson)
+    results['handlers.earthquake.geojson.filtered'] = rate('earthquake GeoJSON (all below minimum)', weakfeed, events, 'features/s')
+
+    def strongfeed():
+        py3buddyfeeds.Feed(minmagnitude=3.5).parsegeojson(geojson)
+    results['handlers.earthquake.geojson'] = rate('earthquake GeoJSON', strongfeed, events, 'features/s')
+    return results
+
+if __name__ == "__main__":
+    main(sys.argv)
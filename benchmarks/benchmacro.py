@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+# Benchmark for the macro language: the cost per token of parsing and
+# dispatching commands in iBuddy.executecommand(), on a simulated device
+# without latency. Sleeps are left out, as those would only measure
+# time.sleep().
+#
+# Copyright 2017-2019 - Armijn Hemel for Tjaldur Software Governance Solutions
+# SPDX-Identifier: MIT
+
+import sys
+from benchutil import bench
+
+import py3buddy
+import py3buddyeffects
+import py3buddysim
+
+# commands to benchmark, without sleeps
+macros = {
+    'setters': 'RED:HEART:WINGSHIGH:LEFT:BLUE:NOHEART:WINGSLOW:RIGHT',
+    'go': 'RED:HEART:WINGSHIGH:GO:YELLOW:NOHEART:WINGSLOW:GO:HEART:BLUE:WINGSHIGH:GO',
+    'reset': 'RED:HEART:WINGSHIGH:GO:RESET',
+}
+
+
+def main(argv):
+    sim = py3buddysim.SimulatedDevice()
+    ibuddy = py3buddy.iBuddy({}, find=sim.find)
+
+    results = {}
+    for name in sorted(macros):
+        macro = macros[name]
+        tokens = len(macro.split(':'))
+        results['macro.%s.pertoken' % name] = bench('executecommand %s' % name,
+                                                    lambda: ibuddy.executecommand(macro),
+                                                    number=10000, per=tokens,
+                                                    unit='ns/token')
+
+    smilecommand = 'RED:HEART:WINGSHIGH:GO:SHORTSLEEP:YELLOW:NOHEART:WINGSLOW:GO:SHORTSLEEP:HEART:BLUE:WINGSHIGH:GO:SHORTSLEEP:PURPLE:NOHEART:WINGSLOW:GO:SHORTSLEEP:HEART:CYAN:WINGSHIGH:GO:SHORTSLEEP:WHITE:NOHEART:WINGSLOW:GO:SHORTSLEEP:RESET'
+    results['macro.compile'] = bench('compilemacro (smiley command)',
+                                     lambda: py3buddyeffects.compilemacro(smilecommand),
+                                     number=10000)
+    results['effects.panic.perframe'] = bench('effects.panic (10000 frames)',
+                                              lambda: py3buddyeffects.panic(5000, seed=1),
+                                              number=10, per=10000,
+                                              unit='ns/frame')
+    return results
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+
+# Benchmark for the software PWM (py3buddypwm.py): the frame rate that is
+# achieved and how steady it is, on a simulated device without latency and
+# on one that cannot keep up with the requested frame rate.
+#
+# Copyright 2017-2019 - Armijn Hemel for Tjaldur Software Governance Solutions
+# SPDX-Identifier: MIT
+
+import sys
+from benchutil import measured
+
+import py3buddy
+import py3buddypwm
+import py3buddysim
+
+# how long the PWM runs per measurement, in seconds
+duration = 3
+
+
+def main(argv):
+    results = {}
+    # 4 ms per transfer: two transfers per frame, so at most 125 frames/s
+    for (name, latency) in [('fast', 0.0), ('slow', 0.004)]:
+        sim = py3buddysim.SimulatedDevice(latency=latency)
+        ibuddy = py3buddy.iBuddy({}, find=sim.find)
+        pwm = py3buddypwm.PWM(ibuddy)
+        pwm.setcolour('ORANGE', heart=0.5)
+        pwm.run(duration)
+        stats = pwm.stats()
+        results['pwm.%s.rate' % name] = measured(
+            'pwm %s device' % name, stats['rate'], 'frames/s', 'higher',
+            'late %d, lowered %d' % (stats['late'], stats['lowered']))
+    return results
+
+if __name__ == "__main__":
+    main(sys.argv)
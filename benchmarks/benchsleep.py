@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+# Benchmark for the accuracy of sleeps: how late iBuddy.sleep() wakes up
+# for short sleeps, with and without spinning for the last part of the
+# sleep, and how accurately frames of a fast effect are played.
+#
+# Copyright 2017-2019 - Armijn Hemel for Tjaldur Software Governance Solutions
+# SPDX-Identifier: MIT
+
+import sys
+import time
+from benchutil import rate
+
+import py3buddy
+import py3buddyeffects
+import py3buddysim
+
+
+def oversleep(name, ibuddy, seconds, count=200):
+    # the mean amount of time that sleeps take longer than requested
+    total = 0.0
+    for i in range(count):
+        start = time.perf_counter()
+        ibuddy.sleep(seconds)
+        total += time.perf_counter() - start - seconds
+    microseconds = total / count * 1000000
+    print("%-50s %12.1f %s" % (name, microseconds, 'us late'))
+    return {'value': microseconds, 'unit': 'us late', 'better': 'lower'}
+
+
+def main(argv):
+    sim = py3buddysim.SimulatedDevice()
+    results = {}
+    for (name, spin) in [('sleep', 0.0), ('spin', py3buddy.SPINTHRESHOLD)]:
+        ibuddy = py3buddy.iBuddy({'spin_threshold': spin}, find=sim.find)
+        for milliseconds in [2, 5]:
+            results['sleep.%s.%dms' % (name, milliseconds)] = oversleep('sleep %dms (%s)' % (milliseconds, name),
+                                                                        ibuddy, milliseconds / 1000)
+
+    # a fast effect: 500 frames of 2 milliseconds, which should
+    # be played at 500 frames per second
+    ibuddy = py3buddy.iBuddy({}, find=sim.find)
+    states = bytes([0xff, 0x7f]) * 250
+    animation = (states, py3buddyeffects.durations(0.002, len(states)))
+    results['sleep.effect.framerate'] = rate('effect, 2ms frames (target 500)',
+                                             lambda: py3buddyeffects.play(ibuddy, animation),
+                                             len(states), repeat=3)
+    return results
+
+if __name__ == "__main__":
+    main(sys.argv)
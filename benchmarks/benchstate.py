@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+# Benchmark for the cost of setting the state of the iBuddy per frame:
+# the setters of the iBuddy class (with colour dicts and with the
+# precomputed colours), the immutable BuddyState and encoding/decoding
+# of messages. No device is needed.
+#
+# Copyright 2017-2019 - Armijn Hemel for Tjaldur Software Governance Solutions
+# SPDX-Identifier: MIT
+
+import sys
+from benchutil import bench
+
+import py3buddy
+import py3buddysim
+
+
+def main(argv):
+    sim = py3buddysim.SimulatedDevice()
+    ibuddy = py3buddy.iBuddy({}, find=sim.find)
+
+    plainred = {'red': True, 'blue': False, 'green': False}
+    results = {}
+    results['state.setcolour.dict'] = bench('setcolour (dict)', lambda: ibuddy.setcolour(plainred))
+    results['state.setcolour.colour'] = bench('setcolour (Colour)', lambda: ibuddy.setcolour(py3buddy.RED))
+    results['state.wiggle'] = bench('wiggle', lambda: ibuddy.wiggle('left'))
+    results['state.wings'] = bench('wings', lambda: ibuddy.wings('high'))
+    results['state.toggleheart'] = bench('toggleheart', lambda: ibuddy.toggleheart(True))
+
+    def frame():
+        ibuddy.wings('high')
+        ibuddy.toggleheart(True)
+        ibuddy.setcolour(py3buddy.CYAN)
+        ibuddy.wiggle('right')
+        ibuddy.createmsg()
+    results['state.frame.setters'] = bench('frame (4 setters + createmsg)', frame)
+
+    state = py3buddy.BuddyState.fromstate(0xff)
+
+    def stateframe():
+        state.withwings('high').withheart(True).withcolour(py3buddy.CYAN).withposition('right').encode()
+    results['state.frame.buddystate'] = bench('frame (BuddyState)', stateframe)
+
+    msg = py3buddy.statemsgs[0x42]
+    results['state.decode'] = bench('BuddyState.decode', lambda: py3buddy.BuddyState.decode(msg))
+    return results
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+# Benchmark for streaming (py3buddystream.py): the amount of lines (commands
+# in the macro language) and binary records per second that are read,
+# queued and played on a simulated device without latency.
+#
+# Copyright 2017-2019 - Armijn Hemel for Tjaldur Software Governance Solutions
+# SPDX-Identifier: MIT
+
+import sys
+import io
+import threading
+from benchutil import rate
+
+import py3buddy
+import py3buddyrecord
+import py3buddysim
+import py3buddystream
+
+# amount of lines or records per run
+count = 20000
+
+
+def readall(streamer, infile):
+    # the reader thread of the stream, for a file object
+    try:
+        streamer.read(infile)
+    finally:
+        streamer.queue.put(None)
+
+
+def play(ibuddy, data, binary):
+    # stream all data through the reader thread and the queue
+    streamer = py3buddystream.Stream(ibuddy, binary)
+    infile = io.BufferedReader(io.BytesIO(data))
+    thread = threading.Thread(target=readall, args=(streamer, infile), daemon=True)
+    thread.start()
+    streamer.run()
+    thread.join()
+
+
+def main(argv):
+    sim = py3buddysim.SimulatedDevice()
+    ibuddy = py3buddy.iBuddy({}, find=sim.find)
+
+    lines = b'RED:HEART:WINGSHIGH:GO\nBLUE:NOHEART:WINGSLOW:GO\n' * (count // 2)
+    records = b''.join([py3buddyrecord.recordformat.pack(0, i % 256) for i in range(count)])
+
+    results = {}
+    results['stream.lines'] = rate('stream commands', lambda: play(ibuddy, lines, False),
+                                   count, unit='lines/s')
+    results['stream.records'] = rate('stream binary records', lambda: play(ibuddy, records, True),
+                                     count, unit='frames/s')
+    return results
+
+if __name__ == "__main__":
+    main(sys.argv)
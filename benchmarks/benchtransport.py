@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+# Benchmark for sending frames: createmsg(), sendcommand() and reset() (with
+# and without resetting the position), on a simulated device without
+# latency, so only the overhead of py3buddy itself is measured.
+#
+# Copyright 2017-2019 - Armijn Hemel for Tjaldur Software Governance Solutions
+# SPDX-Identifier: MIT
+
+import sys
+import threading
+from benchutil import bench, rate
+
+import py3buddy
+import py3buddysim
+
+# amount of frames per measurement
+frames = 20000
+
+
+def main(argv):
+    sim = py3buddysim.SimulatedDevice()
+    ibuddy = py3buddy.iBuddy({}, find=sim.find)
+
+    results = {}
+    results['transport.createmsg'] = bench('createmsg', ibuddy.createmsg)
+
+    def sendframes():
+        for i in range(frames):
+            ibuddy.sendcommand()
+    results['transport.sendcommand'] = rate('sendcommand', sendframes, frames)
+
+    states = bytes(range(256)) * (frames // 256)
+
+    def sendstates():
+        for state in states:
+            ibuddy.sendstate(state)
+    results['transport.sendstate'] = rate('sendstate', sendstates, len(states))
+
+    def commitframes():
+        for i in range(frames):
+            with ibuddy.frame() as f:
+                f.setcolour(py3buddy.RED)
+    results['transport.frame'] = rate('frame commit (1 thread)', commitframes, frames)
+
+    # several threads committing frames at the same time
+    def contention():
+        threads = [threading.Thread(target=commitframes) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    results['transport.frame.4threads'] = rate('frame commit (4 threads)', contention, frames * 4, repeat=3)
+
+    # the device has to be moved away from its rest
+    # state, otherwise the reset is skipped
+    def resetframe():
+        ibuddy.wiggle('left')
+        ibuddy.sendcommand()
+        ibuddy.reset()
+    results['transport.reset'] = bench('sendcommand + reset', resetframe, number=10000)
+    results['transport.reset.skipped'] = bench('reset (at rest, skipped)', ibuddy.reset)
+
+    ibuddy = py3buddy.iBuddy({'reset_position': True}, find=sim.find)
+    ibuddy.reset()
+
+    def resetright():
+        ibuddy.wiggle('right')
+        ibuddy.sendcommand()
+        ibuddy.reset()
+    results['transport.reset.position'] = bench('sendcommand + reset (reset_position)', resetright, number=10000)
+    return results
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+# Benchmark for the transports: the time spent in Python for a single
+# control transfer with pyusb and with the usbfs transport
+# (py3buddyusbfs.py), without a device. pyusb gets a backend that does
+# nothing, the usbfs transport gets an ioctl that does nothing, so only the
+# overhead of the transports themselves is measured. The benchmark for
+# pyusb is skipped if pyusb is not installed.
+#
+# Copyright 2017-2019 - Armijn Hemel for Tjaldur Software Governance Solutions
+# SPDX-Identifier: MIT
+
+import sys
+import os
+import tempfile
+from benchutil import bench, rate, skipped
+
+import py3buddy
+
+try:
+    import py3buddyusbfs
+except ImportError:
+    py3buddyusbfs = None
+
+# amount of frames per measurement
+frames = 10000
+
+
+def nullioctl(fd, request, arg, mutate_flag=True):
+    # an ioctl that does nothing, for control transfers
+    # it returns the length of the data like the kernel
+    return 8
+
+
+def pyusbdevice():
+    # a pyusb device with a backend that does nothing, or
+    # None if pyusb (or this version of it) is not available
+    import usb.backend
+    import usb.core
+
+    class NullDescriptor:
+        # all fields of the device descriptor are 0
+        def __getattr__(self, name):
+            return 0
+
+    class NullBackend(usb.backend.IBackend):
+        def enumerate_devices(self):
+            return iter([object()])
+
+        def get_device_descriptor(self, dev):
+            return NullDescriptor()
+
+        def open_device(self, dev):
+            return object()
+
+        def close_device(self, dev_handle):
+            pass
+
+        def claim_interface(self, dev_handle, intf):
+            pass
+
+        def release_interface(self, dev_handle, intf):
+            pass
+
+        def ctrl_transfer(self, dev_handle, bmRequestType, bRequest, wValue,
+                          wIndex, data, timeout):
+            return len(data)
+
+    return usb.core.Device(object(), NullBackend())
+
+
+def main(argv):
+    results = {}
+    msg = py3buddy.statemsgs[0x7f]
+
+    try:
+        dev = pyusbdevice()
+        dev.ctrl_transfer(0x21, 0x09, 2, 1, msg)
+    except Exception as e:
+        skipped('pyusb ctrl_transfer', e)
+    else:
+        results['usbfs.pyusb.transfer'] = bench('pyusb ctrl_transfer',
+                                                lambda: dev.ctrl_transfer(0x21, 0x09, 2, 1, msg),
+                                                number=10000)
+
+    if py3buddyusbfs is None:
+        skipped('usbfs ctrl_transfer', 'not available on this platform')
+        return results
+
+    with tempfile.TemporaryDirectory() as sysfspath:
+        # a configured device in sysfs. /dev/null is opened
+        # instead of a device, the ioctls never reach it.
+        with open(os.path.join(sysfspath, 'bConfigurationValue'), 'w') as configfile:
+            configfile.write('1\n')
+        usbfsdev = py3buddyusbfs.UsbfsDevice(os.devnull, sysfspath, 0x1130, 0x0001, 1, 2,
+                                             ioctl=nullioctl)
+        results['usbfs.usbfs.transfer'] = bench('usbfs ctrl_transfer',
+                                                lambda: usbfsdev.ctrl_transfer(0x21, 0x09, 2, 1, msg),
+                                                number=100000)
+
+        ibuddy = py3buddy.iBuddy({}, find=lambda **kwargs: usbfsdev)
+
+        def send():
+            for i in range(frames):
+                ibuddy.sendcommand()
+        results['usbfs.usbfs.sendcommand'] = rate('sendcommand (usbfs)', send, frames)
+        ibuddy.close()
+    return results
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+# Helpers for the py3buddy benchmarks.
+#
+# Copyright 2017-2019 - Armijn Hemel for Tjaldur Software Governance Solutions
+# SPDX-Identifier: MIT
+
+import sys
+import os
+import time
+import timeit
+
+# the py3buddy modules are not installed as a package,
+# so make sure they can be imported
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'py3buddy'))
+
+
+def bench(name, func, number=100000, repeat=5, per=1, unit='ns'):
+    # best of 'repeat' runs, in nanoseconds per call, or per
+    # operation if every call does 'per' operations
+    best = min(timeit.repeat(func, number=number, repeat=repeat))
+    nanoseconds = best / number / per * 1000000000
+    print("%-50s %12.1f %s" % (name, nanoseconds, unit))
+    return {'value': nanoseconds, 'unit': unit, 'better': 'lower'}
+
+
+def rate(name, func, count, unit='frames/s', repeat=5):
+    # best of 'repeat' runs of func (which does 'count'
+    # operations), in operations per second
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    persecond = count / best
+    print("%-50s %12.1f %s" % (name, persecond, unit))
+    return {'value': persecond, 'unit': unit, 'better': 'higher'}
+
+
+def skipped(name, reason):
+    print("%-50s %12s (%s)" % (name, 'skipped', reason))
+
+
+def measured(name, value, unit, better, note=None):
+    # a value that was measured by the benchmark itself
+    if note is None:
+        print("%-50s %12.1f %s" % (name, value, unit))
+    else:
+        print("%-50s %12.1f %s (%s)" % (name, value, unit, note))
+    return {'value': value, 'unit': unit, 'better': better}
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+# Run all py3buddy benchmarks against a simulated device and write the
+# results to a JSON file, which can be compared with the results of an
+# earlier run to find regressions:
+#
+# $ python3 benchmarks/run.py -o before.json
+# $ python3 benchmarks/run.py -o after.json -c before.json
+#
+# Copyright 2017-2019 - Armijn Hemel for Tjaldur Software Governance Solutions
+# SPDX-Identifier: MIT
+
+import sys
+import os
+import argparse
+import datetime
+import json
+import platform
+
+# every benchmark imports benchutil, which makes sure the py3buddy
+# modules can be imported
+import benchstate
+import benchmacro
+import benchtransport
+import benchhandlers
+import benchdbus
+import benchsleep
+import benchstream
+import benchusbfs
+import benchfair
+import benchpwm
+
+benchmarks = [('state', benchstate), ('macro', benchmacro),
+              ('transport', benchtransport), ('handlers', benchhandlers),
+              ('dbus', benchdbus), ('sleep', benchsleep),
+              ('stream', benchstream), ('usbfs', benchusbfs),
+              ('fair', benchfair), ('pwm', benchpwm)]
+
+
+def compare(results, previous, threshold):
+    # compare results with the results of an earlier run and
+    # return the names of the benchmarks that got worse by more
+    # than 'threshold' (a fraction)
+    regressions = []
+    print("\nComparison with earlier run:\n")
+    for name in sorted(results):
+        if name not in previous:
+            continue
+        old = previous[name]['value']
+        new = results[name]['value']
+        if old == 0:
+            continue
+        change = (new - old) / old
+        if results[name]['better'] == 'higher':
+            change = -change
+        marker = ''
+        if change > threshold:
+            marker = 'REGRESSION'
+            regressions.append(name)
+        print("%-40s %12.1f -> %12.1f %s %+6.1f%% %s" % (name, old, new, results[name]['unit'], change * 100, marker))
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", "--output", action="store", dest="output",
+                        help="write results to FILE", metavar="FILE")
+    parser.add_argument("-c", "--compare", action="store", dest="compare",
+                        help="compare with results in FILE", metavar="FILE")
+    parser.add_argument("-t", "--threshold", action="store", type=float,
+                        dest="threshold", default=10,
+                        help="regression threshold in percent (default 10)")
+    parser.add_argument("-b", "--benchmark", action="append",
+                        dest="benchmarks", help="only run BENCHMARK",
+                        metavar="BENCHMARK")
+    args = parser.parse_args()
+
+    if args.compare is not None and not os.path.exists(args.compare):
+        parser.error("File to compare with does not exist")
+
+    results = {}
+    for (name, module) in benchmarks:
+        if args.benchmarks is not None and name not in args.benchmarks:
+            continue
+        print("\n%s\n" % name)
+        results.update(module.main(argv))
+
+    if args.output is not None:
+        report = {'date': datetime.datetime.utcnow().isoformat(),
+                  'python': platform.python_version(),
+                  'platform': platform.platform(),
+                  'results': results}
+        with open(args.output, 'w') as outfile:
+            json.dump(report, outfile, indent=4, sort_keys=True)
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as infile:
+            previous = json.load(infile)['results']
+        regressions = compare(results, previous, args.threshold / 100)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv)
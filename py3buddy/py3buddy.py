@@ -25,12 +25,28 @@
 # See https://github.com/pyusb/pyusb/blob/master/docs/tutorial.rst
 # for some of the explanations of the USB part
 
+import collections
+import errno
+import functools
+import heapq
+import itertools
+import json
+import os
+import re
+import sys
+import threading
 import time
 
 # import modules from pyusb
 import usb.core
 import usb.util
 
+# the usbfs transport only works on Linux
+try:
+    import py3buddyusbfs
+except ImportError:
+    py3buddyusbfs = None
+
 # The iBuddy works as follows (according to other people's code):
 # * a setup message is sent every time
 # * during initialization a reset message is sent
@@ -70,6 +86,17 @@ import usb.util
 # wings: 1 is wings high, 2 is wings low (could have been done in 1 bit)
 # motor: 0: center (but only after 'turn right', 1: turn left, 2: turn right,
 #        3: turn center a bit (but only after 'turn right')
+#
+# The masks for each of the actuators. An actuator is energized if any
+# of its bits is 0, so if (command & mask) != mask
+HEARTMASK = 0x80
+HEADMASK = 0x70
+WINGSMASK = 0x0c
+MOTORMASK = 0x03
+
+actuatormasks = {'wings': WINGSMASK, 'motor': MOTORMASK,
+                 'heart': HEARTMASK, 'head': HEADMASK}
+
 # the setup message
 setupbytes = [0x22, 0x09, 0x00, 0x02, 0x01, 0x00, 0x00, 0x00]
 setupmsg = bytes(setupbytes)
@@ -82,18 +109,122 @@ messagebytes = [0x55, 0x53, 0x42, 0x43, 0x00, 0x40, 0x02]
 resetbytes = messagebytes + [0xff]
 resetmsg = bytes(resetbytes)
 
-# some convenience dicts for colours
-NOCOLOUR = {'red': False, 'blue': False, 'green': False}
-RED = {'red': True, 'blue': False, 'green': False}
-BLUE = {'red': False, 'blue': True, 'green': False}
-GREEN = {'red': False, 'blue': False, 'green': True}
-CYAN = {'red': False, 'blue': True, 'green': True}
-YELLOW = {'red': True, 'blue': False, 'green': True}
-PURPLE = {'red': True, 'blue': True, 'green': False}
-WHITE = {'red': True, 'blue': True, 'green': True}
+# all 256 possible messages, created in advance so sending a frame
+# does not need to create a new message every time
+statemsgs = [bytes(messagebytes + [state]) for state in range(256)]
+
+# the wiggle positions, indexed by the value of the motor bits
+motorpositions = ['middle', 'left', 'right', 'middlereset']
+motorbits = {'middle': 0, 'left': 1, 'right': 2, 'middlereset': 3}
+
+# The motor bits are commands for the motor, not positions: 'middle' and
+# 'middlereset' only move the motor back to the middle after it turned
+# right, otherwise nothing happens. So the pose of the motor is modeled as
+# a graph: for every pose and motor bits the resulting pose, and the time
+# (in seconds) the motor needs to get there. 'unknown' is the pose before
+# anything was sent.
+motorposes = ['unknown', 'left', 'middle', 'right']
+
+# time the motor needs to turn
+MOTORDELAY = 0.05
+
+# the estimated cost of a single transfer (setup and state message),
+# in seconds, to compare plans with more transfers to plans that wait
+TRANSFERCOST = 0.002
+
+
+def maketransitions():
+    # for every pose and motor bits: the resulting pose and the delay
+    transitions = {}
+    for pose in motorposes:
+        transitions[(pose, motorbits['left'])] = ('left', MOTORDELAY)
+        transitions[(pose, motorbits['right'])] = ('right', MOTORDELAY)
+        for bits in [motorbits['middle'], motorbits['middlereset']]:
+            if pose == 'right':
+                transitions[(pose, bits)] = ('middle', MOTORDELAY)
+            else:
+                transitions[(pose, bits)] = (pose, 0.0)
+    return transitions
+
+posetransitions = maketransitions()
+
+# the pose that the motor bits are meant for
+motortargets = ['middle', 'left', 'right', 'middle']
+
+
+def planmotion(pose, bits):
+    # the cheapest list of (motor bits, time to wait) to get from 'pose'
+    # to the pose that 'bits' are meant for, ending with 'bits' itself.
+    # The cost of a plan is the amount of transfers and the waiting.
+    target = motortargets[bits]
+    counter = itertools.count()
+    queue = [(0.0, next(counter), pose, [])]
+    done = set()
+    while queue:
+        (cost, count, current, steps) = heapq.heappop(queue)
+        if posetransitions[(current, bits)][0] == target:
+            return steps + [(bits, 0.0)]
+        if current in done:
+            continue
+        done.add(current)
+        for nextbits in range(4):
+            (nextpose, delay) = posetransitions[(current, nextbits)]
+            if nextpose == current or nextpose in done:
+                continue
+            heapq.heappush(queue, (cost + TRANSFERCOST + delay, next(counter),
+                                   nextpose, steps + [(nextbits, delay)]))
+    return [(bits, 0.0)]
+
+# the plans for all poses and motor bits, computed in advance
+motionplans = {(pose, bits): planmotion(pose, bits)
+               for pose in motorposes for bits in range(4)}
+
+# the wings positions and their bits (neutral is 0b1100)
+wingsbits = {'high': 0x04, 'low': 0x08}
+wingspositions = {0x04: 'high', 0x08: 'low'}
+
+# Colours for the head LED. These are immutable (named tuples), and the
+# bits for the state byte are computed in advance, so setting a colour does
+# not need any lookups. colour['red'] keeps working, as colours used to be
+# dicts.
+class Colour(collections.namedtuple('Colour', ['name', 'description', 'red', 'green',
+                                               'blue', 'value', 'bits'])):
+    __slots__ = ()
+
+    def __new__(cls, name, description, red, green, blue):
+        # value: bit 0 is red, bit 1 is green, bit 2 is blue (1 is on)
+        value = int(red) | int(green) << 1 | int(blue) << 2
+        # bits in the state byte (0 is on)
+        bits = (7 - value) << 4
+        return super().__new__(cls, name, description, red, green, blue, value, bits)
+
+    def __getitem__(self, key):
+        if key in ('red', 'green', 'blue'):
+            return getattr(self, key)
+        return tuple.__getitem__(self, key)
+
+    def __getnewargs__(self):
+        # for pickle and copy, as value and bits are computed
+        return tuple(self)[:5]
+
+
+# some convenience colours
+NOCOLOUR = Colour('NOCOLOUR', 'no colour', False, False, False)
+RED = Colour('RED', 'red', True, False, False)
+BLUE = Colour('BLUE', 'blue', False, False, True)
+GREEN = Colour('GREEN', 'green', False, True, False)
+CYAN = Colour('CYAN', 'cyan', False, True, True)
+YELLOW = Colour('YELLOW', 'yellow', True, True, False)
+PURPLE = Colour('PURPLE', 'purple', True, False, True)
+WHITE = Colour('WHITE', 'white', True, True, True)
 
 # a list of all colours
 allcolours = [NOCOLOUR, RED, BLUE, GREEN, CYAN, YELLOW, PURPLE, WHITE]
+
+# all colours, indexed by their value, and by name
+colourbyvalue = sorted(allcolours, key=lambda c: c.value)
+colourbyname = {c.name: c for c in allcolours}
+
 allcolours_string = ["NOCOLOUR", "RED", "BLUE", "GREEN",
                      "CYAN", "YELLOW", "PURPLE", "WHITE"]
 
@@ -104,6 +235,22 @@ SLEEP = 1
 LONGSLEEP = 10
 GLACIAL = 100
 
+# sleeps with a duration in milliseconds, for example 250MS or 12.5MS
+sleepliteralre = re.compile(r'(\d+(?:\.\d+)?)MS$')
+
+# by default the last millisecond of a sleep is spent spinning instead of
+# sleeping, as the scheduler might wake up a thread too late
+SPINTHRESHOLD = 0.001
+
+
+def sleepliteral(token):
+    # the duration (in seconds) of a sleep token with a duration
+    # in milliseconds, or None if the token is not such a sleep
+    match = sleepliteralre.match(token)
+    if match is None:
+        return None
+    return float(match.group(1)) / 1000
+
 # a list of valid commands for the macro language
 validcmds = set(['ULTRASHORTSLEEP', 'SHORTSLEEP', 'SLEEP', 'LONGSLEEP',
                  'GLACIAL', 'RESET', 'GO', 'WINGSHIGH', 'WINGSLOW', 'HEART',
@@ -111,161 +258,1184 @@ validcmds = set(['ULTRASHORTSLEEP', 'SHORTSLEEP', 'SLEEP', 'LONGSLEEP',
                  'YELLOW', 'PURPLE', 'WHITE', 'LEFT', 'RIGHT', 'MIDDLE',
                  'MIDDLE2'])
 
+# An immutable state of the iBuddy (all capabilities at once), stored as the
+# state byte that is sent to the device. Changing a capability returns a
+# new state. All 256 states are created in advance, use fromstate() (or the
+# buddystates list) instead of creating new objects.
+class BuddyState:
+    __slots__ = ('state',)
+
+    def __init__(self, state=0xff):
+        object.__setattr__(self, 'state', state)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("BuddyState is immutable")
+
+    @staticmethod
+    def fromstate(state):
+        return buddystates[state]
+
+    @staticmethod
+    def decode(msg):
+        # decode a message that is sent to the device
+        if len(msg) != len(messagebytes) + 1 or msg[:-1] != statemsgs[0][:-1]:
+            raise ValueError("not an iBuddy message")
+        return buddystates[msg[-1]]
+
+    def encode(self):
+        return statemsgs[self.state]
+
+    @property
+    def heart(self):
+        return not self.state & HEARTMASK
+
+    @property
+    def colour(self):
+        return colourbyvalue[7 - ((self.state & HEADMASK) >> 4)]
+
+    @property
+    def wings(self):
+        return wingspositions.get(self.state & WINGSMASK)
+
+    @property
+    def position(self):
+        return motorpositions[self.state & MOTORMASK]
+
+    def withheart(self, heart):
+        if heart:
+            return buddystates[self.state & ~HEARTMASK]
+        return buddystates[self.state | HEARTMASK]
+
+    def withcolour(self, colour):
+        return buddystates[(self.state & ~HEADMASK) | colour.bits]
+
+    def withwings(self, wings):
+        return buddystates[(self.state & ~WINGSMASK) | wingsbits.get(wings, WINGSMASK)]
+
+    def withposition(self, pos):
+        return buddystates[(self.state & ~MOTORMASK) | motorbits[pos]]
+
+    def __int__(self):
+        return self.state
+
+    def __eq__(self, other):
+        if isinstance(other, BuddyState):
+            return self.state == other.state
+        return NotImplemented
+
+    def __hash__(self):
+        return self.state
+
+    def __repr__(self):
+        return 'BuddyState(0x%02x)' % self.state
+
+
+buddystates = [BuddyState(state) for state in range(256)]
+
 # There have been iBuddy products with various product IDs
 ibuddyids = [0x0001, 0x0002, 0x0004, 0x0005]
 
+# the interfaces of the iBuddy, which are both claimed
+ibuddyinterfaces = [0, 1]
+
+
+def devicekey(dev):
+    # the key of a device in the calibrations (see py3buddycalibrate.py):
+    # the product id and where the device is plugged in, as revisions of
+    # the iBuddy, cables and hubs can all make a difference
+    sysfspath = getattr(dev, 'sysfspath', None)
+    if sysfspath is not None:
+        buspath = sysfspath.rstrip('/').rsplit('/', 1)[-1]
+    else:
+        ports = getattr(dev, 'port_numbers', None)
+        if ports:
+            buspath = '%d-%s' % (dev.bus, '.'.join([str(p) for p in ports]))
+        else:
+            buspath = '%d-%d' % (dev.bus, dev.address)
+    return '0x%04x@%s' % (dev.idProduct, buspath)
+
+
+def readcalibrations(path):
+    # the calibrations in a file, or none if it cannot be read
+    try:
+        with open(path, 'r') as calibrationfile:
+            calibrations = json.load(calibrationfile)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(calibrations, dict):
+        return {}
+    return calibrations
+
+# The settings in the [ibuddy] section of the configuration file (see
+# py3buddy.config) that are used by iBuddy(), with the function to convert
+# the value, and the settings that are 'yes' or 'no' with their default.
+configsettings = [('productid', int), ('transport', str),
+                  ('retries', int), ('retry_backoff', float),
+                  ('tempo', float), ('spin_threshold', float),
+                  ('governor_window', float), ('governor_min_interval', float),
+                  ('idle_release', float), ('calibration', str),
+                  ('min_frame_interval', float)]
+configflags = [('reset_position', False), ('motion_planner', True),
+               ('governor', False), ('idle_reattach', False)]
+
+
+def parseconfig(config, section='ibuddy'):
+    # the configuration for iBuddy() from a section of a configuration
+    # file (a configparser.ConfigParser). Settings that are missing or
+    # that cannot be parsed are left out, so their defaults are used.
+    buddy_config = {}
+    for (name, convert) in configsettings:
+        try:
+            buddy_config[name] = convert(config.get(section, name))
+        except:
+            pass
+    for (name, default) in configflags:
+        buddy_config[name] = default
+        try:
+            value = config.get(section, name)
+        except:
+            continue
+        if default:
+            buddy_config[name] = value != 'no'
+        else:
+            buddy_config[name] = value == 'yes'
+
+    # budgets of the duty cycle governor, per actuator
+    buddy_config['governor_budgets'] = {}
+    buddy_config['governor_continuous'] = {}
+    for actuator in actuatormasks:
+        try:
+            buddy_config['governor_budgets'][actuator] = float(config.get(section, 'governor_%s' % actuator))
+        except:
+            pass
+        try:
+            buddy_config['governor_continuous'][actuator] = float(config.get(section, 'governor_%s_continuous' % actuator))
+        except:
+            pass
+    return buddy_config
+
+# USB errors are classified, to decide how to recover from them:
+# * disconnected: the device is gone (unplugged, hub reset), search again
+# * busy: the interface is claimed by another process, retry later
+# * transient: timeouts, stalls and I/O errors, retry
+# * fatal: for example permission problems, no point in retrying
+errorclasses = ['disconnected', 'busy', 'transient', 'fatal']
+errnoclasses = {errno.ENODEV: 'disconnected', errno.ENOENT: 'disconnected',
+                errno.ESHUTDOWN: 'disconnected', errno.EBUSY: 'busy',
+                errno.ETIMEDOUT: 'transient', errno.EPIPE: 'transient',
+                errno.EIO: 'transient', errno.EOVERFLOW: 'transient',
+                errno.EINTR: 'transient', errno.EAGAIN: 'transient',
+                errno.EACCES: 'fatal', errno.EPERM: 'fatal',
+                errno.EBADF: 'fatal'}
+
+# libusb error codes, for when errno is not set
+libusbclasses = {-4: 'disconnected', -6: 'busy', -7: 'transient',
+                 -9: 'transient', -1: 'transient', -8: 'transient',
+                 -10: 'transient', -3: 'fatal'}
+
+
+def classifyerror(error):
+    # classify a usb.core.USBError
+    if error.errno in errnoclasses:
+        return errnoclasses[error.errno]
+    backend_error_code = getattr(error, 'backend_error_code', None)
+    if backend_error_code in libusbclasses:
+        return libusbclasses[backend_error_code]
+    return 'transient'
+
+
+# default duty cycle budgets for the governor: the maximum amount of
+# seconds an actuator may be energized in the sliding window, and the
+# maximum amount of seconds it may be energized without interruption.
+# The wing solenoid and the wiggle motor are the parts that get hot, the
+# LEDs are not limited (None) unless a budget is configured for them.
+governorwindow = 60
+governorbudgets = {'wings': 20, 'motor': 20, 'heart': None, 'head': None}
+governorcontinuous = {'wings': 5, 'motor': 5, 'heart': None, 'head': None}
+
+
+# The governor keeps track of how long each actuator (wings, motor, heart,
+# head LED) has been energized in a sliding window. Every frame that is
+# sent to the device passes through the governor. If an actuator has used
+# up its budget the bits for that actuator are set to 'off' in the frame
+# that is sent instead (substitution). Optionally frames that are sent too
+# quickly after each other are delayed (throttling).
+class Governor:
+    def __init__(self, window=governorwindow, budgets=None, continuous=None,
+                 min_interval=0):
+        self.window = window
+        self.budgets = dict(governorbudgets)
+        if budgets is not None:
+            self.budgets.update(budgets)
+        self.continuous = dict(governorcontinuous)
+        if continuous is not None:
+            self.continuous.update(continuous)
+        self.min_interval = min_interval
+
+        # per actuator a list of closed (start, end) intervals during
+        # which the actuator was energized, plus the start of the
+        # interval that is still open (or None if the actuator is off)
+        self.intervals = {}
+        self.onsince = {}
+        for actuator in actuatormasks:
+            self.intervals[actuator] = collections.deque()
+            self.onsince[actuator] = None
+
+        # the state that was last sent to the device
+        self.state = 0xff
+        self.lastframe = None
+
+        # counters for monitoring
+        self.counters = {'frames': 0, 'substituted': 0, 'throttled': 0,
+                         'throttledtime': 0.0}
+        self.blocked = {}
+        for actuator in actuatormasks:
+            self.blocked[actuator] = 0
+
+    def prune(self, now):
+        # remove all intervals that are completely outside of the window
+        start = now - self.window
+        for actuator in actuatormasks:
+            intervals = self.intervals[actuator]
+            while intervals and intervals[0][1] <= start:
+                intervals.popleft()
+
+    def usage(self, actuator, now):
+        # compute how long an actuator has been energized
+        # in the window ending at 'now'. Intervals are only pruned when a
+        # frame is recorded, so intervals that ended before the window
+        # started can still be stored and are skipped here.
+        start = now - self.window
+        used = 0.0
+        for (intervalstart, intervalend) in self.intervals[actuator]:
+            if intervalend <= start:
+                continue
+            used += intervalend - max(intervalstart, start)
+        if self.onsince[actuator] is not None:
+            used += now - max(self.onsince[actuator], start)
+        return used
+
+    def allowed(self, actuator, now):
+        # an actuator is allowed to be (or stay) on if it is within
+        # its budget for the window and it has not been on for too
+        # long without interruption
+        budget = self.budgets[actuator]
+        if budget is not None and self.usage(actuator, now) >= budget:
+            return False
+        continuous = self.continuous[actuator]
+        onsince = self.onsince[actuator]
+        if continuous is not None and onsince is not None and now - onsince >= continuous:
+            return False
+        return True
+
+    def record(self, state, now):
+        # record that 'state' was sent to the device at time 'now'
+        for actuator in actuatormasks:
+            mask = actuatormasks[actuator]
+            energized = (state & mask) != mask
+            onsince = self.onsince[actuator]
+            if energized and onsince is None:
+                self.onsince[actuator] = now
+            elif not energized and onsince is not None:
+                self.intervals[actuator].append((onsince, now))
+                self.onsince[actuator] = None
+        self.state = state
+        self.lastframe = now
+        self.prune(now)
+
+    def filter(self, command):
+        # process a frame that is about to be sent to the device and
+        # return the frame that should actually be sent
+        now = time.monotonic()
+
+        # first throttle, if needed
+        if self.min_interval and self.lastframe is not None:
+            wait = self.lastframe + self.min_interval - now
+            if wait > 0:
+                self.counters['throttled'] += 1
+                self.counters['throttledtime'] += wait
+                time.sleep(wait)
+                now = time.monotonic()
+
+        # then switch off every actuator that exceeded its budget
+        state = command
+        for actuator in actuatormasks:
+            mask = actuatormasks[actuator]
+            if (state & mask) == mask:
+                continue
+            if not self.allowed(actuator, now):
+                state = state | mask
+                self.blocked[actuator] += 1
+        if state != command:
+            self.counters['substituted'] += 1
+        self.counters['frames'] += 1
+        self.record(state, now)
+        return state
+
+    def holdlimit(self):
+        # return the amount of seconds the current state can be kept
+        # before one of the energized actuators exceeds its budget,
+        # or None if nothing that is limited is energized
+        now = time.monotonic()
+        limit = None
+        for actuator in actuatormasks:
+            onsince = self.onsince[actuator]
+            if onsince is None:
+                continue
+            remaining = None
+            if self.budgets[actuator] is not None:
+                remaining = self.budgets[actuator] - self.usage(actuator, now)
+            if self.continuous[actuator] is not None:
+                continuous = self.continuous[actuator] - (now - onsince)
+                if remaining is None or continuous < remaining:
+                    remaining = continuous
+            if remaining is None:
+                continue
+            remaining = max(remaining, 0)
+            if limit is None or remaining < limit:
+                limit = remaining
+        return limit
+
+    def stats(self):
+        # return the counters, for monitoring
+        now = time.monotonic()
+        result = dict(self.counters)
+        result['state'] = self.state
+        result['window'] = self.window
+        result['actuators'] = {}
+        for actuator in actuatormasks:
+            result['actuators'][actuator] = {
+                'usage': self.usage(actuator, now),
+                'budget': self.budgets[actuator],
+                'energized': self.onsince[actuator] is not None,
+                'blocked': self.blocked[actuator]}
+        return result
+
+
+# raised when a playback is cancelled
+class Cancelled(Exception):
+    pass
+
+
+# A handle for playing a command: it can be cancelled from another thread,
+# and has a priority that can be used to decide to preempt it.
+#
+# The tempo is a multiplier for the speed of all sleeps in the command
+# (2.0 plays twice as fast). If it is None the tempo of the iBuddy is used.
+#
+# The client is the name of whoever submitted the command (for fair
+# scheduling in the player, see py3buddyplayer.py), or None.
+#
+# Every playback gets a unique id (counting from 1). The times at which it
+# was submitted and finished are kept (time.monotonic()), and the error if
+# playing it raised one.
+playbackids = itertools.count(1)
+
+
+class Playback:
+    def __init__(self, cmd, priority=0, tempo=None, client=None):
+        self.id = next(playbackids)
+        self.cmd = cmd
+        self.priority = priority
+        if tempo is not None and not tempo > 0:
+            raise ValueError("tempo should be larger than 0")
+        self.tempo = tempo
+        self.client = client
+        self.cancelled = threading.Event()
+        self.done = threading.Event()
+        self.completed = False
+        self.submitted = time.monotonic()
+        self.finished = None
+        self.error = None
+        # set if the command was not valid, so it was not played
+        self.invalid = False
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def wait(self, timeout=None):
+        # wait for the playback to finish, returns True if it
+        # finished (completed or cancelled)
+        return self.done.wait(timeout)
+
+
+# The methods to set the capabilities of the iBuddy (heart LED, head LED,
+# wings and motor) in the state byte. These are shared by the iBuddy
+# itself and by frames (see Frame).
+class Capabilities:
+    def wiggle(self, pos):
+        # method to wiggle: replace the motor bits
+        # middle = 0b00, left = 0b01, right = 0b10, middlereset = 0b11
+        if pos in motorbits:
+            self.command = (self.command & ~MOTORMASK) | motorbits[pos]
+            self.pos = pos
+        else:
+            # explicitely set to "no wiggle"
+            self.command = self.command | MOTORMASK
+
+    def toggleheart(self, heart):
+        # method to toggle the heart LED (0 is on)
+        if heart:
+            self.command = self.command & ~HEARTMASK
+        else:
+            self.command = self.command | HEARTMASK
+
+    def wings(self, wings):
+        # method to set the position of the wings
+        # high = 0b0100, low = 0b1000, anything else is "neutral"
+        self.command = (self.command & ~WINGSMASK) | wingsbits.get(wings, WINGSMASK)
+
+    def setcolour(self, colour):
+        # method to set the colour of the head LED
+        # colour profile: {'r', 'g', 'b'}
+        if isinstance(colour, Colour):
+            bits = colour.bits
+        else:
+            # a plain dict
+            bits = HEADMASK
+            if colour['red']:
+                bits -= 16
+            if colour['green']:
+                bits -= 32
+            if colour['blue']:
+                bits -= 64
+        self.command = (self.command & ~HEADMASK) | bits
+
+
+# A frame is built on a private copy of the state of an iBuddy and is
+# committed atomically when the 'with' block ends without an exception:
+#
+# with ibuddy.frame() as f:
+#     f.setcolour(py3buddy.RED)
+#     f.wings('high')
+#
+# Only the capabilities that were set in the frame are changed, so threads
+# that drive different capabilities do not overwrite each other.
+class Frame(Capabilities):
+    def __init__(self, ibuddy):
+        self.ibuddy = ibuddy
+        with ibuddy.statelock:
+            self.command = ibuddy.command
+            self.pos = ibuddy.pos
+        # the bits that were changed in this frame
+        self.changed = 0
+
+    def wiggle(self, pos):
+        Capabilities.wiggle(self, pos)
+        self.changed |= MOTORMASK
+
+    def toggleheart(self, heart):
+        Capabilities.toggleheart(self, heart)
+        self.changed |= HEARTMASK
+
+    def wings(self, wings):
+        Capabilities.wings(self, wings)
+        self.changed |= WINGSMASK
+
+    def setcolour(self, colour):
+        Capabilities.setcolour(self, colour)
+        self.changed |= HEADMASK
+
+    def setstate(self, state):
+        self.command = state.state
+        self.pos = state.position
+        self.changed = 0xff
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exctype, excvalue, traceback):
+        if exctype is None:
+            self.ibuddy.commit(self.command, self.pos, self.changed)
+        return False
 
-class iBuddy:
+
+class iBuddy(Capabilities):
     # First find the iBuddy.
-    def __init__(self, buddy_config):
+    def __init__(self, buddy_config, find=None):
         self.dev = None
-        if 'productid' not in buddy_config:
+
+        # the function to search for USB devices, which takes the same
+        # arguments as usb.core.find(). This can be replaced, for example
+        # by a simulated device (see py3buddysim.py). Which transport is
+        # used can also be set in the configuration: 'pyusb' (the default)
+        # or 'usbfs' (Linux only, see py3buddyusbfs.py).
+        if find is None:
+            transport = buddy_config.get('transport', 'pyusb')
+            if transport == 'usbfs':
+                if py3buddyusbfs is None:
+                    raise ValueError("usbfs transport is not available")
+                find = py3buddyusbfs.find
+            elif transport == 'pyusb':
+                find = usb.core.find
+            else:
+                raise ValueError("unknown transport: %s" % transport)
+        self.find = find
+
+        # The state (command and pos) is protected by statelock, which is
+        # only held for very short times. Sending to the device is
+        # protected by transmitlock, so setup messages and commands of
+        # different threads are not interleaved.
+        self.statelock = threading.Lock()
+        self.transmitlock = threading.RLock()
+
+        # frames that were committed, but not yet sent
+        self.pending = False
+        self.transmitting = False
+
+        # per thread data, such as the playback that is active
+        self.local = threading.local()
+
+        # optional metrics (see py3buddymetrics.py), assign
+        # a Metrics object to enable
+        self.metrics = None
+
+        # optional recorder for all the states that are sent to the
+        # device (see py3buddyrecord.py)
+        self.recorder = None
+
+        # optional tracer (see py3buddytrace.py)
+        self.tracer = None
+
+        # optional live state page (see py3buddystatepage.py), and the
+        # amount of times it could not be written
+        self.statepage = None
+        self.statepageerrors = 0
+
+        # optionally create a governor to protect the device
+        # from overheating
+        self.governor = None
+        if buddy_config.get('governor', False):
+            self.governor = Governor(
+                window=buddy_config.get('governor_window', governorwindow),
+                budgets=buddy_config.get('governor_budgets'),
+                continuous=buddy_config.get('governor_continuous'),
+                min_interval=buddy_config.get('governor_min_interval', 0))
+        # state of the device
+        self.command = 0xff
+        self.pos = None
+        if 'reset_position' in buddy_config:
+            self.resetpos = buddy_config['reset_position']
+        else:
+            self.resetpos = False
+
+        # settings for recovering from USB errors: the amount of retries
+        # for a single transfer and the initial backoff (in seconds),
+        # which is doubled for every retry.
+        self.retries = buddy_config.get('retries', 3)
+        self.backoff = buddy_config.get('retry_backoff', 0.001)
+
+        # the default tempo for sleeps in commands (2.0 plays twice
+        # as fast) and the last part of a sleep (in seconds) that is
+        # spent spinning, to wake up on time
+        self.tempo = buddy_config.get('tempo', 1.0)
+        if not self.tempo > 0:
+            raise ValueError("tempo should be larger than 0")
+        self.spin = buddy_config.get('spin_threshold', SPINTHRESHOLD)
+
+        # the last state that was successfully sent to the device,
+        # which is sent again after reconnecting. None means that the
+        # state of the device is not known.
+        self.laststate = None
+
+        # the pose of the motor (see motorposes), and whether commands
+        # that move the motor to the middle should first bring the motor
+        # in a pose from which that works (see motionplans). The motor
+        # bits that were last sent are kept even when the pose is not
+        # known anymore (after an idle release), so a command that keeps
+        # the motor where it was does not move it again.
+        self.pose = 'unknown'
+        self.lastmotor = None
+        self.planmotion = buddy_config.get('motion_planner', True)
+
+        # counters for the transport, for monitoring
+        self.transportstats = {'errors': 0, 'retries': 0, 'reconnects': 0,
+                               'reconnectfailures': 0, 'releases': 0,
+                               'reacquires': 0}
+        for errorclass in errorclasses:
+            self.transportstats['errors_%s' % errorclass] = 0
+
+        # the kernel drivers that were detached from the interfaces,
+        # and whether or not the device was closed (see close())
+        self.detached = []
+        self.closed = False
+
+        # optionally release the device when it was not used for
+        # 'idlerelease' seconds, so other programs can use it, and
+        # claim it again when the next state is sent. The device that
+        # was released is remembered, so it can be claimed again without
+        # searching for it. If 'idlereattach' is set the kernel drivers
+        # are attached again when releasing the device.
+        self.idlerelease = buddy_config.get('idle_release', 0)
+        self.idlereattach = buddy_config.get('idle_reattach', False)
+        self.idledev = None
+        self.released = False
+        self.lastused = time.monotonic()
+        self.idlestop = threading.Event()
+
+        # the minimum time between two frames, to not send frames faster
+        # than the device can accept them. This is the time that every
+        # state is held at least. It can be set in the configuration, or
+        # taken from the calibration of the device (see py3buddycalibrate.py).
+        self.minframeinterval = buddy_config.get('min_frame_interval', 0)
+        self.lastframe = 0.0
+        self.calibrations = {}
+        if buddy_config.get('calibration'):
+            self.calibrations = readcalibrations(os.path.expanduser(buddy_config['calibration']))
+        self.calibration = None
+
+        self.productid = buddy_config.get('productid')
+        if self.productid is not None and self.productid not in ibuddyids:
+            return
+
+        self.dev = self.finddevice()
+        self.applycalibration()
+        if self.idlerelease:
+            threading.Thread(target=self.idlewatcher, daemon=True).start()
+
+    def finddevice(self):
+        # find the iBuddy, either using the configured product id or
+        # by trying all known product ids. Returns None if no (usable)
+        # device could be found.
+        dev = None
+        if self.productid is None:
             # productid not hardcoded, so search for it
-            buddyfound = False
             for product_id in ibuddyids:
-                self.dev = usb.core.find(idVendor=0x1130, idProduct=product_id)
-                if self.dev is None:
-                    continue
-                buddyfound = True
-                break
-            if not buddyfound:
-                return
+                dev = self.find(idVendor=0x1130, idProduct=product_id)
+                if dev is not None:
+                    break
         else:
-            if not buddy_config['productid'] in ibuddyids:
-                return
-            self.dev = usb.core.find(idVendor=0x1130,
-                                     idProduct=buddy_config['productid'])
+            dev = self.find(idVendor=0x1130, idProduct=self.productid)
 
         # check if the device was found. If not, return.
-        if self.dev is None:
-            return
+        if dev is None:
+            return None
+
+        detached = self.claimdevice(dev)
+        if detached is None:
+            return None
+        self.detached = detached
+        return dev
 
-        # first remove all the kernel drivers. Probably better to do this
-        # with a udev blacklist rule?
+    def claimdevice(self, dev):
+        # prepare a device for use. Returns the interfaces of which the
+        # kernel driver was detached, or None if the device could not
+        # be used, for example because another process is using it.
+        #
+        # First remove all the kernel drivers. Probably better to do this
+        # with a udev blacklist rule? Remember which drivers were removed,
+        # so close() can attach them again.
+        detached = []
         try:
-            if self.dev.is_kernel_driver_active(0) is True:
-                self.dev.detach_kernel_driver(0)
+            for interface in ibuddyinterfaces:
+                if dev.is_kernel_driver_active(interface) is True:
+                    dev.detach_kernel_driver(interface)
+                    detached.append(interface)
         except usb.core.USBError:
-            self.dev = None
-            return
+            self.releasedevice(dev, detached)
+            return None
 
+        # there is just one configuration in the iBuddy, so use it if the
+        # device is not configured yet. Then claim both interfaces once,
+        # instead of letting pyusb claim them for every transfer. If another
+        # process is using the device this fails here and not halfway
+        # through sending a command.
         try:
-            if self.dev.is_kernel_driver_active(1) is True:
-                self.dev.detach_kernel_driver(1)
+            try:
+                dev.get_active_configuration()
+            except usb.core.USBError:
+                dev.set_configuration()
+            for interface in ibuddyinterfaces:
+                usb.util.claim_interface(dev, interface)
         except usb.core.USBError:
+            self.releasedevice(dev, detached)
+            return None
+        return detached
+
+    def releasedevice(self, dev, detached):
+        # release the interfaces, attach the kernel drivers that were
+        # detached and free all resources of a device handle
+        for interface in ibuddyinterfaces:
+            try:
+                usb.util.release_interface(dev, interface)
+            except usb.core.USBError:
+                pass
+        for interface in detached:
+            try:
+                dev.attach_kernel_driver(interface)
+            except usb.core.USBError:
+                pass
+        try:
+            usb.util.dispose_resources(dev)
+        except usb.core.USBError:
+            pass
+
+    def close(self):
+        # release the device, after which it can be used by other
+        # programs (or the kernel) again. The iBuddy cannot be used
+        # anymore after this.
+        with self.transmitlock:
+            self.closed = True
+            self.idlestop.set()
+            if self.dev is None:
+                # a device that was released when it was idle
+                # might still need its kernel drivers
+                if self.idledev is not None and self.detached:
+                    self.releasedevice(self.idledev, self.detached)
+                    self.detached = []
+                self.idledev = None
+                return
+            self.releasedevice(self.dev, self.detached)
+            self.detached = []
             self.dev = None
+
+    def applycalibration(self):
+        # use the calibration of the device that was found, if any. The
+        # minimum time between frames that was configured is only raised.
+        if self.dev is None:
             return
+        calibration = self.calibrations.get(devicekey(self.dev))
+        if calibration is None or self.calibration is calibration:
+            return
+        self.calibration = calibration
+        try:
+            interval = float(calibration['minframeinterval'])
+        except (KeyError, TypeError, ValueError):
+            return
+        self.minframeinterval = max(self.minframeinterval, interval)
 
-        # there is just one configuration in the iBuddy, so use it
-        # (is this necessary?)
-        #self.dev.set_configuration()
+    def idlewatcher(self):
+        # release the device when it was not used for a while (see
+        # release()), until the iBuddy is closed
+        while True:
+            if self.dev is None:
+                # not connected or already released
+                wait = self.idlerelease
+            else:
+                wait = self.lastused + self.idlerelease - time.monotonic()
+            if wait > 0:
+                if self.idlestop.wait(wait):
+                    return
+                continue
+            with self.transmitlock:
+                if self.closed:
+                    return
+                if self.dev is not None and time.monotonic() - self.lastused >= self.idlerelease:
+                    self.release()
 
-        # then grab the active configuration (a bit superfluous here though)
-        #self.cfg = self.dev.get_active_configuration()
-        self.command = 0xff
-        self.pos = None
-        if 'reset_position' in buddy_config:
-            self.resetpos = buddy_config['reset_position']
+    def release(self):
+        # release the device so other programs can use it. It is claimed
+        # again by the next transfer (see reacquire()). As other programs
+        # can change the state of the device in the meantime, the state
+        # and the pose of the motor are not known after this.
+        if self.idlereattach:
+            self.releasedevice(self.dev, self.detached)
+            self.detached = []
         else:
-            self.resetpos = False
+            self.releasedevice(self.dev, [])
+        self.idledev = self.dev
+        self.dev = None
+        self.released = True
+        self.laststate = None
+        self.pose = 'unknown'
+        self.transportstats['releases'] += 1
+
+    def reacquire(self):
+        # claim the device again after it was released. The device that
+        # was released is tried first, which is a lot faster than
+        # searching for it. Returns True if the device can be used.
+        dev = None
+        if self.idledev is not None:
+            detached = self.claimdevice(self.idledev)
+            if detached is not None:
+                dev = self.idledev
+                self.detached = sorted(set(self.detached) | set(detached))
+        if dev is None:
+            dev = self.finddevice()
+            if dev is None:
+                return False
+        self.dev = dev
+        self.idledev = None
+        self.released = False
+        self.lastused = time.monotonic()
+        self.transportstats['reacquires'] += 1
+        return True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def reconnect(self):
+        # drop the current device handle and search for the device
+        # again, for example after it was unplugged or the hub was reset.
+        # Returns True if the device was found again.
+        if self.closed:
+            return False
+        if self.dev is not None:
+            # the device was probably unplugged, so there are
+            # no kernel drivers to attach again
+            self.releasedevice(self.dev, [])
+            self.detached = []
+        # the motor does not move when the device is reset or found
+        # again, so the pose of the motor is still known
+        self.dev = self.finddevice()
+        if self.dev is None:
+            self.transportstats['reconnectfailures'] += 1
+            return False
+        self.idledev = None
+        self.released = False
+        self.applycalibration()
+
+        # the device was (probably) reset, so bring it back to
+        # the last known state. Only then the reconnect counts.
+        if self.laststate not in (None, 0xff):
+            try:
+                self.ctrltransfer(setupmsg)
+                self.ctrltransfer(self.createmsg(self.laststate))
+            except usb.core.USBError:
+                self.transportstats['reconnectfailures'] += 1
+                return False
+        self.transportstats['reconnects'] += 1
+        if self.metrics is not None:
+            self.metrics.inc('reconnects_total')
+        return True
 
-    def reset(self):
+    def needscentering(self):
+        # whether a reset should move the motor to the middle. If the pose
+        # of the motor is not known (at startup, or after an idle release)
+        # this is only done with the motion planner, which turns the motor
+        # right and then back to the middle.
+        if not self.resetpos or self.pose == 'middle':
+            return False
+        if self.pose == 'unknown' and not self.planmotion:
+            return False
+        return True
+
+    def atrest(self):
+        # the device is at rest if the last state that was sent to it was
+        # the reset state and, if the position should be reset as well,
+        # the motor is in the middle
+        if self.laststate != 0xff:
+            return False
+        if self.needscentering():
+            return False
+        return True
+
+    def reset(self, force=False):
         # method to explicitely reset the iBuddy
         # if configured it will also reset its wiggling position
-        # to center, although for right this does not always
-        # seem to work
-        if self.resetpos:
-            self.dev.ctrl_transfer(0x21, 0x09, 2, 1, setupmsg)
-            if self.pos == 'left':
-                self.wiggle('right')
-                msg = self.createmsg()
-                self.dev.ctrl_transfer(0x21, 0x09, 2, 1, msg)
-                time.sleep(0.05)
-                self.wiggle('middle')
-                msg = self.createmsg()
-                self.dev.ctrl_transfer(0x21, 0x09, 2, 1, setupmsg)
-                self.dev.ctrl_transfer(0x21, 0x09, 2, 1, msg)
-            elif self.pos == 'right':
-                self.wiggle('middlereset')
-                msg = self.createmsg()
-                self.dev.ctrl_transfer(0x21, 0x09, 2, 1, msg)
-        self.dev.ctrl_transfer(0x21, 0x09, 2, 1, setupmsg)
-        self.dev.ctrl_transfer(0x21, 0x09, 2, 1, resetmsg)
-        # reset the command byte
-        self.command = 0xff
+        # to center
+        #
+        # If the device is already at rest nothing is sent, unless
+        # 'force' is set.
+        with self.transmitlock:
+            if not force and self.atrest():
+                with self.statelock:
+                    self.command = 0xff
+                if self.metrics is not None:
+                    self.metrics.inc('resets_skipped_total')
+                return
+            if self.metrics is not None:
+                start = time.monotonic()
+            if self.tracer is not None:
+                tracestart = self.tracer.now()
+            if self.needscentering():
+                # move the motor to the middle with the motion plan for
+                # the pose it is in (see motionplans), through the
+                # governor and at most at the frame rate of the device
+                for (bits, delay) in motionplans[(self.pose, motorbits['middle'])]:
+                    self.transmit((self.command & ~MOTORMASK) | bits)
+                    if delay:
+                        self.wait(delay, cancellable=False)
+            # instead of blindly resetting twice check how many bytes
+            # the device accepted and only send the reset again if the
+            # message was not accepted completely
+            for attempt in range(2):
+                self.pace()
+                self.transfer(setupmsg)
+                if self.transfer(resetmsg) == len(resetmsg):
+                    break
+            # reset the command byte
+            with self.statelock:
+                self.command = 0xff
+            if self.governor is not None:
+                self.governor.record(0xff, time.monotonic())
+            if self.metrics is not None:
+                self.metrics.inc('resets_total')
+                self.metrics.observe('reset_seconds', time.monotonic() - start)
+            if self.tracer is not None:
+                self.tracer.span('reset', 'reset', tracestart, self.tracer.now())
 
+    # The capabilities can be set from several threads (for example the
+    # player of the DBus service and frames that are committed by other
+    # threads), so the state is changed under statelock.
     def wiggle(self, pos):
-        # method to wiggle
-        # first reset the status explicitely to "no wiggle"
-        # 0b11 == 3
-        self.command = self.command | 3
-        if pos == 'middle':
-            # middle = 0
-            # 0b00
-            self.command -= 3
-            self.pos = 'middle'
-        elif pos == 'left':
-            # left = 1
-            # 0b01
-            self.command -= 2
-            self.pos = 'left'
-        elif pos == 'right':
-            # right = 2
-            # 0b10
-            self.command -= 1
-            self.pos = 'right'
-        elif pos == 'middlereset':
-            # initial position = 3
-            # 0b11
-            self.command = self.command | 3
-            self.pos = 'middlereset'
+        with self.statelock:
+            Capabilities.wiggle(self, pos)
 
     def toggleheart(self, heart):
-        # method to toggle the heart LED
-        # first reset the status explicitely to
-        # "no heart LED"
-        self.command = self.command | 128
-        if heart:
-            self.command -= 128
+        with self.statelock:
+            Capabilities.toggleheart(self, heart)
 
     def wings(self, wings):
-        # method to set the position of the wings
-        # first reset the status explicitely to
-        # "neutral"
-        # 0b1100 == 12
-        self.command = self.command | 12
-        if wings == 'high':
-            # 0b0100
-            self.command -= 8
-        elif wings == 'low':
-            # 0b1000
-            self.command -= 4
+        with self.statelock:
+            Capabilities.wings(self, wings)
 
     def setcolour(self, colour):
-        # method to set the colour of the head LED
-        # colour profile: {'r', 'g', 'b'}
-        # first reset the status explicitely to
-        # "no colour"
-        # 0b1110000 == 112
-        self.command = self.command | 112
-        if colour['red']:
-            self.command -= 16
-        if colour['green']:
-            self.command -= 32
-        if colour['blue']:
-            self.command -= 64
-
-    def createmsg(self):
-        msgbytes = messagebytes + [self.command]
-        msg = bytes(msgbytes)
-        return msg
+        with self.statelock:
+            Capabilities.setcolour(self, colour)
+
+    def setbits(self, mask, bits, pos=None):
+        # replace the bits in 'mask' by 'bits' and, if given, set the
+        # position of the motor. This is what the tokens of the macro
+        # language that set capabilities do (see compilecommand()).
+        with self.statelock:
+            self.command = (self.command & ~mask) | bits
+            if pos is not None:
+                self.pos = pos
+
+    @property
+    def state(self):
+        # the state that will be sent with the next command
+        return buddystates[self.command]
+
+    def setstate(self, state):
+        # set all capabilities at once from a BuddyState
+        with self.statelock:
+            self.command = state.state
+            self.pos = state.position
+
+    def createmsg(self, command=None):
+        if command is None:
+            command = self.command
+        return statemsgs[command]
+
+    def ctrltransfer(self, msg):
+        # send a single message to the device, without any recovery
+        if self.dev is None:
+            if self.closed:
+                raise usb.core.USBError('iBuddy closed', errno=errno.EBADF)
+            if not self.released:
+                raise usb.core.USBError('iBuddy not connected', errno=errno.ENODEV)
+            if not self.reacquire():
+                raise usb.core.USBError('iBuddy in use', errno=errno.EBUSY)
+        if self.metrics is None and self.tracer is None:
+            return self.dev.ctrl_transfer(0x21, 0x09, 2, 1, msg)
+        start = time.perf_counter()
+        try:
+            result = self.dev.ctrl_transfer(0x21, 0x09, 2, 1, msg)
+        except usb.core.USBError:
+            if self.metrics is not None:
+                self.metrics.inc('usb_errors_total')
+            if self.tracer is not None:
+                self.tracer.span('ctrl_transfer', 'usb', start, time.perf_counter(), {'error': True})
+            raise
+        end = time.perf_counter()
+        if self.metrics is not None:
+            self.metrics.inc('transfers_total')
+            self.metrics.observe('transfer_seconds', end - start)
+        if self.tracer is not None:
+            self.tracer.span('ctrl_transfer', 'usb', start, end)
+        return result
+
+    def transfer(self, msg):
+        # send a single message to the device. If this fails the error
+        # is classified and the transfer is retried (with backoff) a
+        # limited amount of times. If the device has disappeared, or if
+        # retrying alone does not help, the device is searched for again.
+        attempt = 0
+        while True:
+            try:
+                result = self.ctrltransfer(msg)
+                break
+            except usb.core.USBError as e:
+                errorclass = classifyerror(e)
+                self.transportstats['errors'] += 1
+                self.transportstats['errors_%s' % errorclass] += 1
+                if errorclass == 'fatal' or attempt >= self.retries:
+                    raise
+                time.sleep(self.backoff * (2 ** attempt))
+                attempt += 1
+                self.transportstats['retries'] += 1
+                if errorclass == 'disconnected' or attempt > 1:
+                    self.reconnect()
+        if self.idlerelease:
+            self.lastused = time.monotonic()
+        if msg is not setupmsg:
+            self.laststate = msg[-1]
+            self.lastmotor = msg[-1] & MOTORMASK
+            self.pose = posetransitions[(self.pose, self.lastmotor)][0]
+            if self.recorder is not None:
+                self.recorder.record(msg[-1])
+            if self.statepage is not None:
+                self.publishstate(state=msg[-1])
+        return result
+
+    def publishstate(self, **fields):
+        # update fields of the state page. The state page is only for
+        # monitoring, so if it cannot be written frames are still sent
+        # and commands still played (only the first error is reported).
+        try:
+            self.statepage.publish(**fields)
+        except Exception as e:
+            if not self.statepageerrors:
+                print(f"Cannot publish state page: {e}", file=sys.stderr)
+            self.statepageerrors += 1
+
+    def transmit(self, command):
+        # send a state byte to the device
+        tracer = self.tracer
+        if tracer is not None:
+            start = tracer.now()
+        with self.transmitlock:
+            # let the governor decide what can actually be sent
+            if self.governor is not None:
+                command = self.governor.filter(command)
+            self.pace()
+            self.transfer(setupmsg)
+            self.transfer(self.createmsg(command))
+        if tracer is not None:
+            tracer.span('send', 'send', start, tracer.now(), {'state': command})
+
+    def pace(self):
+        # do not send frames faster than the device accepts them
+        # (see minframeinterval), called with transmitlock held
+        if self.minframeinterval:
+            wait = self.lastframe + self.minframeinterval - time.perf_counter()
+            if wait > 0:
+                self.wait(wait, cancellable=False)
+            self.lastframe = time.perf_counter()
 
     def sendcommand(self):
-        msg = self.createmsg()
-        self.dev.ctrl_transfer(0x21, 0x09, 2, 1, setupmsg)
-        self.dev.ctrl_transfer(0x21, 0x09, 2, 1, msg)
+        # a command that moves the motor to the middle only works from
+        # some poses, so first get there if needed (unless the motor was
+        # already sent to the middle)
+        command = self.command
+        if command & MOTORMASK == 0 and self.planmotion and self.lastmotor != 0:
+            plan = motionplans[(self.pose, 0)]
+            if len(plan) > 1:
+                self.approach(command, plan)
+        self.transmit(command)
+
+    def approach(self, command, plan):
+        # send all but the last step of a motion plan, with
+        # the other capabilities as they are in 'command'
+        for (bits, delay) in plan[:-1]:
+            self.transmit((command & ~MOTORMASK) | bits)
+            self.wait(delay)
+
+    def sendstate(self, state):
+        # send a complete state byte to the device, for example from a
+        # recording, and update the bookkeeping to reflect this state
+        with self.statelock:
+            self.command = state
+            self.pos = motorpositions[state & MOTORMASK]
+        self.transmit(state)
+
+    def frame(self):
+        # start a new frame, see Frame
+        return Frame(self)
+
+    def commit(self, command, pos, changed=0xff):
+        # commit the bits in 'changed' of a frame and send the result.
+        # If another thread is already sending, that thread will send
+        # this state as well once it is done (only the latest state is
+        # sent), so threads never wait for each other's USB transfers.
+        # If sending fails the error is raised in the thread that was
+        # sending and the state stays pending, so it is sent by the next
+        # commit (or flush()) instead of being lost.
+        with self.statelock:
+            self.command = (self.command & ~changed) | (command & changed)
+            if changed & MOTORMASK:
+                self.pos = pos
+            self.pending = True
+            if self.transmitting:
+                return
+            self.transmitting = True
+        try:
+            while True:
+                with self.statelock:
+                    if not self.pending:
+                        self.transmitting = False
+                        return
+                    command = self.command
+                    self.pending = False
+                self.transmit(command)
+        except:
+            with self.statelock:
+                self.pending = True
+                self.transmitting = False
+            raise
 
-    def executecommand(self, cmd):
+    def flush(self):
+        # send the state of frames that were committed, but could
+        # not be sent (see commit())
+        if self.pending:
+            self.commit(0, None, 0)
+
+    def wait(self, seconds, cancellable=True):
+        # wait, but wake up immediately if the playback that is
+        # active in this thread is cancelled (unless 'cancellable' is
+        # not set, for waits while sending). The last part of the wait
+        # is spent spinning (yielding to other threads) instead of
+        # sleeping, so the wait does not take longer than needed.
+        deadline = time.perf_counter() + seconds
+        playback = None
+        if cancellable:
+            playback = getattr(self.local, 'playback', None)
+        coarse = seconds - self.spin
+        if coarse > 0:
+            if playback is None:
+                time.sleep(coarse)
+            elif playback.cancelled.wait(coarse):
+                raise Cancelled()
+        while time.perf_counter() < deadline:
+            time.sleep(0)
+        if playback is not None and playback.cancelled.is_set():
+            raise Cancelled()
+
+    def sleep(self, seconds):
+        # sleep, but if a governor is used wake up in time to switch
+        # off actuators that would otherwise exceed their budget while
+        # the device is holding its current state
+        if self.metrics is not None:
+            self.metrics.inc('sleep_seconds_total', seconds)
+        if self.tracer is not None:
+            start = self.tracer.now()
+            try:
+                self.governedsleep(seconds)
+            finally:
+                self.tracer.span('sleep', 'sleep', start, self.tracer.now(), {'seconds': seconds})
+            return
+        self.governedsleep(seconds)
+
+    def governedsleep(self, seconds):
+        if self.governor is None:
+            self.wait(seconds)
+            return
+        deadline = time.monotonic() + seconds
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            limit = self.governor.holdlimit()
+            if limit is None or limit >= remaining:
+                self.wait(remaining)
+                break
+            self.wait(limit)
+            # resend the state that was last sent, the governor will
+            # switch off the offending actuators. Not the command, as
+            # that might contain changes that were not sent yet (GO).
+            self.transmit(self.governor.state)
+
+    def macrosleep(self, seconds):
+        # a sleep in a command, at the tempo of the command
+        self.sleep(seconds / self.local.tempo)
+
+    def executecommand(self, cmd, playback=None):
         # the original version of pybuddy had a macro-like language:
         # https://github.com/ewall/pybuddy/blob/master/src/pybuddy-daemon.py#L170
         #
@@ -294,10 +1464,12 @@ class iBuddy:
         # * WINGSLOW
         #
         # For sleep:
+        # * ULTRASHORTSLEEP
         # * SHORTSLEEP
         # * SLEEP
         # * LONGSLEEP
         # * GLACIAL
+        # * a duration in milliseconds, for example 250MS or 12.5MS
         #
         # To execute a command:
         # * GO
@@ -305,58 +1477,127 @@ class iBuddy:
         # To reset:
         # * RESET
         #
-        # First store a list of commands
-        msgs = cmd.split(':')
+        # A Playback can be passed to be able to cancel the command from
+        # another thread. A cancelled command stops immediately (also in
+        # the middle of a sleep) and the iBuddy is reset.
+        #
+        # Sleeps are played at the tempo of the playback, or the
+        # tempo of the iBuddy.
+        #
+        # Returns True if the command was executed completely.
+        #
+        # First compile the command. If it does not make sense, return.
+        tokens = compilecommand(cmd)
+        if tokens is None:
+            print(cmd.split(':'))
+            if playback is not None:
+                playback.invalid = True
+            if self.metrics is not None:
+                self.metrics.inc('invalid_commands_total')
+            return False
+        if self.metrics is not None:
+            start = time.monotonic()
+        self.local.playback = playback
+        if playback is not None and playback.tempo is not None:
+            self.local.tempo = playback.tempo
+        else:
+            self.local.tempo = self.tempo
+        tracer = self.tracer
+        try:
+            if tracer is None:
+                for (name, method, args) in tokens:
+                    method(self, *args)
+                    if playback is not None and playback.cancelled.is_set():
+                        raise Cancelled()
+            else:
+                # when tracing every token of the command is run on its
+                # own, so there is a span for every token of the macro
+                commandstart = tracer.now()
+                for (name, method, args) in compiletokens(cmd):
+                    tokenstart = tracer.now()
+                    method(self, *args)
+                    tracer.span(name, 'token', tokenstart, tracer.now())
+                    if playback is not None and playback.cancelled.is_set():
+                        raise Cancelled()
+                tracer.span('command', 'command', commandstart, tracer.now(),
+                            {'command': cmd})
+        except Cancelled:
+            # bring the device to a defined state
+            self.reset()
+            return False
+        finally:
+            self.local.playback = None
+        if self.metrics is not None:
+            self.metrics.inc('commands_total')
+            self.metrics.inc('tokens_total', cmd.count(':') + 1)
+            self.metrics.observe('command_seconds', time.monotonic() - start)
+        return True
 
-        # check if the list of commands actually makes sense
-        # if not, return. Empty commands are allowed.
-        if list(filter(lambda x: x not in validcmds and x != '', msgs)):
-            print(msgs)
-            return
-        for i in msgs:
-            if i == 'HEART':
-                self.toggleheart(True)
-            elif i == 'NOHEART':
-                self.toggleheart(False)
-            elif i == 'NOCOLOUR':
-                self.setcolour(NOCOLOUR)
-            elif i == 'RED':
-                self.setcolour(RED)
-            elif i == 'BLUE':
-                self.setcolour(BLUE)
-            elif i == 'GREEN':
-                self.setcolour(GREEN)
-            elif i == 'CYAN':
-                self.setcolour(CYAN)
-            elif i == 'YELLOW':
-                self.setcolour(YELLOW)
-            elif i == 'PURPLE':
-                self.setcolour(PURPLE)
-            elif i == 'WHITE':
-                self.setcolour(WHITE)
-            elif i == 'LEFT':
-                self.wiggle('left')
-            elif i == 'RIGHT':
-                self.wiggle('right')
-            elif i == 'MIDDLE':
-                self.wiggle('middle')
-            elif i == 'MIDDLE2':
-                self.wiggle('middlereset')
-            elif i == 'WINGSHIGH':
-                self.wings('high')
-            elif i == 'WINGSLOW':
-                self.wings('low')
-            elif i == 'GO':
-                self.sendcommand()
-            elif i == 'RESET':
-                self.reset()
-            elif i == 'ULTRASHORTSLEEP':
-                time.sleep(ULTRASHORTSLEEP)
-            elif i == 'SHORTSLEEP':
-                time.sleep(SHORTSLEEP)
-            elif i == 'SLEEP':
-                time.sleep(SLEEP)
-            elif i == 'LONGSLEEP':
-                time.sleep(LONGSLEEP)
-            elif i == 'GLACIAL':
-                time.sleep(GLACIAL)
+
+# The tokens of the macro language, with the method of the iBuddy to call
+# and the arguments for it. Tokens that set capabilities only replace some
+# bits of the state (and the position of the motor), see iBuddy.setbits().
+macrotokens = {
+    'HEART': (iBuddy.setbits, (HEARTMASK, 0, None)),
+    'NOHEART': (iBuddy.setbits, (HEARTMASK, HEARTMASK, None)),
+    'LEFT': (iBuddy.setbits, (MOTORMASK, motorbits['left'], 'left')),
+    'RIGHT': (iBuddy.setbits, (MOTORMASK, motorbits['right'], 'right')),
+    'MIDDLE': (iBuddy.setbits, (MOTORMASK, motorbits['middle'], 'middle')),
+    'MIDDLE2': (iBuddy.setbits, (MOTORMASK, motorbits['middlereset'], 'middlereset')),
+    'WINGSHIGH': (iBuddy.setbits, (WINGSMASK, wingsbits['high'], None)),
+    'WINGSLOW': (iBuddy.setbits, (WINGSMASK, wingsbits['low'], None)),
+    'GO': (iBuddy.sendcommand, ()),
+    'RESET': (iBuddy.reset, ()),
+    'ULTRASHORTSLEEP': (iBuddy.macrosleep, (ULTRASHORTSLEEP,)),
+    'SHORTSLEEP': (iBuddy.macrosleep, (SHORTSLEEP,)),
+    'SLEEP': (iBuddy.macrosleep, (SLEEP,)),
+    'LONGSLEEP': (iBuddy.macrosleep, (LONGSLEEP,)),
+    'GLACIAL': (iBuddy.macrosleep, (GLACIAL,)),
+}
+macrotokens.update({colour.name: (iBuddy.setbits, (HEADMASK, colour.bits, None))
+                    for colour in allcolours})
+
+
+@functools.lru_cache(maxsize=256)
+def compiletokens(cmd):
+    # compile a command in the macro language into a tuple of
+    # (token, method, arguments), one for every token of the command,
+    # or None if the command is not valid. Empty tokens are skipped.
+    tokens = []
+    for i in cmd.split(':'):
+        if not i:
+            continue
+        if i in macrotokens:
+            (method, args) = macrotokens[i]
+        else:
+            seconds = sleepliteral(i)
+            if seconds is None:
+                return None
+            (method, args) = (iBuddy.macrosleep, (seconds,))
+        tokens.append((i, method, args))
+    return tuple(tokens)
+
+
+@functools.lru_cache(maxsize=256)
+def compilecommand(cmd):
+    # compile a command like compiletokens(), but merge consecutive
+    # sleeps into a single sleep and consecutive tokens that set
+    # capabilities into a single change of the state, so the state is
+    # only locked once. Commands are cached, as the same commands tend
+    # to be sent over and over again.
+    compiled = compiletokens(cmd)
+    if compiled is None:
+        return None
+    tokens = []
+    for (i, method, args) in compiled:
+        if method is iBuddy.macrosleep and tokens and tokens[-1][1] is iBuddy.macrosleep:
+            (name, method, previous) = tokens[-1]
+            tokens[-1] = (name + ':' + i, method, (previous[0] + args[0],))
+            continue
+        if method is iBuddy.setbits and tokens and tokens[-1][1] is iBuddy.setbits:
+            (name, method, (mask, bits, pos)) = tokens[-1]
+            tokens[-1] = (name + ':' + i, method,
+                          (mask | args[0], (bits & ~args[0]) | args[1], args[2] or pos))
+            continue
+        tokens.append((i, method, args))
+    return tuple(tokens)
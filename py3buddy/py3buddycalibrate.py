@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+# Calibration of the latency of an iBuddy: how long USB control transfers
+# take (as a distribution) and how many frames per second the device accepts
+# when frames are sent back to back. Revisions of the iBuddy (product ids
+# 0x0001, 0x0002, 0x0004 and 0x0005), but also cables and hubs, differ, so
+# results are stored per product id and place on the bus (for example
+# '0x0001@1-1.2') in a JSON file:
+#
+# $ python3 py3buddycalibrate.py -c py3buddy.config
+#
+# If 'calibration' in the configuration file points to this file, the iBuddy
+# does not send frames faster than the device accepted them, so every state
+# is held at least as long as it takes the device to accept the next frame
+# (see minframeinterval in py3buddy.py). The software PWM (py3buddypwm.py)
+# does not ask for a higher frame rate than that either.
+#
+# During calibration the heart LED flickers.
+#
+# Copyright 2017-2019 - Armijn Hemel for Tjaldur Software Governance Solutions
+# SPDX-Identifier: MIT
+
+import sys
+import os
+import argparse
+import configparser
+import json
+import time
+import usb.core
+import py3buddy
+from py3buddyplayer import percentile
+
+# the default file with calibrations
+defaultpath = '~/.cache/py3buddy/calibration.json'
+
+# default amount of frames for the latency distribution,
+# and the time that frames are sent back to back
+defaultframes = 500
+defaultduration = 2.0
+
+# frames that are sent before measuring
+warmupframes = 20
+
+# the fraction of the measured frame rate that is used,
+# to leave some room for hosts that are busy
+margin = 0.9
+
+# the states that are sent: the heart LED is toggled
+calibrationstates = [0x7f, 0xff]
+
+
+def distribution(values):
+    return {'min': min(values), 'p50': percentile(values, 0.5),
+            'p90': percentile(values, 0.9), 'p99': percentile(values, 0.99),
+            'max': max(values)}
+
+
+def calibrate(ibuddy, frames=defaultframes, duration=defaultduration):
+    # measure the device of an iBuddy. Transfers are sent without any
+    # recovery from errors, the governor or limits on the frame rate, so
+    # errors are raised (usb.core.USBError).
+    now = time.perf_counter
+    ctrltransfer = ibuddy.ctrltransfer
+    msgs = [ibuddy.createmsg(state) for state in calibrationstates]
+
+    with ibuddy.transmitlock:
+        for i in range(warmupframes):
+            ctrltransfer(py3buddy.setupmsg)
+            ctrltransfer(msgs[i % 2])
+
+        # the latency of single transfers and of frames
+        # (a setup message and a state)
+        transfers = []
+        frametimes = []
+        for i in range(frames):
+            start = now()
+            ctrltransfer(py3buddy.setupmsg)
+            middle = now()
+            ctrltransfer(msgs[i % 2])
+            end = now()
+            transfers.append(middle - start)
+            transfers.append(end - middle)
+            frametimes.append(end - start)
+
+        # frames back to back
+        count = 0
+        start = now()
+        end = start + duration
+        while True:
+            ctrltransfer(py3buddy.setupmsg)
+            ctrltransfer(msgs[count % 2])
+            count += 1
+            current = now()
+            if current >= end:
+                break
+        rate = count / (current - start)
+
+        ctrltransfer(py3buddy.setupmsg)
+        ctrltransfer(ibuddy.createmsg(ibuddy.command))
+
+    # the minimum time between frames: the time needed for most frames,
+    # and no more frames than the device accepted (with some margin)
+    maxrate = rate * margin
+    minframeinterval = max(percentile(frametimes, 0.99), 1 / maxrate)
+    return {'productid': ibuddy.dev.idProduct, 'key': py3buddy.devicekey(ibuddy.dev),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'frames': frames,
+            'transfer': distribution(transfers), 'frame': distribution(frametimes),
+            'rate': rate, 'maxrate': 1 / minframeinterval,
+            'minframeinterval': minframeinterval}
+
+
+def store(path, calibration):
+    # add or replace the calibration of a device in the file
+    calibrations = py3buddy.readcalibrations(path)
+    calibrations[calibration['key']] = calibration
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path + '.tmp', 'w') as calibrationfile:
+        json.dump(calibrations, calibrationfile, indent=4, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+
+    # options for the commandline
+    parser.add_argument("-c", "--config", action="store", dest="cfg",
+                        help="path to configuration file", metavar="FILE")
+    parser.add_argument("-o", "--output", action="store", dest="output",
+                        help="file with calibrations (default from configuration file, or %s)" % defaultpath,
+                        metavar="FILE")
+    parser.add_argument("-n", "--frames", action="store", dest="frames", type=int,
+                        default=defaultframes,
+                        help="frames for the latency distribution (default %d)" % defaultframes)
+    parser.add_argument("-d", "--duration", action="store", dest="duration", type=float,
+                        default=defaultduration,
+                        help="seconds to send frames back to back (default %s)" % defaultduration)
+    args = parser.parse_args()
+
+    # first some sanity checks for the configuration file
+    if args.cfg is None:
+        parser.error("Configuration file missing")
+
+    if not os.path.exists(args.cfg):
+        parser.error("Configuration file does not exist")
+
+    if args.frames < 1 or args.duration <= 0:
+        parser.error("Frames and duration should be positive")
+
+    # then parse the configuration file
+    config = configparser.ConfigParser()
+
+    configfile = open(args.cfg, 'r')
+
+    try:
+        config.read_file(configfile)
+    except Exception as e:
+        print(f"Cannot read configuration file: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    # only what is needed to find the device: the calibration is
+    # done without the governor and without limits on the frame rate
+    buddy_config = {}
+    calibrationpath = defaultpath
+    for section in config.sections():
+        if section == 'ibuddy':
+            settings = py3buddy.parseconfig(config, section)
+            for name in ['productid', 'transport']:
+                if name in settings:
+                    buddy_config[name] = settings[name]
+            calibrationpath = settings.get('calibration', calibrationpath)
+
+    if args.output is not None:
+        calibrationpath = args.output
+    calibrationpath = os.path.expanduser(calibrationpath)
+
+    if buddy_config.get('transport', 'pyusb') not in ['pyusb', 'usbfs']:
+        print("Unknown transport, should be pyusb or usbfs", file=sys.stderr)
+        sys.exit(1)
+
+    # initialize an iBuddy and check if a device was found and is accessible
+    try:
+        ibuddy = py3buddy.iBuddy(buddy_config)
+    except ValueError as e:
+        print(f"Cannot use iBuddy: {e}", file=sys.stderr)
+        sys.exit(1)
+    if ibuddy.dev is None:
+        print("No iBuddy found, or iBuddy not accessible", file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        calibration = calibrate(ibuddy, args.frames, args.duration)
+    except usb.core.USBError as e:
+        print(f"Error during calibration: {e}", file=sys.stderr)
+        ibuddy.close()
+        sys.exit(1)
+    ibuddy.reset(force=True)
+    ibuddy.close()
+
+    print("device: %s\n" % calibration['key'])
+    for name in ['transfer', 'frame']:
+        latencies = calibration[name]
+        print("%-9s min %8.3f ms  p50 %8.3f ms  p90 %8.3f ms  p99 %8.3f ms  max %8.3f ms" % (
+            name, latencies['min'] * 1000, latencies['p50'] * 1000, latencies['p90'] * 1000,
+            latencies['p99'] * 1000, latencies['max'] * 1000))
+    print("\nframes back to back: %.1f frames/s" % calibration['rate'])
+    print("maximum frame rate:  %.1f frames/s (minimum hold time %.3f ms)" % (
+        calibration['maxrate'], calibration['minframeinterval'] * 1000))
+
+    try:
+        store(calibrationpath, calibration)
+    except OSError as e:
+        print(f"Cannot write calibration: {e}", file=sys.stderr)
+        sys.exit(1)
+    print("\nwritten to %s" % calibrationpath)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+# A compositor to let several effects share the iBuddy at the same time.
+#
+# Every layer has a priority and owns some of the capabilities (channels)
+# of the device: 'heart', 'head', 'wings' and 'motor' (see actuatormasks in
+# py3buddy.py). A layer either shows a single state, or plays an animation
+# (see py3buddyeffects.py) on its own timeline, once or looping.
+#
+# Every tick the layers are merged into a single state byte: layers with a
+# higher priority are put on top of layers with a lower priority, but only
+# for the channels they own. For example a background colour for the head
+# LED (priority 0, channel 'head') stays visible while an alert flaps the
+# wings (priority 10, channel 'wings'), and comes back after an alert that
+# also uses the head LED has finished. The state is only sent to the device
+# if it changed.
+#
+# Copyright 2017-2019 - Armijn Hemel for Tjaldur Software Governance Solutions
+# SPDX-Identifier: MIT
+
+import bisect
+import threading
+import time
+import py3buddy
+
+# default time between ticks, in seconds
+defaulttick = 0.02
+
+
+class Layer:
+    def __init__(self, name, priority, channels, animation=None, state=0xff,
+                 loop=False):
+        self.name = name
+        self.priority = priority
+        self.mask = 0
+        for channel in channels:
+            self.mask |= py3buddy.actuatormasks[channel]
+        self.state = state
+        self.loop = loop
+        self.setanimation(animation)
+
+    def setanimation(self, animation, start=None):
+        # (re)start the timeline of the layer with a new animation
+        self.animation = animation
+        if start is None:
+            start = time.monotonic()
+        self.start = start
+        self.ends = []
+        if animation is not None:
+            # the end time of every frame, relative to the start,
+            # to quickly find the frame to show
+            (states, frameduration) = animation
+            end = 0.0
+            for duration in frameduration:
+                end += duration
+                self.ends.append(end)
+
+    def setstate(self, state):
+        # show a single state, for example a status colour
+        self.animation = None
+        self.state = state
+
+    def stateat(self, now):
+        # the state of the layer at time 'now', or None if
+        # the animation of the layer has finished
+        if self.animation is None:
+            return self.state
+        if not self.ends:
+            return None
+        elapsed = now - self.start
+        total = self.ends[-1]
+        if elapsed >= total:
+            if not self.loop or total <= 0:
+                return None
+            elapsed = elapsed % total
+        return self.animation[0][bisect.bisect_right(self.ends, elapsed)]
+
+
+class Compositor:
+    def __init__(self, ibuddy, tick=defaulttick):
+        self.ibuddy = ibuddy
+        self.tick = tick
+        self.layers = {}
+        self.lock = threading.Lock()
+        self.laststate = None
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def addlayer(self, layer):
+        # add a layer, replacing a layer with the same name
+        with self.lock:
+            self.layers[layer.name] = layer
+
+    def removelayer(self, name):
+        with self.lock:
+            if name in self.layers:
+                del self.layers[name]
+
+    def compose(self, now):
+        # merge all layers into a single state byte,
+        # removing layers that have finished
+        state = 0xff
+        with self.lock:
+            layers = sorted(self.layers.values(), key=lambda l: l.priority)
+            for layer in layers:
+                layerstate = layer.stateat(now)
+                if layerstate is None:
+                    del self.layers[layer.name]
+                    continue
+                state = (state & ~layer.mask) | (layerstate & layer.mask)
+        return state
+
+    def update(self):
+        # compose the state and send it, but only if it changed
+        state = self.compose(time.monotonic())
+        if state != self.laststate:
+            self.ibuddy.commit(state, py3buddy.motorpositions[state & py3buddy.MOTORMASK])
+            self.laststate = state
+        return state
+
+    def run(self):
+        # update every tick until stopped. Ticks are scheduled relative
+        # to the start, so the time spent sending does not add up.
+        start = time.monotonic()
+        ticks = 0
+        while not self.stopped.is_set():
+            self.update()
+            ticks += 1
+            wait = start + ticks * self.tick - time.monotonic()
+            if wait > 0:
+                self.stopped.wait(wait)
+
+    def start(self):
+        # run the compositor in a separate thread
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
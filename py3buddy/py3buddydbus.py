@@ -5,17 +5,39 @@
 #
 # Uses python3-gobject-base and python3-pydbus (package names from Fedora)
 #
+# The service can be started on demand by DBus (or systemd) when a program
+# calls it, see etc/dbus-1/services/ and etc/systemd/user/, and exit when
+# it has been idle for a while (see the [service] section in
+# py3buddy.config). To keep the time from starting to the first frame low,
+# the service keeps a small state file with the product id and location of
+# the device (so it does not have to search all product ids) and the
+# commands that were used recently (which are compiled before the service
+# is published). Optional modules are only imported when they are enabled.
+#
 # Copyright 2017-2019 - Armijn Hemel for Tjaldur Software Governance Solutions
 # SPDX-Identifier: MIT
 
 import sys
 import os
 import argparse
+import collections
 import configparser
+import functools
+import json
+import signal
+import time
 import py3buddy
+import py3buddyplayer
 import pydbus
 import gi
 
+# the amount of recently used commands that are remembered
+# in the state file, to compile them when starting
+recentcommands = 64
+
+# the default state file
+defaultstatefile = '~/.cache/py3buddy/py3buddydbus.json'
+
 
 # wrap an iBuddy inside a DBus service
 class IBuddyDbusService(object):
@@ -25,24 +47,193 @@ class IBuddyDbusService(object):
     <method name='ExecuteBuddyCommand'>
     <arg type='s' name='command' direction='in'/>
     </method>
+    <method name='ExecuteBuddyCommandWithPriority'>
+    <arg type='s' name='command' direction='in'/>
+    <arg type='i' name='priority' direction='in'/>
+    </method>
+    <method name='ExecuteBuddyCommandWithTempo'>
+    <arg type='s' name='command' direction='in'/>
+    <arg type='i' name='priority' direction='in'/>
+    <arg type='d' name='tempo' direction='in'/>
+    </method>
+    <method name='Stop'/>
+    <method name='GetTrace'>
+    <arg type='s' name='trace' direction='out'/>
+    </method>
+    <method name='GetClientStats'>
+    <arg type='s' name='stats' direction='out'/>
+    </method>
     <method name='Quit'/>
     </interface>
     </node>
         """
 
-    # make sure the iBuddy is available for the commands
-    def __init__(self, ibuddy, loop):
+    # make sure the iBuddy is available for the commands. Commands
+    # are queued and played by a separate thread, so callers do not
+    # need to wait until a command has finished.
+    #
+    # Callers are identified by their unique name on the bus, which is
+    # mapped to the name of the program (the script for Python programs),
+    # so weights and quotas can be configured per program and a program
+    # that connects again is still the same client. Commands of different
+    # clients are scheduled fairly (see py3buddyplayer.py).
+    def __init__(self, ibuddy, loop, bus=None, clients=None,
+                 defaultweight=1.0, defaultquota=0):
         self.ibuddy = ibuddy
         self.loop = loop
+        self.bus = bus
+        self.player = py3buddyplayer.Player(ibuddy, clients=clients,
+                                            defaultweight=defaultweight,
+                                            defaultquota=defaultquota)
+        self.player.start()
+
+        # names of clients per unique name, forgotten
+        # when the client disconnects from the bus
+        self.clientnames = {}
+        if bus is not None:
+            bus.dbus.NameOwnerChanged.connect(self.nameownerchanged)
+
+        # commands that were used recently, most recent last
+        self.recent = collections.OrderedDict()
+
+        # the last time the service was used
+        self.lastactivity = time.monotonic()
+
+    def idle(self, timeout):
+        # check if the service was not called and did not
+        # play anything for 'timeout' seconds
+        now = time.monotonic()
+        with self.player.condition:
+            if self.player.queue or self.player.current is not None:
+                self.lastactivity = now
+        return now - self.lastactivity >= timeout
+
+    def nameownerchanged(self, name, oldowner, newowner):
+        if not newowner:
+            self.clientnames.pop(name, None)
+
+    def clientname(self, dbus_context):
+        # the name of the program that made a call, or its unique
+        # name if the program cannot be found (or no bus is known)
+        if dbus_context is None:
+            return None
+        sender = dbus_context.sender
+        name = self.clientnames.get(sender)
+        if name is not None:
+            return name
+        name = sender
+        if self.bus is not None:
+            try:
+                name = programname(self.bus.dbus.GetConnectionUnixProcessID(sender)) or sender
+            except Exception:
+                pass
+        if len(self.clientnames) >= py3buddyplayer.maxclients:
+            self.clientnames = {}
+        self.clientnames[sender] = name
+        return name
+
+    def submit(self, method, command, priority=0, tempo=None, dbus_context=None):
+        self.lastactivity = time.monotonic()
+        self.recent[command] = True
+        self.recent.move_to_end(command)
+        if len(self.recent) > recentcommands:
+            self.recent.popitem(last=False)
+        client = self.clientname(dbus_context)
+        tracer = self.ibuddy.tracer
+        if tracer is None:
+            self.player.submit(command, priority, tempo, client)
+            return
+        start = tracer.now()
+        self.player.submit(command, priority, tempo, client)
+        tracer.span(method, 'dbus', start, tracer.now(),
+                    {'priority': priority, 'tempo': tempo, 'client': client})
+
+    def ExecuteBuddyCommand(self, command, dbus_context=None):
+        self.submit('ExecuteBuddyCommand', command, dbus_context=dbus_context)
+
+    # a command with a higher priority preempts the
+    # command that is playing (default priority is 0)
+    def ExecuteBuddyCommandWithPriority(self, command, priority, dbus_context=None):
+        self.submit('ExecuteBuddyCommandWithPriority', command, priority,
+                    dbus_context=dbus_context)
+
+    # a command with a priority and a tempo for its
+    # sleeps (2.0 plays twice as fast)
+    def ExecuteBuddyCommandWithTempo(self, command, priority, tempo, dbus_context=None):
+        # the tempo of the service is used for tempos that are not
+        # larger than 0 (including NaN), which cannot be played
+        if not tempo > 0:
+            tempo = None
+        self.submit('ExecuteBuddyCommandWithTempo', command, priority, tempo,
+                    dbus_context=dbus_context)
+
+    # stop the command that is playing, drop all
+    # queued commands and reset the iBuddy
+    def Stop(self):
+        self.player.stop()
 
-    def ExecuteBuddyCommand(self, command):
-        self.ibuddy.executecommand(command)
-        self.ibuddy.reset()
+    # the last spans of the trace as JSON lines, if tracing
+    # to memory is enabled (empty otherwise)
+    def GetTrace(self):
+        tracer = self.ibuddy.tracer
+        # only the ring buffer sink keeps spans that can be dumped
+        if tracer is None or not hasattr(tracer.sink, 'dump'):
+            return ''
+        return tracer.sink.dump()
+
+    # the statistics per client (commands submitted, rejected,
+    # completed, cancelled and failed, and latencies) as JSON
+    def GetClientStats(self):
+        return json.dumps(self.player.clientstats(), sort_keys=True)
 
     def Quit(self):
+        self.player.shutdown()
         self.loop.quit()
 
 
+def programname(pid):
+    # the name of a program from its command line: the script
+    # for interpreters (such as python3 py3buddypidgin.py)
+    try:
+        with open('/proc/%d/cmdline' % pid, 'rb') as cmdlinefile:
+            cmdline = cmdlinefile.read().split(b'\0')
+    except OSError:
+        return None
+    if not cmdline[0]:
+        return None
+    program = os.path.basename(cmdline[0].decode('utf-8', 'replace'))
+    if program.startswith('python') or program in ['perl', 'ruby', 'node', 'sh', 'bash']:
+        for argument in cmdline[1:]:
+            if argument and not argument.startswith(b'-'):
+                return os.path.basename(argument.decode('utf-8', 'replace'))
+    return program
+
+
+def readstate(path):
+    # the state that was saved when the service exited, or
+    # an empty state if there is none (or it cannot be read)
+    try:
+        with open(path, 'r') as statefile:
+            state = json.load(statefile)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(state, dict):
+        return {}
+    return state
+
+
+def writestate(path, state):
+    # write the state to a new file first, so a service that
+    # is started at the same time never reads half a state
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'w') as statefile:
+            json.dump(state, statefile)
+        os.replace(path + '.tmp', path)
+    except OSError as e:
+        print(f"Cannot write state file: {e}", file=sys.stderr)
+
+
 def main(argv):
     parser = argparse.ArgumentParser()
 
@@ -71,39 +262,234 @@ def main(argv):
         sys.exit(1)
 
     buddy_config = {}
+    metrics_config = {'enabled': False, 'port': 9101, 'address': '127.0.0.1'}
+    statepage_config = {'enabled': False, 'path': None}
+    trace_config = {'enabled': False, 'sink': 'ring', 'path': None,
+                    'size': None}
+    service_config = {'idle_timeout': 0, 'state': defaultstatefile}
+    scheduler_config = {'weight': 1.0, 'quota': 0}
+    clients_config = {}
     for section in config.sections():
         if section == 'ibuddy':
+            buddy_config = py3buddy.parseconfig(config, section)
+
+        if section == 'metrics':
             try:
-                productid = int(config.get(section, 'productid'))
-                buddy_config['productid'] = productid
+                metrics_val = config.get(section, 'enabled')
+                if metrics_val == 'yes':
+                    metrics_config['enabled'] = True
+            except:
+                pass
+            try:
+                metrics_config['port'] = int(config.get(section, 'port'))
             except:
                 pass
-
-            buddy_config['reset_position'] = False
             try:
-                reset_position_val = config.get(section, 'reset_position')
-                if reset_position_val == 'yes':
-                    buddy_config['reset_position'] = True
+                metrics_config['address'] = config.get(section, 'address')
+            except:
+                pass
+        if section == 'statepage':
+            try:
+                statepage_val = config.get(section, 'enabled')
+                if statepage_val == 'yes':
+                    statepage_config['enabled'] = True
+            except:
+                pass
+            try:
+                statepage_config['path'] = config.get(section, 'path')
+            except:
+                pass
+        if section == 'trace':
+            try:
+                trace_val = config.get(section, 'enabled')
+                if trace_val == 'yes':
+                    trace_config['enabled'] = True
+            except:
+                pass
+            try:
+                trace_config['sink'] = config.get(section, 'sink')
+            except:
+                pass
+            try:
+                trace_config['path'] = config.get(section, 'path')
+            except:
+                pass
+            try:
+                trace_config['size'] = int(config.get(section, 'size'))
+            except:
+                pass
+        if section == 'scheduler':
+            try:
+                scheduler_config['weight'] = float(config.get(section, 'default_weight'))
+            except:
+                pass
+            try:
+                scheduler_config['quota'] = int(config.get(section, 'default_quota'))
+            except:
+                pass
+        # weights and quotas per program, in sections
+        # such as [client py3buddyearthquakedbus.py]
+        if section.startswith('client '):
+            client = section[7:].strip()
+            clients_config[client] = {}
+            try:
+                clients_config[client]['weight'] = float(config.get(section, 'weight'))
+            except:
+                pass
+            try:
+                clients_config[client]['quota'] = int(config.get(section, 'quota'))
+            except:
+                pass
+        if section == 'service':
+            try:
+                service_config['idle_timeout'] = int(config.get(section, 'idle_timeout'))
+            except:
+                pass
+            try:
+                service_config['state'] = config.get(section, 'state')
             except:
                 pass
         if section == 'twitter':
             pass
 
-    # initialize an iBuddy and check if a device was found and is accessible
-    ibuddy = py3buddy.iBuddy(buddy_config)
+    # sanity checks for the trace configuration
+    if trace_config['enabled']:
+        if trace_config['sink'] not in ['ring', 'jsonl', 'chrome']:
+            print("Unknown trace sink, should be ring, jsonl or chrome", file=sys.stderr)
+            sys.exit(1)
+        if trace_config['sink'] != 'ring' and trace_config['path'] is None:
+            print("Trace file missing", file=sys.stderr)
+            sys.exit(1)
+
+    if buddy_config.get('transport', 'pyusb') not in ['pyusb', 'usbfs']:
+        print("Unknown transport, should be pyusb or usbfs", file=sys.stderr)
+        sys.exit(1)
+
+    # weights should be positive, otherwise a client is never scheduled
+    for weight in [scheduler_config['weight']] + [c['weight'] for c in clients_config.values() if 'weight' in c]:
+        if weight <= 0:
+            print("Weights of clients should be positive", file=sys.stderr)
+            sys.exit(1)
+
+    # the state of the previous run: where the device was found and
+    # which commands were used
+    statepath = None
+    state = {}
+    if service_config['state']:
+        statepath = os.path.expanduser(service_config['state'])
+        state = readstate(statepath)
+
+    # initialize an iBuddy and check if a device was found and is
+    # accessible. Look where it was found last time first.
+    ibuddy = None
+    try:
+        cached_config = dict(buddy_config)
+        find = None
+        if 'productid' not in buddy_config and isinstance(state.get('productid'), int):
+            cached_config['productid'] = state['productid']
+        if buddy_config.get('transport') == 'usbfs' and state.get('sysfspath') and py3buddy.py3buddyusbfs is not None:
+            find = functools.partial(py3buddy.py3buddyusbfs.find, sysfspath=state['sysfspath'])
+        if cached_config != buddy_config or find is not None:
+            ibuddy = py3buddy.iBuddy(cached_config, find)
+            if ibuddy.dev is None:
+                ibuddy.close()
+                ibuddy = None
+        if ibuddy is None:
+            ibuddy = py3buddy.iBuddy(buddy_config)
+    except ValueError as e:
+        print(f"Cannot use iBuddy: {e}", file=sys.stderr)
+        sys.exit(1)
     if ibuddy.dev is None:
         print("No iBuddy found, or iBuddy not accessible", file=sys.stderr)
         sys.exit(1)
 
+    # compile the commands that were used last time
+    commands = state.get('commands')
+    if isinstance(commands, list):
+        for command in commands:
+            if isinstance(command, str):
+                py3buddy.compilecommand(command)
+
+    # optionally collect metrics and expose them over HTTP
+    if metrics_config['enabled']:
+        import py3buddymetrics
+        metrics = py3buddymetrics.Metrics()
+        metrics.addcollector(py3buddymetrics.transportcollector(ibuddy))
+        if ibuddy.governor is not None:
+            metrics.addcollector(py3buddymetrics.governorcollector(ibuddy.governor))
+        ibuddy.metrics = metrics
+        try:
+            py3buddymetrics.startserver(metrics, metrics_config['port'],
+                                        metrics_config['address'])
+        except OSError as e:
+            print(f"Cannot start metrics server: {e}", file=sys.stderr)
+            sys.exit(1)
+
+    # optionally trace commands, transfers and DBus calls
+    if trace_config['enabled']:
+        import py3buddytrace
+        if trace_config['sink'] == 'ring':
+            sink = py3buddytrace.RingBufferSink(trace_config['size'] or py3buddytrace.defaultringsize)
+        elif trace_config['sink'] == 'jsonl':
+            sink = py3buddytrace.JsonLinesSink(trace_config['path'])
+        else:
+            sink = py3buddytrace.ChromeTraceSink(trace_config['path'])
+        ibuddy.tracer = py3buddytrace.Tracer(sink)
+
+    # optionally publish the state of the iBuddy in a memory mapped page
+    if statepage_config['enabled']:
+        import py3buddystatepage
+        try:
+            ibuddy.statepage = py3buddystatepage.StatePage(statepage_config['path'] or py3buddystatepage.defaultpath)
+        except OSError as e:
+            print(f"Cannot create state page: {e}", file=sys.stderr)
+            sys.exit(1)
+
     loop = gi.repository.GObject.MainLoop()
     # get a reference to the session DBus and expose the iBuddy on it
     bus = pydbus.SessionBus()
-    bus.publish("nl.tjaldur.IBuddy", IBuddyDbusService(ibuddy, loop))
+    service = IBuddyDbusService(ibuddy, loop, bus, clients_config,
+                                scheduler_config['weight'], scheduler_config['quota'])
+    if metrics_config['enabled']:
+        ibuddy.metrics.addcollector(py3buddymetrics.clientcollector(service.player))
+    registration = bus.publish("nl.tjaldur.IBuddy", service)
+
+    # optionally exit when idle. The name is given up first, so
+    # DBus starts a new service for calls that arrive after that.
+    if service_config['idle_timeout'] > 0:
+        def checkidle():
+            if not service.idle(service_config['idle_timeout']):
+                return True
+            registration.unpublish()
+            service.player.shutdown()
+            loop.quit()
+            return False
+        gi.repository.GLib.timeout_add_seconds(1, checkidle)
+
+    # stop cleanly when systemd (SIGTERM) or the user (SIGINT) asks
+    # for it, so the iBuddy is reset and the trace is closed
+    def terminate():
+        registration.unpublish()
+        service.player.shutdown()
+        loop.quit()
+        return False
+    for signum in [signal.SIGTERM, signal.SIGINT]:
+        gi.repository.GLib.unix_signal_add(gi.repository.GLib.PRIORITY_DEFAULT, signum, terminate)
 
     loop.run()
 
-    # finally reset the i-buddy again
+    # finally reset the i-buddy again and release it
     ibuddy.reset()
+    if statepath is not None:
+        writestate(statepath, {'productid': ibuddy.dev.idProduct if ibuddy.dev is not None else ibuddy.productid,
+                               'sysfspath': getattr(ibuddy.dev, 'sysfspath', None),
+                               'commands': list(service.recent)})
+    ibuddy.close()
+
+    if ibuddy.tracer is not None:
+        ibuddy.tracer.close()
+    if ibuddy.statepage is not None:
+        ibuddy.statepage.close()
 
 if __name__ == "__main__":
     main(sys.argv)
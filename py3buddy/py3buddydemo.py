@@ -7,49 +7,23 @@ import sys
 import os
 import argparse
 import configparser
-import random
 import time
 import py3buddy
+import py3buddyeffects
+import py3buddypwm
 
 
 def panic(ibuddy, paniccount):
-    # a demo version to show some of the capabilities of the iBuddy
+    # a demo version to show some of the capabilities of the iBuddy:
+    # flap the wings, toggle the heart LED, pick random colours for
+    # the head LED and wiggle randomly, every 0.1 seconds
 
     # first reset the iBuddy
     ibuddy.reset()
-    for i in range(0, paniccount):
-        # set the wings to high
-        ibuddy.wings('high')
 
-        # turn on the heart LED
-        ibuddy.toggleheart(True)
+    # generate the whole animation in advance, then play it
+    py3buddyeffects.play(ibuddy, py3buddyeffects.panic(paniccount))
 
-        # pick a random colour for the head LED
-        ibuddy.setcolour(random.choice(py3buddy.allcolours))
-
-        # wiggle randomly
-        ibuddy.wiggle(random.choice(['right', 'left', 'middle', 'middlereset']))
-
-        # create the message, then send it, and sleep for 0.1 seconds
-        ibuddy.sendcommand()
-        time.sleep(0.1)
-
-        # set the wings to low
-        ibuddy.wings('low')
-
-        # turn off the heart LED
-        ibuddy.toggleheart(False)
-
-        # pick a random colour for the head LED
-        ibuddy.setcolour(random.choice(py3buddy.allcolours))
-
-        # random wiggle
-        ibuddy.wiggle(random.choice(['right', 'left', 'middle', 'middlereset']))
-        ibuddy.sendcommand()
-        time.sleep(0.1)
-
-    # extra reset as sometimes the device doesn't respond
-    ibuddy.reset()
     ibuddy.reset()
 
 
@@ -57,49 +31,39 @@ def panic(ibuddy, paniccount):
 # good to train people what colour to pick for the dice
 def colourloop(ibuddy, loopcount):
     ibuddy.reset()
-    for i in range(0, loopcount):
-        for c in py3buddy.allcolours:
-            ibuddy.setcolour(c)
-            ibuddy.sendcommand()
-            time.sleep(1)
-    ibuddy.reset()
+    py3buddyeffects.play(ibuddy, py3buddyeffects.colourloop(loopcount))
     ibuddy.reset()
 
 
 def dice(ibuddy, dicecount):
     # turn iBuddy into an 8 sided dice with colours
     ibuddy.reset()
-    dicecounter = 1
-    chosencolour = None
-    for i in range(0, dicecount):
-        # pick a random colour for the head LED
-        chosencolour = random.choice(py3buddy.allcolours)
-        ibuddy.setcolour(chosencolour)
-        # create the message, then send it, and sleep for 0.1 seconds
-        if dicecounter == dicecount:
-            ibuddy.toggleheart(True)
-        dicecounter += 1
-        ibuddy.sendcommand()
-        time.sleep(0.1)
-    if chosencolour == py3buddy.NOCOLOUR:
-        print("iBuddy chose: no colour!\n")
-    elif chosencolour == py3buddy.RED:
-        print("iBuddy chose: red!\n")
-    elif chosencolour == py3buddy.BLUE:
-        print("iBuddy chose: blue!\n")
-    elif chosencolour == py3buddy.GREEN:
-        print("iBuddy chose: green!\n")
-    elif chosencolour == py3buddy.CYAN:
-        print("iBuddy chose: cyan!\n")
-    elif chosencolour == py3buddy.YELLOW:
-        print("iBuddy chose: yellow!\n")
-    elif chosencolour == py3buddy.PURPLE:
-        print("iBuddy chose: purple!\n")
-    elif chosencolour == py3buddy.WHITE:
-        print("iBuddy chose: white!\n")
+    (animation, chosenvalue) = py3buddyeffects.dice(dicecount)
+    py3buddyeffects.play(ibuddy, animation)
+    chosencolour = py3buddy.colourbyvalue[chosenvalue]
+    print("iBuddy chose: %s!\n" % chosencolour.description)
     time.sleep(5)
-    # extra reset as sometimes the device doesn't respond
     ibuddy.reset()
+
+
+def dimming(ibuddy):
+    # software PWM: a heart that fades in and out, and
+    # colours that the head LED does not have
+    ibuddy.reset()
+    pwm = py3buddypwm.PWM(ibuddy)
+    pwm.start()
+    for i in range(3):
+        for level in list(range(11)) + list(range(10, -1, -1)):
+            pwm.set(heart=level / 10)
+            time.sleep(0.05)
+    for colour in ['ORANGE', 'PINK', 'LIME', 'VIOLET']:
+        print("Showing %s" % colour.lower())
+        pwm.setcolour(colour)
+        time.sleep(2)
+    pwm.stop()
+    stats = pwm.stats()
+    print("Frame rate: %.1f frames/s (requested %d), late frames: %d\n" % (
+        stats['rate'], stats['requested'], stats['late']))
     ibuddy.reset()
 
 
@@ -132,22 +96,18 @@ def main(argv):
     buddy_config = {}
     for section in config.sections():
         if section == 'ibuddy':
-            try:
-                productid = int(config.get(section, 'productid'))
-                buddy_config['productid'] = productid
-            except:
-                pass
-
-            buddy_config['reset_position'] = False
-            try:
-                reset_position_val = config.get(section, 'reset_position')
-                if reset_position_val == 'yes':
-                    buddy_config['reset_position'] = True
-            except:
-                pass
+            buddy_config = py3buddy.parseconfig(config, section)
+
+    if buddy_config.get('transport', 'pyusb') not in ['pyusb', 'usbfs']:
+        print("Unknown transport, should be pyusb or usbfs", file=sys.stderr)
+        sys.exit(1)
 
     # initialize an iBuddy and check if a device was found and is accessible
-    ibuddy = py3buddy.iBuddy(buddy_config)
+    try:
+        ibuddy = py3buddy.iBuddy(buddy_config)
+    except ValueError as e:
+        print(f"Cannot use iBuddy: {e}", file=sys.stderr)
+        sys.exit(1)
     if ibuddy.dev is None:
         print("No iBuddy found, or iBuddy not accessible", file=sys.stderr)
         sys.exit(1)
@@ -172,5 +132,9 @@ def main(argv):
         ibuddy.executecommand(cmd)
     ibuddy.reset()
 
+    print("Demo 5: Dimming and mixing colours\n")
+    dimming(ibuddy)
+    ibuddy.close()
+
 if __name__ == "__main__":
     main(sys.argv)
@@ -1,9 +1,8 @@
 #!/usr/bin/env python3
 
-# Demo program to show how to use the py3buddy module with Twitter
-#
-# Uses python3-twitter (package name on Fedora) from:
-# https://github.com/bear/python-twitter
+# Demo program to show how to use the py3buddy module: shake whenever the
+# earth shakes. Earthquake data comes from a GeoJSON feed (such as the feeds
+# of the USGS) or a local file, see py3buddyfeeds.py.
 #
 # Copyright 2017-2019 - Armijn Hemel for Tjaldur Software Governance Solutions
 # SPDX-Identifier: MIT
@@ -12,53 +11,24 @@ import sys
 import os
 import argparse
 import configparser
-import random
 import time
-import calendar
-import re
+import urllib.error
 import py3buddy
-import twitter
-
-
-def panic(ibuddy, paniccount):
-    # a demo version to show some of the capabilities of
-    # the iBuddy
-
-    # first reset the iBuddy
-    ibuddy.reset()
-
-    for i in range(0, paniccount):
-        # set the wings to high
-        ibuddy.wings('high')
-
-        # turn on the heart LED
-        ibuddy.toggleheart(True)
+import py3buddyeffects
+import py3buddyfeeds
 
-        # pick a random colour for the head LED
-        ibuddy.setcolour(random.choice(py3buddy.allcolours))
+# the default feed: all earthquakes of the past hour
+defaultfeed = 'https://earthquake.usgs.gov/earthquakes/feed/v1.0/summary/all_hour.geojson'
 
-        # wiggle randomly
-        ibuddy.wiggle(random.choice(['right', 'left', 'middle', 'middlereset']))
+# the default time between two polls of the feed, in seconds
+defaultinterval = 60
 
-        # create the message, then send it, and sleep for 0.1 seconds
-        ibuddy.sendcommand()
-        time.sleep(0.1)
 
-        # set the wings to low
-        ibuddy.wings('low')
-
-        # turn off the heart LED
-        ibuddy.toggleheart(False)
-
-        # pick a random colour for the head LED
-        ibuddy.setcolour(random.choice(py3buddy.allcolours))
-
-        # wiggle randomly
-        ibuddy.wiggle(random.choice(['right', 'left', 'middle', 'middlereset']))
-        ibuddy.sendcommand()
-        time.sleep(0.1)
-    # extra reset as sometimes the device doesn't respond
+def panic(ibuddy, paniccount):
+    # wings and heart alternate, with random colours
+    # for the head LED and random wiggling
     ibuddy.reset()
+    py3buddyeffects.play(ibuddy, py3buddyeffects.panic(paniccount))
     ibuddy.reset()
 
 
@@ -68,15 +38,15 @@ def main(argv):
     # options for the commandline
     parser.add_argument("-c", "--config", action="store", dest="cfg",
                         help="path to configuration file", metavar="FILE")
-    parser.add_argument("-k", "--key", action="store", dest="key",
-                        help="consumer key", metavar="KEY")
-    parser.add_argument("-s", "--secret", action="store", dest="secret",
-                        help="consumer secret", metavar="SECRET")
-    parser.add_argument("-t", "--token", action="store", dest="token",
-                        help="access token", metavar="KEY")
-    parser.add_argument("-a", "--accesssecret", action="store",
-                        dest="accesssecret", help="access secret",
-                        metavar="SECRET")
+    parser.add_argument("-u", "--url", action="store", dest="url",
+                        help="URL of GeoJSON feed", metavar="URL")
+    parser.add_argument("-f", "--file", action="store", dest="feedfile",
+                        help="local feed (GeoJSON or text) instead of URL",
+                        metavar="FILE")
+    parser.add_argument("-m", "--min-magnitude", action="store",
+                        dest="minmagnitude", type=float,
+                        help="ignore quakes with a lower magnitude",
+                        metavar="MAGNITUDE")
     args = parser.parse_args()
 
     # first some sanity checks for the configuration file
@@ -86,17 +56,8 @@ def main(argv):
     if not os.path.exists(args.cfg):
         parser.error("Configuration file does not exist")
 
-    if args.key is None:
-        parser.error("Consumer key missing")
-
-    if args.secret is None:
-        parser.error("Consumer secret missing")
-
-    if args.token is None:
-        parser.error("Access token missing")
-
-    if args.accesssecret is None:
-        parser.error("Access secret missing")
+    if args.feedfile is not None and not os.path.exists(args.feedfile):
+        parser.error("Feed file does not exist")
 
     # then parse the configuration file
     config = configparser.ConfigParser()
@@ -110,73 +71,90 @@ def main(argv):
         sys.exit(1)
 
     buddy_config = {}
+    earthquake_config = {'url': defaultfeed, 'file': None,
+                         'min_magnitude': 0.0,
+                         'max_age': py3buddyfeeds.defaultmaxage,
+                         'interval': defaultinterval}
     for section in config.sections():
         if section == 'ibuddy':
+            buddy_config = py3buddy.parseconfig(config, section)
+
+        if section == 'earthquake':
             try:
-                productid = int(config.get(section, 'productid'))
-                buddy_config['productid'] = productid
+                earthquake_config['url'] = config.get(section, 'url')
+            except:
+                pass
+            try:
+                earthquake_config['file'] = config.get(section, 'file')
             except:
                 pass
-
-            buddy_config['reset_position'] = False
             try:
-                reset_position_val = config.get(section, 'reset_position')
-                if reset_position_val == 'yes':
-                    buddy_config['reset_position'] = True
+                earthquake_config['min_magnitude'] = float(config.get(section, 'min_magnitude'))
             except:
                 pass
-        if section == 'twitter':
-            pass
+            try:
+                earthquake_config['max_age'] = int(config.get(section, 'max_age'))
+            except:
+                pass
+            try:
+                earthquake_config['interval'] = int(config.get(section, 'interval'))
+            except:
+                pass
+
+    # the commandline overrides the configuration file
+    if args.url is not None:
+        earthquake_config['url'] = args.url
+        earthquake_config['file'] = None
+    if args.feedfile is not None:
+        earthquake_config['file'] = args.feedfile
+    if args.minmagnitude is not None:
+        earthquake_config['min_magnitude'] = args.minmagnitude
+
+    if buddy_config.get('transport', 'pyusb') not in ['pyusb', 'usbfs']:
+        print("Unknown transport, should be pyusb or usbfs", file=sys.stderr)
+        sys.exit(1)
 
     # initialize an iBuddy and check if a device was found and is accessible
-    ibuddy = py3buddy.iBuddy(buddy_config)
+    try:
+        ibuddy = py3buddy.iBuddy(buddy_config)
+    except ValueError as e:
+        print(f"Cannot use iBuddy: {e}", file=sys.stderr)
+        sys.exit(1)
     if ibuddy.dev is None:
         print("No iBuddy found, or iBuddy not accessible", file=sys.stderr)
         sys.exit(1)
 
-    # create a twitter api endpoint
-    api = twitter.Api(consumer_key=args.key,
-                      consumer_secret=args.secret,
-                      access_token_key=args.token,
-                      access_token_secret=args.accesssecret,
-                      sleep_on_rate_limit=True)
-
-    # set of timestamps to ignore
-    ignorelist = set()
+    # the feed with earthquake data
+    if earthquake_config['file'] is not None:
+        feed = py3buddyfeeds.FileFeed(earthquake_config['file'],
+                                      earthquake_config['min_magnitude'],
+                                      earthquake_config['max_age'])
+    else:
+        feed = py3buddyfeeds.GeoJSONFeed(earthquake_config['url'],
+                                         earthquake_config['min_magnitude'],
+                                         earthquake_config['max_age'])
 
     # loop
-    magnitudere = re.compile('(\d\.\d) magnitude #earthquake')
     while(True):
-        curtime = calendar.timegm(time.gmtime())
-        print("Current time:", time.asctime(time.localtime(curtime)))
-
-        # get earthquake data from a Twitter account
-        quakes = api.GetUserTimeline(screen_name='quakestoday')
-        for q in quakes:
-            # only process the most recent ones that happened
-            # in the last 15 minutes = 900 seconds
-            if curtime - q.created_at_in_seconds > 900:
-                continue
-            quakedata = q.AsDict()
-            if quakedata['id'] in ignorelist:
-                continue
-            magnituderes = magnitudere.match(quakedata['text'])
-            if magnituderes is None:
-                continue
-            magnitude = float(magnituderes.groups()[0])
-            shakelength = int(magnitude*2)
-            if 'place' in quakedata:
-                location = quakedata['place']['country']
-            else:
-                location = 'unspecified'
-            print('Time %s, location: %s, magnitude %.1f\n' % (time.asctime(time.localtime(q.created_at_in_seconds)), location, magnitude))
+        print("Current time:", time.asctime())
+
+        # only new quakes that are recent and strong enough are
+        # returned, everything else is filtered by the feed
+        try:
+            quakes = feed.fetch()
+        except (urllib.error.URLError, OSError, ValueError) as e:
+            print(f"Cannot fetch earthquake data: {e}", file=sys.stderr)
+            quakes = []
+        for quake in quakes:
+            shakelength = int(quake.magnitude*2)
+            print('Time %s, location: %s, magnitude %.1f\n' % (time.asctime(time.localtime(quake.time)), quake.place, quake.magnitude))
             panic(ibuddy, shakelength)
-            ignorelist.add(quakedata['id'])
             time.sleep(0.5)
-        time.sleep(60)
+        time.sleep(earthquake_config['interval'])
 
-    # finally reset the i-buddy again
+    # finally reset the i-buddy again and release it
     ibuddy.reset()
+    ibuddy.close()
 
 if __name__ == "__main__":
     main(sys.argv)
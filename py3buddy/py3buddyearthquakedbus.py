@@ -22,10 +22,15 @@ import twitter
 import pydbus
 import gi
 
+# regular expression to find the magnitude in a tweet
+magnitudere = re.compile(r'(\d\.\d) magnitude #earthquake')
 
-def panic(ibuddy, paniccount):
+
+def panic(ibuddy, paniccount, priority=0):
     # a demo version to show some of the capabilities of
-    # the iBuddy
+    # the iBuddy. All the frames are sent as a single command,
+    # so bigger quakes (higher priority) preempt smaller ones.
+    cmds = []
 
     for i in range(0, paniccount):
         # set the wings to high and turn on the heart LED
@@ -41,9 +46,7 @@ def panic(ibuddy, paniccount):
 
         # send the message, and sleep for 0.1 seconds
         cmd += ":GO:SHORTSLEEP"
-
-        # execute the command
-        ibuddy.ExecuteBuddyCommand(cmd)
+        cmds.append(cmd)
 
         # set the wings to low and turn off the heart LED
         cmd = "WINGSLOW:NOHEART:"
@@ -58,12 +61,11 @@ def panic(ibuddy, paniccount):
 
         # send the message, and sleep for 0.1 seconds
         cmd += ":GO:SHORTSLEEP"
+        cmds.append(cmd)
+    cmds.append("RESET")
 
-        # execute the command
-        ibuddy.ExecuteBuddyCommand(cmd)
-    # extra reset as sometimes the device doesn't respond
-    ibuddy.ExecuteBuddyCommand("RESET")
-    ibuddy.ExecuteBuddyCommand("RESET")
+    # execute the command
+    ibuddy.ExecuteBuddyCommandWithPriority(":".join(cmds), priority)
 
 
 def main(argv):
@@ -157,7 +159,6 @@ def main(argv):
     magnitudemin = 1.5
 
     # loop
-    magnitudere = re.compile('(\d\.\d) magnitude #earthquake')
     while(True):
         curtime = calendar.timegm(time.gmtime())
         if verbose:
@@ -202,7 +203,7 @@ def main(argv):
                 sys.stdout.flush()
             if ibuddy is not None:
                 try:
-                    panic(ibuddy, shakelength)
+                    panic(ibuddy, shakelength, int(magnitude))
                 except:
                     pass
             ignorelist.add(quakedata['id'])
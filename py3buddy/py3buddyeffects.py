@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+# Effects for the iBuddy, generated as complete animations instead of
+# frame by frame.
+#
+# An animation consists of two arrays of equal length: the state bytes that
+# are sent to the device and the duration (in seconds) for which every state
+# is shown. The state bytes are composed in bulk from one track per channel,
+# with one byte per frame:
+#
+# * heart: 0 is off, 1 is on
+# * colour: bit 0 is red, bit 1 is green, bit 2 is blue (1 is on)
+# * wings: 0 is neutral, 1 is high, 2 is low
+# * motor: the motor bits (0 is middle, 1 is left, 2 is right, 3 is
+#   middlereset)
+#
+# If NumPy is available it is used for the random tracks and for combining
+# the tracks, otherwise the tracks are translated and combined as (big)
+# integers, which also avoids a Python loop per frame.
+#
+# Copyright 2017-2019 - Armijn Hemel for Tjaldur Software Governance Solutions
+# SPDX-Identifier: MIT
+
+import array
+import random
+import time
+import py3buddy
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# translation tables from channel values to the bits in the state
+# byte. Remember that for the device 0 is on and 1 is off.
+heartbits = bytes([py3buddy.HEARTMASK if i == 0 else 0 for i in range(256)])
+colourbits = bytes([((7 - (i & 7)) << 4) for i in range(256)])
+wingsvalues = [3, 1, 2]
+wingsbits = bytes([wingsvalues[i % 3] << 2 for i in range(256)])
+motorbits = bytes([i & 3 for i in range(256)])
+
+# the colours of py3buddy.allcolours as values for the colour track
+allcolours = [c.value for c in py3buddy.allcolours]
+
+# values for the tracks
+HEARTOFF = 0
+HEARTON = 1
+WINGSNEUTRAL = 0
+WINGSHIGH = 1
+WINGSLOW = 2
+
+
+def compose(heart, colour, wings, motor):
+    # combine four tracks (bytes-like, one byte per frame)
+    # into the state bytes that are sent to the device
+    if numpy is not None:
+        heart = numpy.frombuffer(bytes(heart), dtype=numpy.uint8)
+        colour = numpy.frombuffer(bytes(colour), dtype=numpy.uint8)
+        wings = numpy.frombuffer(bytes(wings), dtype=numpy.uint8)
+        motor = numpy.frombuffer(bytes(motor), dtype=numpy.uint8)
+        states = numpy.where(heart == 0, py3buddy.HEARTMASK, 0).astype(numpy.uint8)
+        states |= (7 - (colour & 7)) << 4
+        states |= numpy.array(wingsvalues, dtype=numpy.uint8)[wings % 3] << 2
+        states |= motor & 3
+        return states.tobytes()
+
+    # without NumPy: translate every track to its bits in the state byte,
+    # then OR all tracks together at once as integers
+    length = len(heart)
+    states = int.from_bytes(bytes(heart).translate(heartbits), 'big')
+    states |= int.from_bytes(bytes(colour).translate(colourbits), 'big')
+    states |= int.from_bytes(bytes(wings).translate(wingsbits), 'big')
+    states |= int.from_bytes(bytes(motor).translate(motorbits), 'big')
+    return states.to_bytes(length, 'big')
+
+
+def constant(value, length):
+    # a track with the same value for every frame
+    return bytes([value]) * length
+
+
+def alternate(values, length):
+    # a track that cycles through a few values
+    values = bytes(values)
+    return (values * (length // len(values) + 1))[:length]
+
+
+def randomtrack(choices, length, seed=None):
+    # a track with random values from 'choices'
+    # (the amount of choices has to be a divisor of 256)
+    if numpy is not None:
+        rng = numpy.random.default_rng(seed)
+        indices = rng.integers(0, len(choices), length, dtype=numpy.uint8)
+        return numpy.array(choices, dtype=numpy.uint8)[indices].tobytes()
+    rng = random.Random(seed)
+    table = bytes([choices[i % len(choices)] for i in range(256)])
+    return rng.randbytes(length).translate(table)
+
+
+def durations(duration, length):
+    return array.array('d', [duration]) * length
+
+
+def panic(paniccount, seed=None, duration=py3buddy.SHORTSLEEP):
+    # the panic demo: wings and heart alternate, random
+    # colours for the head LED and random wiggling
+    length = paniccount * 2
+    heart = alternate([HEARTON, HEARTOFF], length)
+    wings = alternate([WINGSHIGH, WINGSLOW], length)
+    if seed is not None:
+        colour = randomtrack(allcolours, length, seed)
+        motor = randomtrack([0, 1, 2, 3], length, seed + 1)
+    else:
+        colour = randomtrack(allcolours, length)
+        motor = randomtrack([0, 1, 2, 3], length)
+    return (compose(heart, colour, wings, motor), durations(duration, length))
+
+
+def colourloop(loopcount, duration=py3buddy.SLEEP):
+    # loop through all the colours of the head LED
+    length = loopcount * len(allcolours)
+    colour = bytes(allcolours) * loopcount
+    states = compose(constant(HEARTOFF, length), colour,
+                     constant(WINGSNEUTRAL, length), constant(3, length))
+    return (states, durations(duration, length))
+
+
+def dice(dicecount, seed=None, duration=py3buddy.SHORTSLEEP):
+    # an 8 sided dice: random colours, with the heart LED on for the
+    # last throw. Returns the animation and the value of the colour track
+    # for the last throw.
+    colour = randomtrack(allcolours, dicecount, seed)
+    heart = constant(HEARTOFF, dicecount - 1) + bytes([HEARTON])
+    states = compose(heart, colour, constant(WINGSNEUTRAL, dicecount),
+                     constant(3, dicecount))
+    return ((states, durations(duration, dicecount)), colour[-1])
+
+
+# sleeps in the macro language, in seconds
+macrosleeps = {'ULTRASHORTSLEEP': py3buddy.ULTRASHORTSLEEP,
+               'SHORTSLEEP': py3buddy.SHORTSLEEP, 'SLEEP': py3buddy.SLEEP,
+               'LONGSLEEP': py3buddy.LONGSLEEP, 'GLACIAL': py3buddy.GLACIAL}
+
+
+def compilemacro(cmd, tempo=1.0, pose='unknown'):
+    # compile a command in the macro language (see doc/macro-language.txt)
+    # into an animation: every GO and RESET becomes a frame, sleeps are
+    # added to the duration of the last frame (at 'tempo', 2.0 is twice
+    # as fast). Frames that move the motor to the middle get the frames
+    # they need for this from the motion planner, starting at 'pose' (None
+    # to leave them out). Returns None if the command is not valid.
+    msgs = cmd.split(':')
+    sleeps = {}
+    for i in msgs:
+        if i in py3buddy.validcmds or i == '':
+            continue
+        seconds = py3buddy.sleepliteral(i)
+        if seconds is None:
+            return None
+        sleeps[i] = seconds
+    capabilities = py3buddy.Capabilities()
+    capabilities.command = 0xff
+    capabilities.pos = None
+    states = bytearray()
+    frameduration = array.array('d')
+    for i in msgs:
+        if i == 'GO':
+            states.append(capabilities.command)
+            frameduration.append(0.0)
+        elif i == 'RESET':
+            states.append(0xff)
+            frameduration.append(0.0)
+            capabilities.command = 0xff
+        elif i in macrosleeps or i in sleeps:
+            if not states:
+                # sleeping before anything was sent
+                states.append(0xff)
+                frameduration.append(0.0)
+            frameduration[-1] += macrosleeps.get(i, sleeps.get(i)) / tempo
+        elif i == 'HEART':
+            capabilities.toggleheart(True)
+        elif i == 'NOHEART':
+            capabilities.toggleheart(False)
+        elif i in py3buddy.colourbyname:
+            capabilities.setcolour(py3buddy.colourbyname[i])
+        elif i == 'LEFT':
+            capabilities.wiggle('left')
+        elif i == 'RIGHT':
+            capabilities.wiggle('right')
+        elif i == 'MIDDLE':
+            capabilities.wiggle('middle')
+        elif i == 'MIDDLE2':
+            capabilities.wiggle('middlereset')
+        elif i == 'WINGSHIGH':
+            capabilities.wings('high')
+        elif i == 'WINGSLOW':
+            capabilities.wings('low')
+    if pose is None:
+        return (bytes(states), frameduration)
+    return planmotion((bytes(states), frameduration), pose)
+
+
+def planmotion(animation, pose='unknown'):
+    # splice the steps of the motion planner (see py3buddy.motionplans)
+    # into an animation, so frames that move the motor to the middle
+    # actually do so, starting from 'pose'. The time for the extra frames
+    # is taken from the frame before, if that is long enough.
+    (states, frameduration) = animation
+    if b'\x00' not in bytes(states).translate(motorbits):
+        # the motor is never moved to the middle
+        return animation
+    newstates = bytearray()
+    newduration = array.array('d')
+    for i in range(len(states)):
+        state = states[i]
+        bits = state & py3buddy.MOTORMASK
+        if bits == 0:
+            for (stepbits, delay) in py3buddy.motionplans[(pose, 0)][:-1]:
+                if newduration and newduration[-1] >= delay:
+                    newduration[-1] -= delay
+                newstates.append((state & ~py3buddy.MOTORMASK) | stepbits)
+                newduration.append(delay)
+                pose = py3buddy.posetransitions[(pose, stepbits)][0]
+        pose = py3buddy.posetransitions[(pose, bits)][0]
+        newstates.append(state)
+        newduration.append(frameduration[i])
+    return (bytes(newstates), newduration)
+
+
+def concat(*animations):
+    # concatenate several animations
+    states = b''.join([a[0] for a in animations])
+    frameduration = array.array('d')
+    for a in animations:
+        frameduration.extend(a[1])
+    return (states, frameduration)
+
+
+def play(ibuddy, animation, speed=None):
+    # play an animation: every state is sent and then shown for its
+    # duration. Frames are scheduled relative to the start, so the time
+    # spent sending frames does not add up. By default the animation is
+    # played at the tempo of the iBuddy.
+    if speed is None:
+        speed = ibuddy.tempo
+    (states, frameduration) = animation
+    start = time.monotonic()
+    target = 0.0
+    for i in range(len(states)):
+        ibuddy.sendstate(states[i])
+        target += frameduration[i] / speed
+        wait = start + target - time.monotonic()
+        if wait > 0:
+            ibuddy.sleep(wait)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+# Feeds with earthquake data for the earthquake monitor
+# (py3buddyearthquake.py). Every feed has a method fetch() that returns the
+# quakes that were not returned before, oldest first, and that are recent
+# enough (maxage, in seconds) and strong enough (minmagnitude).
+#
+# * GeoJSONFeed: a GeoJSON feed over HTTP(S), such as the USGS feeds:
+#   https://earthquake.usgs.gov/earthquakes/feed/v1.0/geojson.php
+#   Only changed feeds are downloaded (If-Modified-Since and If-None-Match).
+#   The URL can contain {since} (the time of the newest quake that was seen,
+#   in ISO 8601) and {minmagnitude}, so feeds that support queries (such as
+#   https://earthquake.usgs.gov/fdsnws/event/1/query) only return new quakes:
+#   https://earthquake.usgs.gov/fdsnws/event/1/query?format=geojson&starttime={since}&minmagnitude={minmagnitude}
+#
+# * FileFeed: a local file, which is only read when it was changed. This is
+#   either a GeoJSON file, or a text file with one quake per line in the
+#   format of the old Twitter feed ("4.5 magnitude #earthquake ..."), of
+#   which only the lines that were added since the last fetch are read.
+#
+# Before a feed is parsed the magnitudes are extracted with a regular
+# expression, so feeds without any quake that is strong enough are skipped
+# without parsing them.
+#
+# Copyright 2017-2019 - Armijn Hemel for Tjaldur Software Governance Solutions
+# SPDX-Identifier: MIT
+
+import collections
+import gzip
+import json
+import os
+import re
+import time
+import urllib.error
+import urllib.request
+
+# a quake: id, time (in seconds since the epoch), magnitude and place
+Quake = collections.namedtuple('Quake', ['id', 'time', 'magnitude', 'place'])
+
+# default maximum age of quakes, in seconds
+defaultmaxage = 900
+
+# magnitudes in a GeoJSON feed
+geojsonmagnitudere = re.compile(rb'"mag"\s*:\s*(-?\d+(?:\.\d+)?)')
+
+# the magnitude in a line of text
+magnitudere = re.compile(rb'(\d+(?:\.\d+)?) magnitude #earthquake[.\s]*(.*)')
+
+
+def strongenough(data, minmagnitude):
+    # quick check whether a GeoJSON feed contains
+    # at least one quake that is strong enough
+    for magnitude in geojsonmagnitudere.findall(data):
+        if float(magnitude) >= minmagnitude:
+            return True
+    return False
+
+
+class Feed:
+    # the bookkeeping that is shared by all feeds
+    def __init__(self, minmagnitude=0.0, maxage=defaultmaxage):
+        self.minmagnitude = minmagnitude
+        self.maxage = maxage
+
+        # ids of quakes that were returned, with their time
+        self.seen = {}
+
+        # the time of the newest quake that was returned
+        self.newest = None
+
+    def since(self):
+        # the time from which quakes are interesting
+        oldest = time.time() - self.maxage
+        if self.newest is not None and self.newest > oldest:
+            return self.newest
+        return oldest
+
+    def prune(self):
+        # forget quakes that are too old to be returned again
+        oldest = time.time() - self.maxage
+        for quakeid in [q for q in self.seen if self.seen[q] < oldest]:
+            del self.seen[quakeid]
+
+    def newquakes(self, candidates):
+        # the quakes that are recent, strong enough and not yet
+        # returned, oldest first
+        oldest = time.time() - self.maxage
+        quakes = []
+        for quake in candidates:
+            if quake.magnitude < self.minmagnitude or quake.time < oldest:
+                continue
+            if quake.id in self.seen:
+                continue
+            self.seen[quake.id] = quake.time
+            quakes.append(quake)
+            if self.newest is None or quake.time > self.newest:
+                self.newest = quake.time
+        self.prune()
+        quakes.sort(key=lambda q: q.time)
+        return quakes
+
+    def parsegeojson(self, data):
+        # quakes in a GeoJSON feed
+        if not strongenough(data, self.minmagnitude):
+            return []
+        candidates = []
+        for feature in json.loads(data).get('features', []):
+            properties = feature.get('properties') or {}
+            magnitude = properties.get('mag')
+            if magnitude is None or magnitude < self.minmagnitude:
+                continue
+            candidates.append(Quake(feature.get('id'), properties.get('time', 0) / 1000,
+                                    magnitude, properties.get('place') or 'unspecified'))
+        return self.newquakes(candidates)
+
+
+class GeoJSONFeed(Feed):
+    def __init__(self, url, minmagnitude=0.0, maxage=defaultmaxage,
+                 timeout=30):
+        super().__init__(minmagnitude, maxage)
+        self.url = url
+        self.timeout = timeout
+        self.lastmodified = None
+        self.etag = None
+
+    def geturl(self):
+        since = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(self.since()))
+        return self.url.replace('{since}', since).replace('{minmagnitude}', str(self.minmagnitude))
+
+    def fetch(self):
+        headers = {'Accept-Encoding': 'gzip'}
+        if self.lastmodified is not None:
+            headers['If-Modified-Since'] = self.lastmodified
+        if self.etag is not None:
+            headers['If-None-Match'] = self.etag
+        request = urllib.request.Request(self.geturl(), headers=headers)
+        try:
+            response = urllib.request.urlopen(request, timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                # not modified
+                return []
+            raise
+        with response:
+            data = response.read()
+            if response.headers.get('Content-Encoding') == 'gzip':
+                data = gzip.decompress(data)
+            self.lastmodified = response.headers.get('Last-Modified')
+            self.etag = response.headers.get('ETag')
+        return self.parsegeojson(data)
+
+
+class FileFeed(Feed):
+    def __init__(self, path, minmagnitude=0.0, maxage=defaultmaxage):
+        super().__init__(minmagnitude, maxage)
+        self.path = path
+        self.lastmodified = None
+        # how far a text file was read
+        self.offset = 0
+
+    def fetch(self):
+        filestat = os.stat(self.path)
+        modified = (filestat.st_mtime_ns, filestat.st_size)
+        if modified == self.lastmodified:
+            return []
+        self.lastmodified = modified
+        with open(self.path, 'rb') as feedfile:
+            start = feedfile.read(1)
+            while start.isspace():
+                start = feedfile.read(1)
+            if start == b'{':
+                feedfile.seek(0)
+                return self.parsegeojson(feedfile.read())
+
+            # a text file: only read the lines that were added, unless
+            # the file was truncated (for example by log rotation)
+            if filestat.st_size < self.offset:
+                self.offset = 0
+                self.seen = {}
+            feedfile.seek(self.offset)
+            data = feedfile.read()
+        # only use complete lines, the position of
+        # a line in the file is the id of the quake
+        end = data.rfind(b'\n') + 1
+        now = time.time()
+        candidates = []
+        position = self.offset
+        for line in data[:end].split(b'\n')[:-1]:
+            match = magnitudere.search(line)
+            if match is not None:
+                place = match.group(2).decode('utf-8', 'replace').strip() or 'unspecified'
+                candidates.append(Quake(position, now, float(match.group(1)), place))
+            position += len(line) + 1
+        self.offset += end
+        return self.newquakes(candidates)
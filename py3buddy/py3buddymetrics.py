@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+
+# Metrics for the iBuddy: counters and histograms that are updated by the
+# iBuddy class (transfers, USB errors, commands, resets, sleeps) and that
+# can be exposed in the Prometheus text exposition format over HTTP.
+#
+# Metrics are only collected if a Metrics object is assigned to an
+# iBuddy (ibuddy.metrics = metrics). If not, the only overhead is a
+# check for None in the iBuddy methods.
+#
+# Copyright 2017-2019 - Armijn Hemel for Tjaldur Software Governance Solutions
+# SPDX-Identifier: MIT
+
+import http.server
+import threading
+
+# prefix for all metric names
+metricsprefix = 'py3buddy_'
+
+# default buckets for the histograms, in seconds. USB transfers
+# are typically a few milliseconds, sleeps and macros can take
+# much longer.
+defaultbuckets = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                  0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 100]
+
+# descriptions of the metrics that are known in advance
+metricshelp = {
+    'transfers_total': 'Number of USB control transfers sent to the device',
+    'reconnects_total': 'Number of times the device was found again after an error',
+    'usb_errors_total': 'Number of USB errors raised by control transfers',
+    'commands_total': 'Number of macro commands executed',
+    'invalid_commands_total': 'Number of macro commands rejected as invalid',
+    'tokens_total': 'Number of macro tokens executed',
+    'resets_total': 'Number of resets of the device',
+    'resets_skipped_total': 'Number of resets skipped as the device was at rest',
+    'sleep_seconds_total': 'Time spent sleeping in macros',
+    'transfer_seconds': 'Latency of USB control transfers',
+    'command_seconds': 'Duration of macro commands',
+    'reset_seconds': 'Duration of resets',
+    'queue_wait_seconds': 'Time commands wait in the queue before being played',
+}
+
+
+class Metrics:
+    def __init__(self, buckets=defaultbuckets):
+        self.buckets = sorted(buckets)
+        self.counters = {}
+        self.histograms = {}
+        # functions that return extra samples when the metrics are
+        # exported, for values that are kept elsewhere (for example
+        # the governor counters)
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    # counters and histograms are updated from several threads (the
+    # player, the idle watcher, DBus) and read when scraped, so they
+    # are only accessed with the lock held
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = {
+                    'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            # only the first bucket that fits is updated, the
+            # buckets are made cumulative when exporting
+            for i in range(len(self.buckets)):
+                if value <= self.buckets[i]:
+                    histogram['buckets'][i] += 1
+                    break
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def addcollector(self, collector):
+        # a collector is a function returning a list of
+        # (name, type, labels, value) tuples
+        self.collectors.append(collector)
+
+    def exposition(self):
+        # return all the metrics in the Prometheus text format
+        lines = []
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = [(name, {'buckets': list(histogram['buckets']),
+                                  'sum': histogram['sum'],
+                                  'count': histogram['count']})
+                          for (name, histogram) in self.histograms.items()]
+
+        for name in sorted(counters):
+            fullname = metricsprefix + name
+            if name in metricshelp:
+                lines.append('# HELP %s %s' % (fullname, metricshelp[name]))
+            lines.append('# TYPE %s counter' % fullname)
+            lines.append('%s %s' % (fullname, formatvalue(counters[name])))
+
+        for (name, histogram) in sorted(histograms):
+            fullname = metricsprefix + name
+            if name in metricshelp:
+                lines.append('# HELP %s %s' % (fullname, metricshelp[name]))
+            lines.append('# TYPE %s histogram' % fullname)
+            cumulative = 0
+            for i in range(len(self.buckets)):
+                cumulative += histogram['buckets'][i]
+                lines.append('%s_bucket{le="%s"} %d' % (fullname, formatvalue(self.buckets[i]), cumulative))
+            lines.append('%s_bucket{le="+Inf"} %d' % (fullname, histogram['count']))
+            lines.append('%s_sum %s' % (fullname, formatvalue(histogram['sum'])))
+            lines.append('%s_count %d' % (fullname, histogram['count']))
+
+        # the samples of a metric have to be grouped together, but
+        # collectors return the samples per actuator or client
+        families = {}
+        for collector in self.collectors:
+            for (name, metrictype, labels, value) in collector():
+                fullname = metricsprefix + name
+                if fullname not in families:
+                    families[fullname] = ['# TYPE %s %s' % (fullname, metrictype)]
+                if labels:
+                    labelstring = ','.join(['%s="%s"' % (k, escapelabel(labels[k])) for k in sorted(labels)])
+                    families[fullname].append('%s{%s} %s' % (fullname, labelstring, formatvalue(value)))
+                else:
+                    families[fullname].append('%s %s' % (fullname, formatvalue(value)))
+        for family in families.values():
+            lines += family
+        return '\n'.join(lines) + '\n'
+
+
+def escapelabel(value):
+    # escape a label value as the exposition format requires, as some
+    # values (such as the names of clients) come from other programs
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def formatvalue(value):
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+def governorcollector(governor):
+    # create a collector for the counters of an iBuddy governor
+    def collect():
+        stats = governor.stats()
+        samples = [('governor_frames_total', 'counter', None, stats['frames']),
+                   ('governor_substituted_total', 'counter', None, stats['substituted']),
+                   ('governor_throttled_total', 'counter', None, stats['throttled']),
+                   ('governor_throttled_seconds_total', 'counter', None, stats['throttledtime']),
+                   ('state', 'gauge', None, stats['state'])]
+        for actuator in sorted(stats['actuators']):
+            actuatorstats = stats['actuators'][actuator]
+            labels = {'actuator': actuator}
+            samples.append(('governor_usage_seconds', 'gauge', labels, actuatorstats['usage']))
+            if actuatorstats['budget'] is not None:
+                samples.append(('governor_budget_seconds', 'gauge', labels, actuatorstats['budget']))
+            samples.append(('governor_energized', 'gauge', labels, actuatorstats['energized']))
+            samples.append(('governor_blocked_total', 'counter', labels, actuatorstats['blocked']))
+        return samples
+    return collect
+
+
+def transportcollector(ibuddy):
+    # create a collector for the transport counters of an iBuddy
+    def collect():
+        stats = ibuddy.transportstats
+        samples = [('transport_retries_total', 'counter', None, stats['retries']),
+                   ('transport_reconnect_failures_total', 'counter', None, stats['reconnectfailures']),
+                   ('transport_idle_releases_total', 'counter', None, stats['releases']),
+                   ('transport_reacquires_total', 'counter', None, stats['reacquires']),
+                   ('statepage_errors_total', 'counter', None, ibuddy.statepageerrors),
+                   ('connected', 'gauge', None, ibuddy.dev is not None)]
+        for errorclass in ibuddy.transportstats:
+            if not errorclass.startswith('errors_'):
+                continue
+            labels = {'class': errorclass[7:]}
+            samples.append(('transport_errors_total', 'counter', labels, stats[errorclass]))
+        return samples
+    return collect
+
+
+def clientcollector(player):
+    # create a collector for the statistics per client of a player
+    def collect():
+        samples = []
+        stats = player.clientstats()
+        for client in sorted(stats, key=str):
+            clientstats = stats[client]
+            labels = {'client': client}
+            samples.append(('client_commands_total', 'counter', labels, clientstats['submitted']))
+            samples.append(('client_rejected_total', 'counter', labels, clientstats['rejected']))
+            samples.append(('client_errors_total', 'counter', labels, clientstats['errors']))
+            samples.append(('client_invalid_total', 'counter', labels, clientstats['invalid']))
+            samples.append(('client_cancelled_total', 'counter', labels, clientstats['cancelled']))
+            samples.append(('client_queued', 'gauge', labels, clientstats['queued']))
+            # the percentiles are computed by the player over the recent
+            # waits, there is no sum and count, so they are plain gauges
+            for quantile in ['p50', 'p99']:
+                if 'wait_' + quantile in clientstats:
+                    samples.append(('client_queue_wait_%s_seconds' % quantile, 'gauge', labels,
+                                    clientstats['wait_' + quantile]))
+        return samples
+    return collect
+
+
+# a minimal HTTP handler that only serves /metrics
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.metrics.exposition().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # do not log every scrape
+        pass
+
+
+def startserver(metrics, port, address='127.0.0.1'):
+    # serve the metrics over HTTP in a separate (daemon) thread
+    server = http.server.ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    server.metrics = metrics
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
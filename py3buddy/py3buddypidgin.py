@@ -17,6 +17,8 @@ import time
 import calendar
 import re
 import py3buddy
+import py3buddycompositor
+import py3buddyeffects
 import pydbus
 import gi
 
@@ -25,9 +27,6 @@ def processmsg(account, sender, message, conversation, flags):
     # a demo version to show some of the capabilities of
     # the iBuddy
 
-    # first reset the iBuddy
-    ibuddy.reset()
-
     # a list of smileys as sent by Google Hangout
     smileys = [':D', ':-D', '^_^', ':-)', ':)', '☺️']
 
@@ -35,11 +34,14 @@ def processmsg(account, sender, message, conversation, flags):
     smilecommand = 'RED:HEART:WINGSHIGH:GO:SHORTSLEEP:YELLOW:NOHEART:WINGSLOW:GO:SHORTSLEEP:HEART:BLUE:WINGSHIGH:GO:SHORTSLEEP:PURPLE:NOHEART:WINGSLOW:GO:SHORTSLEEP:HEART:CYAN:WINGSHIGH:GO:SHORTSLEEP:WHITE:NOHEART:WINGSLOW:GO:SHORTSLEEP:RESET'
     for s in smileys:
         if s in message:
-            ibuddy.executecommand(smilecommand)
+            # play the command on top of the status layer (if any).
+            # When it has finished the status is shown again.
+            animation = py3buddyeffects.compilemacro(smilecommand)
+            compositor.addlayer(py3buddycompositor.Layer('smiley', 10,
+                                ['heart', 'head', 'wings', 'motor'],
+                                animation=animation))
             break
 
-    ibuddy.reset()
-
 
 def main(argv):
     parser = argparse.ArgumentParser()
@@ -47,6 +49,9 @@ def main(argv):
     # options for the commandline
     parser.add_argument("-c", "--config", action="store", dest="cfg",
                         help="path to configuration file", metavar="FILE")
+    parser.add_argument("-s", "--status", action="store", dest="status",
+                        help="status colour for the head LED",
+                        metavar="COLOUR")
     args = parser.parse_args()
 
     # first some sanity checks for the configuration file
@@ -56,6 +61,9 @@ def main(argv):
     if not os.path.exists(args.cfg):
         parser.error("Configuration file does not exist")
 
+    if args.status is not None and args.status not in py3buddy.colourbyname:
+        parser.error("Unknown colour")
+
     # then parse the configuration file
     config = configparser.ConfigParser()
 
@@ -70,32 +78,39 @@ def main(argv):
     buddy_config = {}
     for section in config.sections():
         if section == 'ibuddy':
-            try:
-                productid = int(config.get(section, 'productid'))
-                buddy_config['productid'] = productid
-            except:
-                pass
-
-            buddy_config['reset_position'] = False
-            try:
-                reset_position_val = config.get(section, 'reset_position')
-                if reset_position_val == 'yes':
-                    buddy_config['reset_position'] = True
-            except:
-                pass
+            buddy_config = py3buddy.parseconfig(config, section)
+
         if section == 'twitter':
             pass
 
     # This is very ugly, but the only way (I know) to expose the iBuddy to the
     # method processing the message from Pidgin
-    global ibuddy
+    global compositor
+
+    if buddy_config.get('transport', 'pyusb') not in ['pyusb', 'usbfs']:
+        print("Unknown transport, should be pyusb or usbfs", file=sys.stderr)
+        sys.exit(1)
 
     # initialize an iBuddy and check if a device was found and is accessible
-    ibuddy = py3buddy.iBuddy(buddy_config)
+    try:
+        ibuddy = py3buddy.iBuddy(buddy_config)
+    except ValueError as e:
+        print(f"Cannot use iBuddy: {e}", file=sys.stderr)
+        sys.exit(1)
     if ibuddy.dev is None:
         print("No iBuddy found, or iBuddy not accessible", file=sys.stderr)
         sys.exit(1)
 
+    # all effects go through a compositor, so the
+    # status colour is not wiped out by the smileys
+    ibuddy.reset()
+    compositor = py3buddycompositor.Compositor(ibuddy)
+    if args.status is not None:
+        status = py3buddy.BuddyState().withcolour(py3buddy.colourbyname[args.status])
+        compositor.addlayer(py3buddycompositor.Layer('status', 0, ['head'],
+                                                      state=status.state))
+    compositor.start()
+
     # connect to session DBus
     bus = pydbus.SessionBus()
 
@@ -107,7 +122,9 @@ def main(argv):
     gi.repository.GObject.MainLoop().run()
 
     # finally reset the i-buddy again
+    compositor.stop()
     ibuddy.reset()
+    ibuddy.close()
 
 if __name__ == "__main__":
     main(sys.argv)
@@ -20,9 +20,6 @@ def processmsg(account, sender, message, conversation, flags):
     # a demo version to show some of the capabilities of
     # the iBuddy
 
-    # first reset the iBuddy
-    ibuddy.ExecuteBuddyCommand("RESET")
-
     # a list of smileys as sent by Google Hangout
     smileys = [':D', ':-D', '^_^', ':-)', ':)', '☺️']
 
@@ -34,10 +31,6 @@ def processmsg(account, sender, message, conversation, flags):
             ibuddy.ExecuteBuddyCommand(smilecommand)
             break
 
-    # send an extra reset, as sometimes the iBuddy doesn't respond
-    # to all commands.
-    ibuddy.ExecuteBuddyCommand("RESET")
-
 
 def main(argv):
     # connect to session DBus
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+
+# A player that executes commands in the macro language on the iBuddy in a
+# separate thread, so callers (for example the DBus service) do not have to
+# wait until a command has finished.
+#
+# Commands are queued with a priority: commands with a higher priority are
+# executed first, commands with the same priority in the order they were
+# submitted. If a command is submitted with a higher priority than the
+# command that is playing, the playing command is cancelled (preempted), so
+# an alert does not have to wait for a long sleep in another command. A
+# cancelled command resets the iBuddy, so it is in a defined state.
+#
+# Commands can be submitted on behalf of a client (for example the name of
+# the program that called the DBus service). Commands of clients with the
+# same priority are scheduled with weighted fair queuing: every command gets
+# a virtual finish time, which is the virtual time at which it was submitted
+# (or the finish time of the previous command of the client, if that is
+# later) plus the expected duration of the command divided by the weight of
+# the client. Commands with the earliest finish time are played first, so a
+# client that submits a lot of commands cannot starve a client that only
+# submits a command once in a while: the wait of the latter is bounded by
+# the duration of a few commands, not by the length of the queue.
+#
+# Clients can also have a quota: the maximum amount of commands they can
+# have in the queue. Commands beyond the quota are rejected.
+#
+# Copyright 2017-2019 - Armijn Hemel for Tjaldur Software Governance Solutions
+# SPDX-Identifier: MIT
+
+import sys
+import collections
+import heapq
+import itertools
+import threading
+import time
+import py3buddy
+
+# the expected duration of commands that do not send anything
+# or sleep (for example invalid commands), in seconds
+mincost = 0.001
+
+# the amount of latencies per client that are kept
+# for the percentiles in the statistics
+latencysamples = 1000
+
+# the maximum amount of clients that are remembered, clients
+# that are not configured and that have nothing queued are
+# forgotten when there are more clients
+maxclients = 256
+
+
+def commandcost(cmd, tempo=1.0):
+    # the expected duration of a command in seconds: the sleeps
+    # (at the tempo of the command) and the USB transfers
+    tokens = py3buddy.compilecommand(cmd)
+    if not tokens:
+        return mincost
+    cost = 0.0
+    for (name, method, args) in tokens:
+        if method is py3buddy.iBuddy.macrosleep:
+            cost += args[0] / tempo
+        elif method is py3buddy.iBuddy.sendcommand or method is py3buddy.iBuddy.reset:
+            cost += py3buddy.TRANSFERCOST
+    return max(cost, mincost)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Client:
+    # the scheduling state and the statistics of a client
+    def __init__(self, name, weight=1.0, quota=0):
+        self.name = name
+        self.weight = weight
+        # maximum amount of queued commands, 0 is unlimited
+        self.quota = quota
+        self.queued = 0
+        # virtual finish time of the last command
+        self.finish = 0.0
+        self.lastseen = time.monotonic()
+        self.stats = {'submitted': 0, 'rejected': 0, 'completed': 0,
+                      'cancelled': 0, 'errors': 0, 'invalid': 0}
+        # time waited in the queue, and time until the
+        # command was done (submitted to finished)
+        self.waits = collections.deque(maxlen=latencysamples)
+        self.latencies = collections.deque(maxlen=latencysamples)
+        self.maxwait = 0.0
+
+
+class Player:
+    def __init__(self, ibuddy, resetafter=True, clients=None,
+                 defaultweight=1.0, defaultquota=0):
+        self.ibuddy = ibuddy
+        # reset the iBuddy after every command
+        self.resetafter = resetafter
+        self.queue = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.current = None
+        self.stopped = False
+        self.thread = None
+
+        # weights and quotas of known clients (a dictionary with
+        # a dictionary with 'weight' and/or 'quota' per client),
+        # and of all other clients
+        self.clientconfig = clients or {}
+        self.defaultweight = defaultweight
+        self.defaultquota = defaultquota
+        self.clients = {}
+
+        # the virtual time: the finish time of the
+        # command that was played last
+        self.virtualtime = 0.0
+
+    def getclient(self, name):
+        # the state of a client, created when it is first seen.
+        # Called with the condition held.
+        client = self.clients.get(name)
+        if client is not None:
+            return client
+        if len(self.clients) >= maxclients:
+            self.forgetclients()
+        clientconfig = self.clientconfig.get(name, {})
+        client = Client(name, clientconfig.get('weight', self.defaultweight),
+                        clientconfig.get('quota', self.defaultquota))
+        self.clients[name] = client
+        return client
+
+    def forgetclients(self):
+        # forget the least recently seen half of the clients
+        # that are not configured and have nothing queued
+        idle = [c for c in self.clients.values()
+                if c.queued == 0 and c.name not in self.clientconfig]
+        idle.sort(key=lambda c: c.lastseen)
+        for client in idle[:max(1, len(idle) // 2)]:
+            del self.clients[client.name]
+
+    def submit(self, cmd, priority=0, tempo=None, client=None):
+        # queue a command, returns a Playback that can be used to
+        # wait for the command or cancel it, or None if the client
+        # already has as many commands in the queue as its quota
+        playback = py3buddy.Playback(cmd, priority, tempo, client)
+        if tempo is None:
+            tempo = self.ibuddy.tempo
+        with self.condition:
+            state = self.getclient(client)
+            state.lastseen = playback.submitted
+            if state.quota and state.queued >= state.quota:
+                state.stats['rejected'] += 1
+                return None
+            state.stats['submitted'] += 1
+            state.queued += 1
+            start = max(self.virtualtime, state.finish)
+            state.finish = start + commandcost(cmd, tempo) / state.weight
+            heapq.heappush(self.queue, (-priority, state.finish, next(self.counter), playback))
+            if self.current is not None and priority > self.current.priority:
+                self.current.cancel()
+            self.condition.notify()
+            self.publish()
+        return playback
+
+    def publish(self):
+        # publish the queue depth and the command that is playing on the
+        # state page, if any (see py3buddystatepage.py). Errors writing
+        # the page are counted by the iBuddy. Called with the condition
+        # held.
+        if self.ibuddy.statepage is not None:
+            playing = 0
+            if self.current is not None:
+                playing = self.current.id
+            self.ibuddy.publishstate(queuedepth=len(self.queue), playing=playing)
+
+    def stop(self):
+        # stop and reset: cancel the command that is playing and drop
+        # all commands that are queued. The command that is playing
+        # resets the iBuddy when it is cancelled.
+        with self.condition:
+            for (priority, finish, count, playback) in self.queue:
+                playback.cancel()
+                playback.finished = time.monotonic()
+                playback.done.set()
+                state = self.clients.get(playback.client)
+                if state is not None:
+                    state.queued -= 1
+                    state.stats['cancelled'] += 1
+            self.queue = []
+            for state in self.clients.values():
+                state.finish = self.virtualtime
+            self.publish()
+            current = self.current
+            if current is not None:
+                current.cancel()
+        if current is None:
+            self.ibuddy.reset()
+
+    def queuedepth(self):
+        with self.condition:
+            return len(self.queue)
+
+    def clientstats(self):
+        # the statistics per client, with the median, 99th
+        # percentile and maximum of the time waited in the
+        # queue and of the time until commands were done
+        stats = {}
+        with self.condition:
+            for client in self.clients.values():
+                clientstats = dict(client.stats)
+                clientstats['weight'] = client.weight
+                clientstats['quota'] = client.quota
+                clientstats['queued'] = client.queued
+                clientstats['wait_max'] = client.maxwait
+                for (name, values) in [('wait', client.waits), ('latency', client.latencies)]:
+                    if values:
+                        clientstats[name + '_p50'] = percentile(values, 0.5)
+                        clientstats[name + '_p99'] = percentile(values, 0.99)
+                stats[client.name] = clientstats
+        return stats
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                (priority, finish, count, playback) = heapq.heappop(self.queue)
+                self.virtualtime = finish
+                self.current = playback
+                self.publish()
+                waited = time.monotonic() - playback.submitted
+                state = self.clients.get(playback.client)
+                if state is not None:
+                    state.queued -= 1
+                    state.waits.append(waited)
+                    if waited > state.maxwait:
+                        state.maxwait = waited
+            if self.ibuddy.metrics is not None:
+                self.ibuddy.metrics.observe('queue_wait_seconds', waited)
+            if self.ibuddy.tracer is not None:
+                end = self.ibuddy.tracer.now()
+                self.ibuddy.tracer.span('queue', 'queue', end - waited, end,
+                                        {'priority': playback.priority,
+                                         'client': playback.client})
+            try:
+                if not playback.cancelled.is_set():
+                    playback.completed = self.ibuddy.executecommand(playback.cmd, playback)
+                    if playback.completed and self.resetafter:
+                        self.ibuddy.reset()
+            except Exception as e:
+                # for example a USB error that could not be recovered
+                # from, which should not stop the player
+                playback.error = e
+                print(f"Error executing command: {e}", file=sys.stderr)
+            finally:
+                playback.finished = time.monotonic()
+                with self.condition:
+                    self.current = None
+                    self.publish()
+                    if state is not None:
+                        if playback.completed:
+                            state.stats['completed'] += 1
+                        elif playback.error is not None:
+                            state.stats['errors'] += 1
+                        elif playback.invalid:
+                            state.stats['invalid'] += 1
+                        elif playback.cancelled.is_set():
+                            state.stats['cancelled'] += 1
+                        state.latencies.append(playback.finished - playback.submitted)
+                playback.done.set()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def shutdown(self):
+        # stop the player thread after cancelling everything
+        self.stop()
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+# Software PWM for the iBuddy: the red, green and blue bits of the head LED
+# and the heart LED are switched on and off at a high, steady frame rate, so
+# they look dimmed, and the head LED can show colours other than the 8
+# colours it has (such as orange: red at full brightness, green at half).
+#
+# pwm = py3buddypwm.PWM(ibuddy)
+# pwm.start()
+# pwm.set(red=1.0, green=0.5, heart=0.2)
+# ...
+# pwm.stop()
+#
+# Every channel has a brightness between 0 and 1, which is rounded to one
+# of 'levels' steps. For every combination of brightnesses the frames for a
+# period of 'levels' frames are computed in advance with error diffusion, so
+# the frames in which a channel is on are spread over the period as evenly
+# as possible (a channel at half brightness toggles every frame, instead of
+# being on for half a period and then off), which keeps flicker low. The
+# loop that sends the frames does not compute or allocate anything.
+#
+# While the PWM is running it owns the head LED and the heart LED. The
+# wings and the motor keep the state they had in the iBuddy when the
+# brightness was set. When the PWM stops the state of the iBuddy is sent
+# again.
+#
+# If the device cannot keep up with the frame rate, the frame rate is
+# lowered to what the device can do, instead of sending frames late (which
+# would make the brightness uneven). It is raised again, up to the frame
+# rate that was asked for, when the device keeps up again. The frame rate
+# that is achieved can be found with stats().
+#
+# Copyright 2017-2019 - Armijn Hemel for Tjaldur Software Governance Solutions
+# SPDX-Identifier: MIT
+
+import threading
+import time
+import py3buddy
+
+# the default frame rate (frames per second) and the
+# amount of brightness levels of every channel
+defaultrate = 200
+defaultlevels = 16
+
+# the lowest frame rate the PWM goes down to
+minrate = 10
+
+# the bits of the channels in the state byte (0 is on)
+channelbits = {'red': 0x10, 'green': 0x20, 'blue': 0x40, 'heart': py3buddy.HEARTMASK}
+PWMMASK = py3buddy.HEADMASK | py3buddy.HEARTMASK
+
+# the frame rate is checked every 'window' seconds: if less than 'slow' of
+# the frame rate was achieved the frame rate is lowered, if all frames were
+# sent on time for 'recover' windows in a row the frame rate is raised by
+# 'step' (until the requested rate)
+window = 1.0
+slow = 0.9
+recover = 5
+step = 1.1
+
+# colours that are mixed from the red, green and blue bits
+pwmcolours = {
+    'ORANGE': (1.0, 0.4, 0.0),
+    'PINK': (1.0, 0.3, 0.5),
+    'AMBER': (1.0, 0.6, 0.0),
+    'LIME': (0.5, 1.0, 0.0),
+    'TEAL': (0.0, 0.5, 0.5),
+    'VIOLET': (0.5, 0.0, 1.0),
+    'WARMWHITE': (1.0, 0.7, 0.3),
+}
+
+
+def pattern(brightness, base=0xff, levels=defaultlevels):
+    # the frames for one period of 'levels' frames, for a dictionary with
+    # the brightness (0 to 1) per channel. The bits outside of the head
+    # LED and the heart LED are taken from 'base'.
+    frames = bytearray([base | PWMMASK]) * levels
+    for channel in channelbits:
+        on = round(min(max(brightness.get(channel, 0.0), 0.0), 1.0) * levels)
+        # error diffusion: a channel is on whenever the
+        # accumulated brightness passes a full frame
+        accumulator = levels // 2
+        for i in range(levels):
+            accumulator += on
+            if accumulator >= levels:
+                accumulator -= levels
+                frames[i] &= ~channelbits[channel]
+    return bytes(frames)
+
+
+class PWM:
+    def __init__(self, ibuddy, rate=defaultrate, levels=defaultlevels):
+        self.ibuddy = ibuddy
+        # not faster than the device accepts frames (see py3buddycalibrate.py)
+        if ibuddy.minframeinterval:
+            rate = min(rate, 1 / ibuddy.minframeinterval)
+        self.levels = levels
+        self.requestedrate = rate
+        self.rate = rate
+        self.frames = pattern({}, ibuddy.command, levels)
+        self.stopping = threading.Event()
+        self.thread = None
+
+        # statistics: frames sent, frames that were sent late, times the
+        # schedule was restarted as it was more than a frame behind, the
+        # frame rate that was achieved in the last window and the amount
+        # of times the frame rate was lowered
+        self.frames_sent = 0
+        self.late = 0
+        self.skipped = 0
+        self.achieved = 0.0
+        self.lowered = 0
+
+    def set(self, red=0.0, green=0.0, blue=0.0, heart=0.0):
+        # set the brightness of the channels (0 to 1). The new frames
+        # are picked up by the loop at the start of the next frame.
+        self.frames = pattern({'red': red, 'green': green, 'blue': blue,
+                               'heart': heart}, self.ibuddy.command, self.levels)
+
+    def setcolour(self, name, brightness=1.0, heart=0.0):
+        # set one of the mixed colours (see pwmcolours), or
+        # one of the colours of the iBuddy, at a brightness
+        if name in pwmcolours:
+            (red, green, blue) = pwmcolours[name]
+        else:
+            colour = py3buddy.colourbyname[name]
+            (red, green, blue) = (colour.red, colour.green, colour.blue)
+        self.set(red * brightness, green * brightness, blue * brightness, heart)
+
+    def stats(self):
+        return {'frames': self.frames_sent, 'late': self.late,
+                'skipped': self.skipped, 'rate': self.achieved,
+                'target': self.rate, 'requested': self.requestedrate,
+                'lowered': self.lowered}
+
+    def run(self, duration=None):
+        # send frames until stop() is called or 'duration' seconds
+        # have passed. Everything that is used in the loop is looked
+        # up in advance.
+        transmit = self.ibuddy.transmit
+        wait = self.ibuddy.wait
+        now = time.perf_counter
+        stopping = self.stopping
+        interval = 1.0 / self.rate
+        start = now()
+        end = None
+        if duration is not None:
+            end = start + duration
+        deadline = start
+        windowstart = start
+        windowframes = 0
+        windowlate = 0
+        ontime = 0
+        i = 0
+        try:
+            while not stopping.is_set():
+                transmit(self.frames[i])
+                i += 1
+                if i == self.levels:
+                    i = 0
+                windowframes += 1
+                deadline += interval
+                current = now()
+                remaining = deadline - current
+                if remaining > 0:
+                    wait(remaining)
+                else:
+                    windowlate += 1
+                    if remaining < -interval:
+                        # more than a frame behind: do not try to
+                        # catch up, which would send a burst of frames
+                        deadline = current
+                        self.skipped += 1
+
+                if current - windowstart >= window:
+                    self.achieved = windowframes / (current - windowstart)
+                    self.frames_sent += windowframes
+                    self.late += windowlate
+                    if self.achieved < self.rate * slow and self.rate > minrate:
+                        # the device cannot keep up
+                        self.rate = max(minrate, self.achieved * slow)
+                        self.lowered += 1
+                        ontime = 0
+                    elif windowlate == 0:
+                        ontime += 1
+                        if ontime >= recover and self.rate < self.requestedrate:
+                            self.rate = min(self.requestedrate, self.rate * step)
+                            ontime = 0
+                    else:
+                        ontime = 0
+                    interval = 1.0 / self.rate
+                    windowstart = current
+                    windowframes = 0
+                    windowlate = 0
+                if end is not None and current >= end:
+                    break
+        finally:
+            self.frames_sent += windowframes
+            self.late += windowlate
+            # bring back the state of the iBuddy itself
+            transmit(self.ibuddy.command)
+
+    def start(self):
+        # run in a separate thread
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+# Recording and replaying of what is sent to the iBuddy.
+#
+# A recording is a compact binary file: a 4 byte header (b'IBR1'), followed
+# by records of 5 bytes each:
+#
+# * delay in microseconds since the previous record (unsigned 32 bits,
+#   little endian), or since the start of the recording for the first record
+# * the state byte that was sent to the device (see py3buddy.py for the
+#   meaning of the bits)
+#
+# A reset is recorded as state 0xff, as that is what the reset message sends.
+#
+# Random effects (such as panic) can be compiled in advance with a seed, so
+# the same sequence can be played back again and playback does not need to
+# make any decisions per frame.
+#
+# Copyright 2017-2019 - Armijn Hemel for Tjaldur Software Governance Solutions
+# SPDX-Identifier: MIT
+
+import sys
+import os
+import argparse
+import configparser
+import mmap
+import struct
+import time
+import py3buddy
+import py3buddyeffects
+
+# the header of a recording
+recordingheader = b'IBR1'
+
+# the format of a single record
+recordformat = struct.Struct('<IB')
+
+# the maximum delay that fits in a single record, in microseconds
+maxdelay = 0xffffffff
+
+
+class Recorder:
+    # record all states sent to the iBuddy into a file object (opened in
+    # binary mode). Assign it to an iBuddy to start recording:
+    #
+    # ibuddy.recorder = Recorder(open('recording.ibr', 'wb'))
+    def __init__(self, outfile):
+        self.outfile = outfile
+        self.outfile.write(recordingheader)
+        self.last = time.monotonic()
+        self.laststate = 0xff
+        self.frames = 0
+
+    def record(self, state, now=None):
+        if now is None:
+            now = time.monotonic()
+        delay = int((now - self.last) * 1000000)
+        self.last = now
+        # very long pauses are split over several records
+        # that repeat the previous state
+        while delay > maxdelay:
+            self.outfile.write(recordformat.pack(maxdelay, self.laststate))
+            delay -= maxdelay
+        self.outfile.write(recordformat.pack(delay, state))
+        self.laststate = state
+        self.frames += 1
+
+    def close(self):
+        self.outfile.close()
+
+
+def compileframes(frames):
+    # compile a list of (duration in seconds, state) tuples, where
+    # each state is shown for the duration, into a recording
+    recording = bytearray(recordingheader)
+    delay = 0
+    for (duration, state) in frames:
+        recording += recordformat.pack(delay, state)
+        delay = int(duration * 1000000)
+    # end with a reset after the last frame was shown
+    recording += recordformat.pack(delay, 0xff)
+    return bytes(recording)
+
+
+def compilepanic(paniccount, seed=None, duration=py3buddy.SHORTSLEEP):
+    # compile the panic demo (see py3buddydemo.py) into a recording. With
+    # the same seed the same recording is created.
+    (states, frameduration) = py3buddyeffects.panic(paniccount, seed, duration)
+    return compileframes(zip(frameduration, states))
+
+
+def iterrecording(data):
+    # iterate over the records in a recording (bytes, or a memoryview
+    # or mmap of a file), yielding (delay in seconds, state) tuples
+    if data[:len(recordingheader)] != recordingheader:
+        raise ValueError("not a py3buddy recording")
+    body = memoryview(data)[len(recordingheader):]
+    body = body[:len(body) - len(body) % recordformat.size]
+    for (delay, state) in recordformat.iter_unpack(body):
+        yield (delay / 1000000, state)
+
+
+def readrecording(path):
+    # iterate over the records of a recording in a file,
+    # which is memory mapped instead of read in completely
+    with open(path, 'rb') as recordingfile:
+        mapped = mmap.mmap(recordingfile.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        yield from iterrecording(mapped)
+    finally:
+        try:
+            mapped.close()
+        except BufferError:
+            # a memoryview is still referenced, it
+            # will be closed when collected
+            pass
+
+
+def replay(ibuddy, records, speed=1.0):
+    # play back a recording on the iBuddy. Records are scheduled relative
+    # to the start of the playback, so time spent sending frames does
+    # not add up over the recording.
+    start = time.monotonic()
+    target = 0.0
+    for (delay, state) in records:
+        target += delay / speed
+        wait = start + target - time.monotonic()
+        if wait > 0:
+            ibuddy.sleep(wait)
+        ibuddy.sendstate(state)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+
+    # options for the commandline
+    parser.add_argument("-c", "--config", action="store", dest="cfg",
+                        help="path to configuration file", metavar="FILE")
+    parser.add_argument("-p", "--play", action="store", dest="play",
+                        help="play recording", metavar="FILE")
+    parser.add_argument("--panic", action="store", dest="panic",
+                        help="compile panic demo into recording",
+                        metavar="FILE")
+    parser.add_argument("--count", action="store", dest="count", type=int,
+                        default=10, help="panic count (default 10)")
+    parser.add_argument("--seed", action="store", dest="seed", type=int,
+                        help="seed for random effects")
+    parser.add_argument("--speed", action="store", dest="speed", type=float,
+                        default=1.0, help="playback speed (default 1.0)")
+    args = parser.parse_args()
+
+    if args.panic is not None:
+        with open(args.panic, 'wb') as recordingfile:
+            recordingfile.write(compilepanic(args.count, args.seed))
+        if args.play is None:
+            return
+
+    if args.play is None:
+        parser.error("Nothing to do")
+
+    if not os.path.exists(args.play):
+        parser.error("Recording does not exist")
+
+    # first some sanity checks for the configuration file
+    if args.cfg is None:
+        parser.error("Configuration file missing")
+
+    if not os.path.exists(args.cfg):
+        parser.error("Configuration file does not exist")
+
+    # then parse the configuration file
+    config = configparser.ConfigParser()
+
+    configfile = open(args.cfg, 'r')
+
+    try:
+        config.read_file(configfile)
+    except Exception as e:
+        print(f"Cannot read configuration file: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    buddy_config = {}
+    for section in config.sections():
+        if section == 'ibuddy':
+            buddy_config = py3buddy.parseconfig(config, section)
+
+    if buddy_config.get('transport', 'pyusb') not in ['pyusb', 'usbfs']:
+        print("Unknown transport, should be pyusb or usbfs", file=sys.stderr)
+        sys.exit(1)
+
+    # initialize an iBuddy and check if a device was found and is accessible
+    try:
+        ibuddy = py3buddy.iBuddy(buddy_config)
+    except ValueError as e:
+        print(f"Cannot use iBuddy: {e}", file=sys.stderr)
+        sys.exit(1)
+    if ibuddy.dev is None:
+        print("No iBuddy found, or iBuddy not accessible", file=sys.stderr)
+        sys.exit(1)
+
+    ibuddy.reset()
+    try:
+        replay(ibuddy, readrecording(args.play), args.speed)
+    except ValueError as e:
+        print(f"Cannot play recording: {e}", file=sys.stderr)
+        sys.exit(1)
+    ibuddy.reset()
+    ibuddy.close()
+
+if __name__ == "__main__":
+    main(sys.argv)
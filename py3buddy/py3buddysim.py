@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+# A simulated iBuddy, which behaves like the pyusb device of an iBuddy as far
+# as py3buddy uses it. It can be used to run py3buddy without a device, for
+# example for benchmarks and tests:
+#
+# sim = py3buddysim.SimulatedDevice()
+# ibuddy = py3buddy.iBuddy({}, find=sim.find)
+#
+# The simulated device keeps track of the state it was sent and can
+# simulate the latency of USB transfers, disconnects and USB errors. Faults
+# can also be injected at random (see injectfaults()), for soak tests (see
+# py3buddysoak.py).
+#
+# Copyright 2017-2019 - Armijn Hemel for Tjaldur Software Governance Solutions
+# SPDX-Identifier: MIT
+
+import errno
+import random
+import time
+import usb.core
+import py3buddy
+
+# USB errors that can be simulated, with the libusb error
+# code and the errno that pyusb would use
+simulatederrors = {
+    'disconnected': (-4, errno.ENODEV, 'No such device (it may have been disconnected)'),
+    'busy': (-6, errno.EBUSY, 'Resource busy'),
+    'timeout': (-7, errno.ETIMEDOUT, 'Operation timed out'),
+    'pipe': (-9, errno.EPIPE, 'Pipe error'),
+    'io': (-1, errno.EIO, 'Input/Output Error'),
+    'access': (-3, errno.EACCES, 'Access denied (insufficient permissions)'),
+}
+
+
+def makeerror(kind):
+    (backend_error_code, errorno, message) = simulatederrors[kind]
+    return usb.core.USBError(message, backend_error_code, errorno)
+
+
+class SimulatedDevice:
+    def __init__(self, productid=0x0001, latency=0.0, keepmessages=False):
+        self.idVendor = 0x1130
+        self.idProduct = productid
+        self.bus = 1
+        self.address = 2
+        self.port_numbers = (1,)
+
+        # simulated latency of a single transfer, in seconds
+        self.latency = latency
+        self.connected = True
+
+        # the state of the device, as the last state byte that was sent
+        self.state = 0xff
+        self.transfers = 0
+        self.messages = None
+        if keepmessages:
+            self.messages = []
+
+        # errors that will be raised by the next transfers
+        self.pendingerrors = []
+
+        # random faults, see injectfaults()
+        self.random = random.Random()
+        self.errorrate = 0.0
+        self.errorkinds = ['timeout', 'pipe', 'io']
+        self.spikerate = 0.0
+        self.spikelatency = 0.0
+        self.faults = {'errors': 0, 'spikes': 0}
+
+        # the configuration and the interfaces that were claimed. If
+        # 'busy' is set another process is simulated to use the device.
+        self.configuration = None
+        self.claimed = set()
+        self.busy = False
+        self.kerneldrivers = set()
+
+        # pyusb claims and releases interfaces through the context of a
+        # device (see usb.util.claim_interface())
+        self._ctx = self
+
+    def find(self, **kwargs):
+        # replacement for usb.core.find()
+        if not self.connected:
+            return None
+        if kwargs.get('idVendor', self.idVendor) != self.idVendor:
+            return None
+        if kwargs.get('idProduct', self.idProduct) != self.idProduct:
+            return None
+        return self
+
+    def disconnect(self):
+        self.connected = False
+
+    def connect(self):
+        # a device that is plugged in again starts without a state
+        self.connected = True
+        self.state = 0xff
+
+    def failnext(self, kind, count=1):
+        # let the next 'count' transfers fail with an error
+        for i in range(count):
+            self.pendingerrors.append(makeerror(kind))
+
+    def injectfaults(self, errorrate=0.0, spikerate=0.0, spikelatency=0.0,
+                     errorkinds=None, seed=None):
+        # let a fraction of the transfers fail with a random error
+        # (one of 'errorkinds'), and let a fraction of the transfers
+        # take 'spikelatency' seconds longer
+        self.errorrate = errorrate
+        self.spikerate = spikerate
+        self.spikelatency = spikelatency
+        if errorkinds is not None:
+            self.errorkinds = errorkinds
+        if seed is not None:
+            self.random.seed(seed)
+
+    def is_kernel_driver_active(self, interface):
+        if not self.connected:
+            raise makeerror('disconnected')
+        return interface in self.kerneldrivers
+
+    def detach_kernel_driver(self, interface):
+        self.kerneldrivers.discard(interface)
+
+    def attach_kernel_driver(self, interface):
+        self.kerneldrivers.add(interface)
+
+    def get_active_configuration(self):
+        if self.configuration is None:
+            raise usb.core.USBError('Configuration not set')
+        return self.configuration
+
+    def set_configuration(self, configuration=None):
+        if self.busy:
+            raise makeerror('busy')
+        self.configuration = 1
+
+    def managed_claim_interface(self, device, interface):
+        if self.busy:
+            raise makeerror('busy')
+        self.claimed.add(interface)
+
+    def managed_release_interface(self, device, interface):
+        self.claimed.discard(interface)
+
+    def dispose(self, device, close_handle=True):
+        self.claimed = set()
+
+    def ctrl_transfer(self, bmRequestType, bRequest, wValue=0, wIndex=0,
+                      data_or_wLength=None, timeout=None):
+        if not self.connected:
+            raise makeerror('disconnected')
+        if self.pendingerrors:
+            raise self.pendingerrors.pop(0)
+        if self.errorrate and self.random.random() < self.errorrate:
+            self.faults['errors'] += 1
+            raise makeerror(self.random.choice(self.errorkinds))
+        if self.spikerate and self.random.random() < self.spikerate:
+            self.faults['spikes'] += 1
+            time.sleep(self.spikelatency)
+        if self.latency:
+            time.sleep(self.latency)
+        data = data_or_wLength
+        if len(data) == len(py3buddy.messagebytes) + 1 and data[0] == py3buddy.messagebytes[0]:
+            self.state = data[-1]
+        if self.messages is not None:
+            self.messages.append(bytes(data))
+        self.transfers += 1
+        return len(data)
@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+
+# A soak test for long running programs: the player of the DBus service
+# (py3buddydbus.py) and the earthquake monitor (py3buddyearthquake.py) are
+# driven by synthetic events for hours, in accelerated time, on a simulated
+# device (see py3buddysim.py) while faults are injected:
+#
+# * USB errors in a fraction of the transfers
+# * latency spikes in a fraction of the transfers
+# * disconnects of the device (it is plugged in again a bit later)
+# * restarts of the service: the player is stopped and the device released,
+#   then a new iBuddy and player are started, as a restarted DBus service
+#   would. Commands that are sent during a restart are lost, like DBus calls
+#   of clients that ignore errors.
+#
+# The events are generated by:
+#
+# * a chat client that sends smileys in bursts (like py3buddypidgindbus.py)
+# * a status client that sends a colour every few seconds
+# * quakes that are written to a local text feed, which is rotated now and
+#   then, and a monitor that polls the feed and sends panics with a priority
+#   (like py3buddyearthquakedbus.py)
+#
+# Every few seconds a sample is taken with the throughput, the latency
+# percentiles of commands (submitted to finished), the resident memory, the
+# amount of threads and open files and the size of the bookkeeping that
+# grows with the amount of events (quakes that were seen, clients of the
+# player). If commands are waiting but none finish for a while the soak test
+# reports a stall. At the end the growth of the resident memory is reported.
+#
+# Times in the configuration and the latencies are in simulated seconds: with
+# an acceleration of 60 an hour of soaking covers 60 hours of events. USB
+# latency spikes and disconnects are not accelerated.
+#
+# $ python3 py3buddysoak.py -d 3600 -a 60 -o soak.jsonl
+#
+# The soak test exits with an error if there were stalls or if the resident
+# memory grew more than a threshold.
+#
+# Copyright 2017-2019 - Armijn Hemel for Tjaldur Software Governance Solutions
+# SPDX-Identifier: MIT
+
+import sys
+import os
+import argparse
+import json
+import random
+import resource
+import shutil
+import tempfile
+import threading
+import time
+import py3buddy
+import py3buddyfeeds
+import py3buddyplayer
+import py3buddysim
+
+# default duration of the soak test, in (real) seconds
+defaultduration = 3600
+
+# default acceleration of time
+defaultacceleration = 60
+
+# default time between samples, in (real) seconds
+defaultinterval = 10
+
+# if commands are waiting and none finished for this
+# many (real) seconds the player is considered stalled
+stalltimeout = 30
+
+# the command for a smiley (see py3buddypidgindbus.py)
+smilecommand = 'RED:HEART:WINGSHIGH:GO:SHORTSLEEP:YELLOW:NOHEART:WINGSLOW:GO:SHORTSLEEP:HEART:BLUE:WINGSHIGH:GO:SHORTSLEEP:PURPLE:NOHEART:WINGSLOW:GO:SHORTSLEEP:HEART:CYAN:WINGSHIGH:GO:SHORTSLEEP:WHITE:NOHEART:WINGSLOW:GO:SHORTSLEEP:RESET'
+
+# default rates of events and faults, times in simulated seconds
+defaultconfig = {'chat_interval': 300, 'chat_burst': 10, 'status_interval': 5,
+                 'quake_interval': 600, 'poll_interval': 60,
+                 'rotate_interval': 21600, 'min_magnitude': 2.5,
+                 'error_rate': 0.001, 'spike_rate': 0.001, 'spike_latency': 0.1,
+                 'disconnect_interval': 7200, 'disconnect_duration': 5,
+                 'restart_interval': 43200}
+
+
+def residentmemory():
+    # the resident memory of this process in bytes, or the
+    # maximum resident memory if the current one is unknown
+    try:
+        with open('/proc/self/statm', 'r') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def openfiles():
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return None
+
+
+def paniccommand(rng, paniccount):
+    # a panic as a single command (see py3buddyearthquakedbus.py)
+    cmds = []
+    for i in range(0, paniccount):
+        cmds.append("WINGSHIGH:HEART:%s:%s:GO:SHORTSLEEP" % (
+            rng.choice(py3buddy.allcolours_string), rng.choice(['LEFT', 'RIGHT', 'MIDDLE'])))
+        cmds.append("WINGSLOW:NOHEART:%s:%s:GO:SHORTSLEEP" % (
+            rng.choice(py3buddy.allcolours_string), rng.choice(['LEFT', 'RIGHT', 'MIDDLE'])))
+    cmds.append("RESET")
+    return ":".join(cmds)
+
+
+class Soak:
+    def __init__(self, config, acceleration=defaultacceleration, seed=None):
+        self.config = config
+        self.acceleration = acceleration
+        self.seed = seed
+        self.stopping = threading.Event()
+        self.threads = []
+
+        self.sim = py3buddysim.SimulatedDevice()
+        self.sim.injectfaults(config['error_rate'], config['spike_rate'],
+                              config['spike_latency'], seed=seed)
+
+        # the service: an iBuddy and a player, None during a restart
+        self.lock = threading.Lock()
+        self.ibuddy = None
+        self.player = None
+
+        # commands that were submitted and did not finish yet
+        self.outstanding = []
+        self.counters = {'submitted': 0, 'lost': 0, 'rejected': 0,
+                         'completed': 0, 'cancelled': 0, 'errors': 0, 'quakes': 0,
+                         'rotations': 0, 'disconnects': 0, 'restarts': 0,
+                         'stalls': 0}
+
+        # the local feed with quakes
+        self.feeddir = tempfile.mkdtemp(prefix='py3buddysoak')
+        self.feedpath = os.path.join(self.feeddir, 'quakes.txt')
+        open(self.feedpath, 'wb').close()
+        self.feed = py3buddyfeeds.FileFeed(self.feedpath, config['min_magnitude'])
+
+    def sleep(self, seconds):
+        # sleep in simulated seconds, returns True if the soak test stops
+        return self.stopping.wait(seconds / self.acceleration)
+
+    def random(self, offset):
+        # a random generator per thread, so runs with a seed can be repeated
+        if self.seed is None:
+            return random.Random()
+        return random.Random(self.seed + offset)
+
+    def startservice(self):
+        ibuddy = py3buddy.iBuddy({'tempo': self.acceleration}, find=self.sim.find)
+        player = py3buddyplayer.Player(ibuddy)
+        player.start()
+        with self.lock:
+            self.ibuddy = ibuddy
+            self.player = player
+
+    def stopservice(self):
+        with self.lock:
+            ibuddy = self.ibuddy
+            player = self.player
+            self.ibuddy = None
+            self.player = None
+        if player is None:
+            return
+        try:
+            player.shutdown()
+            ibuddy.reset()
+        except Exception:
+            pass
+        ibuddy.close()
+
+    def submit(self, client, cmd, priority=0):
+        with self.lock:
+            player = self.player
+            self.counters['submitted'] += 1
+        # clients ignore errors, such as a service that is not there
+        try:
+            playback = player.submit(cmd, priority, client=client)
+        except Exception:
+            with self.lock:
+                self.counters['lost'] += 1
+            return
+        with self.lock:
+            if playback is None:
+                self.counters['rejected'] += 1
+            else:
+                self.outstanding.append(playback)
+
+    def chat(self):
+        rng = self.random(1)
+        while not self.sleep(rng.expovariate(1 / self.config['chat_interval'])):
+            for i in range(rng.randint(1, self.config['chat_burst'])):
+                self.submit('py3buddypidgindbus.py', smilecommand)
+                if self.sleep(rng.expovariate(0.5)):
+                    return
+
+    def status(self):
+        rng = self.random(2)
+        while not self.sleep(self.config['status_interval']):
+            self.submit('status', "%s:GO" % rng.choice(py3buddy.allcolours_string))
+
+    def quakes(self):
+        # write quakes to the feed, and rotate it now and then
+        rng = self.random(3)
+        rotated = time.monotonic()
+        while not self.sleep(rng.expovariate(1 / self.config['quake_interval'])):
+            if (time.monotonic() - rotated) * self.acceleration >= self.config['rotate_interval']:
+                open(self.feedpath, 'wb').close()
+                rotated = time.monotonic()
+                self.counters['rotations'] += 1
+            with open(self.feedpath, 'a') as feedfile:
+                feedfile.write("%.1f magnitude #earthquake %d km from Somewhere\n" % (
+                    rng.uniform(1.0, 7.0), rng.randint(1, 500)))
+
+    def monitor(self):
+        # poll the feed and panic (see py3buddyearthquakedbus.py)
+        rng = self.random(4)
+        while not self.sleep(self.config['poll_interval']):
+            for quake in self.feed.fetch():
+                self.counters['quakes'] += 1
+                self.submit('py3buddyearthquakedbus.py',
+                            paniccommand(rng, int(quake.magnitude * 2)),
+                            int(quake.magnitude))
+
+    def disconnects(self):
+        rng = self.random(5)
+        while not self.sleep(rng.expovariate(1 / self.config['disconnect_interval'])):
+            self.sim.disconnect()
+            self.counters['disconnects'] += 1
+            # disconnects last the same in real time
+            self.stopping.wait(self.config['disconnect_duration'])
+            self.sim.connect()
+
+    def restarts(self):
+        while not self.sleep(self.config['restart_interval']):
+            self.stopservice()
+            self.counters['restarts'] += 1
+            self.startservice()
+
+    def start(self):
+        self.startservice()
+        for target in [self.chat, self.status, self.quakes, self.monitor,
+                       self.disconnects, self.restarts]:
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self.stopservice()
+        shutil.rmtree(self.feeddir, ignore_errors=True)
+
+    def sample(self, elapsed, interval):
+        # collect the commands that finished since the last sample
+        with self.lock:
+            done = [p for p in self.outstanding if p.done.is_set()]
+            self.outstanding = [p for p in self.outstanding if not p.done.is_set()]
+            waiting = len(self.outstanding)
+            oldest = None
+            if self.outstanding:
+                oldest = min([p.submitted for p in self.outstanding])
+            player = self.player
+        latencies = sorted([(p.finished - p.submitted) * self.acceleration for p in done])
+        completed = len([p for p in done if p.completed])
+        errors = len([p for p in done if p.error is not None])
+        cancelled = len([p for p in done if not p.completed and p.error is None
+                         and p.cancelled.is_set()])
+        self.counters['completed'] += completed
+        self.counters['errors'] += errors
+        self.counters['cancelled'] += cancelled
+
+        # a stall: commands are waiting, but nothing finished for a while
+        if not done and oldest is not None and time.monotonic() - oldest > stalltimeout:
+            self.counters['stalls'] += 1
+            print("Stall: %d commands waiting, nothing finished for %d seconds" % (
+                waiting, time.monotonic() - oldest), file=sys.stderr)
+
+        result = {'time': elapsed, 'simulated': elapsed * self.acceleration,
+                  'throughput': len(done) / interval, 'finished': len(done),
+                  'waiting': waiting, 'rss': residentmemory(),
+                  'threads': threading.active_count(), 'files': openfiles(),
+                  'seen': len(self.feed.seen), 'transfers': self.sim.transfers,
+                  'errors': self.sim.faults['errors'], 'spikes': self.sim.faults['spikes']}
+        if player is not None:
+            result['clients'] = len(player.clients)
+        if latencies:
+            result['latency_p50'] = py3buddyplayer.percentile(latencies, 0.5)
+            result['latency_p90'] = py3buddyplayer.percentile(latencies, 0.9)
+            result['latency_p99'] = py3buddyplayer.percentile(latencies, 0.99)
+            result['latency_max'] = latencies[-1]
+        result.update(self.counters)
+        return result
+
+
+def rssgrowth(samples):
+    # the growth of the resident memory: the mean of the last quarter of
+    # the samples minus the mean of the second quarter (the first quarter
+    # is the warmup), in bytes
+    if len(samples) < 8:
+        return 0
+    quarter = len(samples) // 4
+    early = [s['rss'] for s in samples[quarter:2 * quarter]]
+    late = [s['rss'] for s in samples[-quarter:]]
+    return sum(late) / len(late) - sum(early) / len(early)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--duration", action="store", dest="duration",
+                        type=float, default=defaultduration,
+                        help="duration in seconds (default %d)" % defaultduration)
+    parser.add_argument("-a", "--acceleration", action="store", dest="acceleration",
+                        type=float, default=defaultacceleration,
+                        help="acceleration of time (default %d)" % defaultacceleration)
+    parser.add_argument("-i", "--interval", action="store", dest="interval",
+                        type=float, default=defaultinterval,
+                        help="seconds between samples (default %d)" % defaultinterval)
+    parser.add_argument("-o", "--output", action="store", dest="output",
+                        help="write samples as JSON lines to FILE", metavar="FILE")
+    parser.add_argument("-s", "--seed", action="store", dest="seed", type=int,
+                        help="seed for the events and faults")
+    parser.add_argument("-m", "--max-rss-growth", action="store", dest="maxgrowth",
+                        type=float, default=10,
+                        help="maximum growth of resident memory in MiB (default 10)")
+    parser.add_argument("-e", "--error-rate", action="store", dest="error_rate", type=float,
+                        help="fraction of USB transfers that fail (default %s)" % defaultconfig['error_rate'])
+    parser.add_argument("--spike-rate", action="store", dest="spike_rate", type=float,
+                        help="fraction of USB transfers with a latency spike (default %s)" % defaultconfig['spike_rate'])
+    parser.add_argument("--spike-latency", action="store", dest="spike_latency", type=float,
+                        help="latency of spikes in seconds (default %s)" % defaultconfig['spike_latency'])
+    parser.add_argument("--disconnect-interval", action="store", dest="disconnect_interval", type=float,
+                        help="mean simulated seconds between disconnects (default %d)" % defaultconfig['disconnect_interval'])
+    parser.add_argument("--restart-interval", action="store", dest="restart_interval", type=float,
+                        help="simulated seconds between restarts of the service (default %d)" % defaultconfig['restart_interval'])
+    parser.add_argument("--chat-interval", action="store", dest="chat_interval", type=float,
+                        help="mean simulated seconds between bursts of smileys (default %d)" % defaultconfig['chat_interval'])
+    parser.add_argument("--quake-interval", action="store", dest="quake_interval", type=float,
+                        help="mean simulated seconds between quakes (default %d)" % defaultconfig['quake_interval'])
+    args = parser.parse_args()
+
+    if args.duration <= 0 or args.interval <= 0:
+        parser.error("Duration and interval should be positive")
+    if args.acceleration <= 0:
+        parser.error("Acceleration should be positive")
+
+    config = dict(defaultconfig)
+    for name in ['error_rate', 'spike_rate', 'spike_latency', 'disconnect_interval',
+                 'restart_interval', 'chat_interval', 'quake_interval']:
+        value = getattr(args, name)
+        if value is None:
+            continue
+        if value < 0 or (value == 0 and name.endswith('_interval')):
+            parser.error("Invalid value for %s" % name.replace('_', '-'))
+        config[name] = value
+
+    outfile = None
+    if args.output is not None:
+        outfile = open(args.output, 'w')
+
+    soak = Soak(config, args.acceleration, args.seed)
+    soak.start()
+    samples = []
+    start = time.monotonic()
+    try:
+        while time.monotonic() - start < args.duration:
+            time.sleep(min(args.interval, max(0, args.duration - (time.monotonic() - start))))
+            sample = soak.sample(time.monotonic() - start, args.interval)
+            samples.append(sample)
+            if outfile is not None:
+                outfile.write(json.dumps(sample) + '\n')
+                outfile.flush()
+            print("%7.0fs (%8.0fs simulated) %7.1f cmd/s p99 %7.3fs rss %6.1f MiB threads %d" % (
+                sample['time'], sample['simulated'], sample['throughput'],
+                sample.get('latency_p99', 0), sample['rss'] / 1048576, sample['threads']))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        soak.stop()
+        if outfile is not None:
+            outfile.close()
+
+    growth = rssgrowth(samples) / 1048576
+    counters = soak.counters
+    print("\nsubmitted: %(submitted)d, completed: %(completed)d, cancelled: %(cancelled)d, "
+          "errors: %(errors)d, rejected: %(rejected)d, lost: %(lost)d" % counters)
+    print("quakes: %(quakes)d, rotations: %(rotations)d, disconnects: %(disconnects)d, "
+          "restarts: %(restarts)d, stalls: %(stalls)d" % counters)
+    print("USB errors injected: %d, latency spikes: %d" % (soak.sim.faults['errors'], soak.sim.faults['spikes']))
+    print("growth of resident memory: %.2f MiB" % growth)
+    if counters['stalls'] or growth > args.maxgrowth:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+# A live state page: the DBus service (py3buddydbus.py) publishes what the
+# iBuddy is doing in a small memory mapped file, so local programs (such as
+# dashboards) can see the state of the device as often as they want, without
+# any system calls or DBus calls.
+#
+# The page starts with a header (b'IBS1' and a sequence number), followed by:
+#
+# * the last state byte that was sent to the device (see py3buddy.py for
+#   the meaning of the bits)
+# * the amount of commands waiting in the queue
+# * the id of the command that is playing (0 if none)
+# * the time of the update (seconds since the epoch)
+#
+# Updates use a seqlock: the sequence number is odd while the page is being
+# written. A reader reads the sequence number, then the page, then the
+# sequence number again, and tries again if the sequence number changed or
+# was odd. The sequence number wraps around at 2**32. All numbers are little
+# endian.
+#
+# This file can also be run to show the state page:
+#
+# $ python3 py3buddystatepage.py -f /dev/shm/py3buddy-state -w
+#
+# Copyright 2017-2019 - Armijn Hemel for Tjaldur Software Governance Solutions
+# SPDX-Identifier: MIT
+
+import sys
+import os
+import argparse
+import mmap
+import struct
+import tempfile
+import threading
+import time
+import py3buddy
+
+# the header of a state page
+stateheader = b'IBS1'
+
+# the layout of the page: header and sequence number, then the state
+headerformat = struct.Struct('<4sI')
+seqformat = struct.Struct('<I')
+seqoffset = len(stateheader)
+bodyformat = struct.Struct('<BxxxIQd')
+bodyoffset = headerformat.size
+
+# the default path of the state page
+defaultpath = '/dev/shm/py3buddy-state'
+
+
+class StatePage:
+    # the writer of a state page, there should only be one per page
+    def __init__(self, path=defaultpath):
+        self.path = path
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.state = 0xff
+        self.queuedepth = 0
+        self.playing = 0
+
+        # write to a new file, which replaces an old page at once, so
+        # readers that still have the old page mapped are not confused.
+        # The new file gets a name that cannot be predicted and is created
+        # exclusively, as the directory (/dev/shm) is usually shared.
+        (fd, tmppath) = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                         prefix='%s.%d.%d.' % (os.path.basename(path), os.getuid(), os.getpid()))
+        try:
+            try:
+                os.fchmod(fd, 0o644)
+                os.ftruncate(fd, mmap.PAGESIZE)
+                self.page = mmap.mmap(fd, mmap.PAGESIZE)
+            finally:
+                os.close(fd)
+            headerformat.pack_into(self.page, 0, stateheader, self.seq)
+            self.write()
+            os.replace(tmppath, path)
+        except:
+            try:
+                os.unlink(tmppath)
+            except OSError:
+                pass
+            raise
+
+    def write(self):
+        # write the page: the sequence number is odd while writing
+        self.seq = (self.seq + 1) & 0xffffffff
+        seqformat.pack_into(self.page, seqoffset, self.seq)
+        bodyformat.pack_into(self.page, bodyoffset, self.state, self.queuedepth,
+                             self.playing, time.time())
+        self.seq = (self.seq + 1) & 0xffffffff
+        seqformat.pack_into(self.page, seqoffset, self.seq)
+
+    def publish(self, state=None, queuedepth=None, playing=None):
+        # update one or more of the fields
+        with self.lock:
+            if state is not None:
+                self.state = state
+            if queuedepth is not None:
+                self.queuedepth = queuedepth
+            if playing is not None:
+                self.playing = playing
+            self.write()
+
+    def close(self):
+        # remove the page, readers can keep using
+        # the last version they have mapped
+        with self.lock:
+            self.page.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+class StatePageReader:
+    def __init__(self, path=defaultpath):
+        with open(path, 'rb') as pagefile:
+            self.page = mmap.mmap(pagefile.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.page[:len(stateheader)] != stateheader:
+            self.page.close()
+            raise ValueError("not a py3buddy state page")
+
+    def read(self):
+        # a consistent copy of the page as a dictionary
+        # with the sequence number and all the fields
+        while True:
+            (before,) = seqformat.unpack_from(self.page, seqoffset)
+            if before & 1:
+                continue
+            (state, queuedepth, playing, updated) = bodyformat.unpack_from(self.page, bodyoffset)
+            (after,) = seqformat.unpack_from(self.page, seqoffset)
+            if before == after:
+                return {'seq': before, 'state': state, 'queuedepth': queuedepth,
+                        'playing': playing, 'updated': updated}
+
+    def close(self):
+        self.page.close()
+
+
+def describe(state):
+    # a human readable description of a state byte
+    buddystate = py3buddy.buddystates[state]
+    return "heart: %s, colour: %s, wings: %s, position: %s" % (
+        'on' if buddystate.heart else 'off', buddystate.colour.name,
+        buddystate.wings or 'neutral', buddystate.position)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-f", "--file", action="store", dest="path",
+                        default=defaultpath,
+                        help="path to state page (default %s)" % defaultpath,
+                        metavar="FILE")
+    parser.add_argument("-w", "--watch", action="store_true", dest="watch",
+                        help="keep showing changes")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.path):
+        parser.error("State page does not exist")
+
+    try:
+        reader = StatePageReader(args.path)
+    except (OSError, ValueError) as e:
+        print(f"Cannot read state page: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    lastseq = None
+    try:
+        while True:
+            page = reader.read()
+            if page['seq'] != lastseq:
+                print("%s state: 0x%02x (%s), queue: %d, playing: %d" % (
+                    time.strftime('%H:%M:%S', time.localtime(page['updated'])),
+                    page['state'], describe(page['state']), page['queuedepth'],
+                    page['playing']))
+                lastseq = page['seq']
+            if not args.watch:
+                break
+            time.sleep(0.05)
+    except KeyboardInterrupt:
+        pass
+    reader.close()
+
+if __name__ == "__main__":
+    main(sys.argv)
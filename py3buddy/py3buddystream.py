@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+
+# Stream commands to the iBuddy from stdin or a named pipe (FIFO), so shell
+# pipelines and log processors can drive the device without starting a new
+# process (and searching for the device) for every event:
+#
+# $ tail -f events.log | my-filter | python3 py3buddystream.py -c py3buddy.config
+#
+# $ mkfifo /tmp/ibuddy
+# $ python3 py3buddystream.py -c py3buddy.config -i /tmp/ibuddy &
+# $ echo "RED:HEART:GO:250MS:RESET" > /tmp/ibuddy
+#
+# Every line is a command in the macro language (see doc/macro-language.txt).
+# Empty lines and lines starting with '#' are ignored. With --binary the
+# input consists of records as used in recordings (see py3buddyrecord.py):
+# a delay in microseconds since the previous record and a state byte. A
+# recording can be streamed as is, as its header is skipped.
+#
+# Input is read by a separate thread into a bounded queue. If the queue is
+# full reading stops, so writers to the pipe block until the iBuddy has
+# caught up (backpressure). With --drop input is dropped instead, so
+# writers never block.
+#
+# A named pipe is opened again when the last writer closes it, so the
+# stream keeps running until it is interrupted.
+#
+# Copyright 2017-2019 - Armijn Hemel for Tjaldur Software Governance Solutions
+# SPDX-Identifier: MIT
+
+import sys
+import os
+import argparse
+import configparser
+import queue
+import stat
+import threading
+import time
+import py3buddy
+import py3buddyrecord
+
+# the default amount of chunks of input in the queue
+defaultqueuesize = 64
+
+# the maximum amount of bytes read at once
+chunksize = 65536
+
+
+class Stream:
+    def __init__(self, ibuddy, binary=False, queuesize=defaultqueuesize,
+                 drop=False):
+        self.ibuddy = ibuddy
+        self.binary = binary
+        self.drop = drop
+        self.queue = queue.Queue(queuesize)
+        self.stats = {'lines': 0, 'invalid': 0, 'frames': 0, 'dropped': 0}
+
+    def put(self, items):
+        # queue a batch of lines or records, blocking if
+        # the queue is full unless input should be dropped
+        if not self.drop:
+            self.queue.put(items)
+            return
+        try:
+            self.queue.put_nowait(items)
+        except queue.Full:
+            self.stats['dropped'] += len(items)
+
+    def read(self, infile):
+        # read input from a binary file until the end, in chunks,
+        # and queue complete lines or records
+        remainder = b''
+        first = True
+        while True:
+            chunk = infile.read1(chunksize)
+            if not chunk:
+                break
+            data = remainder + chunk
+            if self.binary:
+                if first:
+                    if len(data) < len(py3buddyrecord.recordingheader) and py3buddyrecord.recordingheader.startswith(data):
+                        remainder = data
+                        continue
+                    if data.startswith(py3buddyrecord.recordingheader):
+                        data = data[len(py3buddyrecord.recordingheader):]
+                    first = False
+                end = len(data) - len(data) % py3buddyrecord.recordformat.size
+                if end:
+                    self.put(list(py3buddyrecord.recordformat.iter_unpack(data[:end])))
+                remainder = data[end:]
+            else:
+                lines = data.split(b'\n')
+                remainder = lines.pop()
+                if lines:
+                    self.put(lines)
+        if remainder and not self.binary:
+            self.put([remainder])
+
+    def reader(self, path):
+        # read stdin (path is None), a file or a named pipe. A named
+        # pipe is opened again after the last writer closed it.
+        try:
+            if path is None:
+                self.read(sys.stdin.buffer)
+                return
+            fifo = stat.S_ISFIFO(os.stat(path).st_mode)
+            while True:
+                with open(path, 'rb') as infile:
+                    self.read(infile)
+                if not fifo:
+                    return
+        finally:
+            self.queue.put(None)
+
+    def playlines(self, lines):
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith(b'#'):
+                continue
+            self.stats['lines'] += 1
+            if not self.ibuddy.executecommand(line.decode('ascii', 'replace')):
+                self.stats['invalid'] += 1
+
+    def playrecords(self, records, schedule):
+        # records are scheduled relative to the previous record, but
+        # if the input was late (for example because a writer was idle)
+        # the schedule starts again instead of catching up
+        tempo = self.ibuddy.tempo
+        for (delay, state) in records:
+            now = time.monotonic()
+            if schedule < now:
+                schedule = now
+            schedule += delay / 1000000 / tempo
+            wait = schedule - time.monotonic()
+            if wait > 0:
+                self.ibuddy.sleep(wait)
+            self.ibuddy.sendstate(state)
+            self.stats['frames'] += 1
+        return schedule
+
+    def run(self):
+        # play everything in the queue until the input ends
+        schedule = 0.0
+        while True:
+            items = self.queue.get()
+            if items is None:
+                return
+            if self.binary:
+                schedule = self.playrecords(items, schedule)
+            else:
+                self.playlines(items)
+
+    def start(self, path=None):
+        # start reading in a separate thread
+        thread = threading.Thread(target=self.reader, args=(path,), daemon=True)
+        thread.start()
+        return thread
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+
+    # options for the commandline
+    parser.add_argument("-c", "--config", action="store", dest="cfg",
+                        help="path to configuration file", metavar="FILE")
+    parser.add_argument("-i", "--input", action="store", dest="input",
+                        help="read from FILE or named pipe instead of stdin",
+                        metavar="FILE")
+    parser.add_argument("-b", "--binary", action="store_true", dest="binary",
+                        help="input consists of binary records instead of commands")
+    parser.add_argument("-q", "--queue", action="store", dest="queuesize",
+                        type=int, default=defaultqueuesize,
+                        help="maximum amount of chunks of input in the queue (default %d)" % defaultqueuesize)
+    parser.add_argument("-d", "--drop", action="store_true", dest="drop",
+                        help="drop input if the queue is full instead of blocking")
+    args = parser.parse_args()
+
+    # first some sanity checks for the configuration file
+    if args.cfg is None:
+        parser.error("Configuration file missing")
+
+    if not os.path.exists(args.cfg):
+        parser.error("Configuration file does not exist")
+
+    if args.input is not None and not os.path.exists(args.input):
+        parser.error("Input does not exist")
+
+    if args.queuesize < 1:
+        parser.error("Queue size should be at least 1")
+
+    # then parse the configuration file
+    config = configparser.ConfigParser()
+
+    configfile = open(args.cfg, 'r')
+
+    try:
+        config.read_file(configfile)
+    except Exception as e:
+        print(f"Cannot read configuration file: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    buddy_config = {}
+    for section in config.sections():
+        if section == 'ibuddy':
+            buddy_config = py3buddy.parseconfig(config, section)
+
+    if buddy_config.get('transport', 'pyusb') not in ['pyusb', 'usbfs']:
+        print("Unknown transport, should be pyusb or usbfs", file=sys.stderr)
+        sys.exit(1)
+
+    # initialize an iBuddy and check if a device was found and is accessible
+    try:
+        ibuddy = py3buddy.iBuddy(buddy_config)
+    except ValueError as e:
+        print(f"Cannot use iBuddy: {e}", file=sys.stderr)
+        sys.exit(1)
+    if ibuddy.dev is None:
+        print("No iBuddy found, or iBuddy not accessible", file=sys.stderr)
+        sys.exit(1)
+
+    stream = Stream(ibuddy, args.binary, args.queuesize, args.drop)
+    stream.start(args.input)
+    try:
+        stream.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        ibuddy.reset()
+        ibuddy.close()
+
+    print("lines: %(lines)d, invalid: %(invalid)d, frames: %(frames)d, dropped: %(dropped)d" % stream.stats,
+          file=sys.stderr)
+
+if __name__ == "__main__":
+    main(sys.argv)
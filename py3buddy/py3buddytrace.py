@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+# Tracing for the iBuddy: spans with timestamps for every token of a command
+# in the macro language, for USB transfers, resets and (in the DBus service)
+# for handling DBus calls and waiting in the queue. Spans are sent to a sink:
+#
+# * RingBufferSink: keeps the last spans in memory
+# * JsonLinesSink: writes every span as a line of JSON to a file
+# * ChromeTraceSink: writes every span to a file in the Chrome trace event
+#   format, which can be opened in chrome://tracing or Perfetto
+#
+# Tracing is only done if a Tracer is assigned to an iBuddy
+# (ibuddy.tracer = py3buddytrace.Tracer(sink)).
+#
+# Timestamps are taken from time.perf_counter(), which is monotonic.
+#
+# This file can also be run to summarize the time spent per category in a
+# JSON lines or Chrome trace file:
+#
+# $ python3 py3buddytrace.py trace.json
+#
+# Categories of spans:
+#
+# * command: a complete command in the macro language
+# * token: a single token of a command (the name of the span is the token)
+# * send: sending a state to the device (GO tokens, frames, animations)
+# * sleep: sleeping (sleep tokens, animations)
+# * reset: resets (RESET tokens, or resets outside of commands)
+# * usb: single USB control transfers, which are part of send and reset
+# * dbus: handling of DBus calls in the DBus service
+# * queue: time a command waited in the queue before being played
+#
+# Copyright 2017-2019 - Armijn Hemel for Tjaldur Software Governance Solutions
+# SPDX-Identifier: MIT
+
+import sys
+import os
+import argparse
+import collections
+import json
+import threading
+import time
+
+# the default size of the ring buffer
+defaultringsize = 10000
+
+
+class Tracer:
+    def __init__(self, sink):
+        self.sink = sink
+        self.pid = os.getpid()
+
+    # the clock used for the spans
+    now = staticmethod(time.perf_counter)
+
+    def span(self, name, category, start, end, args=None):
+        span = {'name': name, 'cat': category, 'start': start,
+                'end': end, 'tid': threading.get_ident()}
+        if args is not None:
+            span['args'] = args
+        self.sink.emit(span)
+
+    def close(self):
+        self.sink.close()
+
+
+class RingBufferSink:
+    # keep the last 'size' spans in memory
+    def __init__(self, size=defaultringsize):
+        self.spans = collections.deque(maxlen=size)
+
+    def emit(self, span):
+        self.spans.append(span)
+
+    def dump(self):
+        # all spans as JSON lines
+        return ''.join([json.dumps(span) + '\n' for span in list(self.spans)])
+
+    def close(self):
+        pass
+
+
+class JsonLinesSink:
+    def __init__(self, path):
+        self.outfile = open(path, 'a')
+        self.lock = threading.Lock()
+
+    def emit(self, span):
+        line = json.dumps(span) + '\n'
+        with self.lock:
+            self.outfile.write(line)
+
+    def close(self):
+        with self.lock:
+            self.outfile.close()
+
+
+class ChromeTraceSink:
+    # Spans are written as they are emitted, in the JSON array variant of
+    # the Chrome trace event format, so nothing is kept in memory. The
+    # closing bracket is written when the sink is closed, but it is
+    # optional in this format, so the file of a process that did not
+    # close the sink can still be opened.
+    def __init__(self, path):
+        self.path = path
+        self.pid = os.getpid()
+        self.outfile = open(path, 'w')
+        self.outfile.write('[')
+        self.separator = '\n'
+        self.lock = threading.Lock()
+
+    def emit(self, span):
+        # complete events, timestamps in microseconds
+        event = {'name': span['name'], 'cat': span['cat'], 'ph': 'X',
+                 'ts': span['start'] * 1000000,
+                 'dur': (span['end'] - span['start']) * 1000000,
+                 'pid': self.pid, 'tid': span['tid']}
+        if 'args' in span:
+            event['args'] = span['args']
+        line = self.separator + json.dumps(event)
+        with self.lock:
+            if self.outfile.closed:
+                return
+            self.outfile.write(line)
+            self.separator = ',\n'
+
+    def close(self):
+        with self.lock:
+            if self.outfile.closed:
+                return
+            self.outfile.write('\n]\n')
+            self.outfile.close()
+
+
+def readtrace(path):
+    # read spans from a JSON lines or Chrome trace file, as
+    # (name, category, duration in seconds) tuples
+    spans = []
+    with open(path, 'r') as infile:
+        data = infile.read().strip()
+    if data.startswith('{"traceEvents"') or data.startswith('['):
+        if data.startswith('[') and not data.endswith(']'):
+            # a trace that was not closed
+            data = data.rstrip(',') + ']'
+        trace = json.loads(data)
+        if isinstance(trace, dict):
+            trace = trace['traceEvents']
+        for event in trace:
+            if event.get('ph') != 'X':
+                continue
+            spans.append((event['name'], event.get('cat', ''), event['dur'] / 1000000))
+    else:
+        for line in data.splitlines():
+            if not line.strip():
+                continue
+            span = json.loads(line)
+            spans.append((span['name'], span['cat'], span['end'] - span['start']))
+    return spans
+
+
+def summarize(spans):
+    # the amount of spans and the total time per category,
+    # and per name within every category
+    categories = {}
+    for (name, category, duration) in spans:
+        if category not in categories:
+            categories[category] = {'count': 0, 'total': 0.0, 'names': {}}
+        categories[category]['count'] += 1
+        categories[category]['total'] += duration
+        names = categories[category]['names']
+        if name not in names:
+            names[name] = {'count': 0, 'total': 0.0}
+        names[name]['count'] += 1
+        names[name]['total'] += duration
+    return categories
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("trace", help="JSON lines or Chrome trace file",
+                        metavar="FILE")
+    parser.add_argument("-n", "--names", action="store_true", dest="names",
+                        help="also show the time per name")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.trace):
+        parser.error("Trace file does not exist")
+
+    try:
+        spans = readtrace(args.trace)
+    except (ValueError, KeyError) as e:
+        print(f"Cannot read trace file: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    categories = summarize(spans)
+    print("%-18s %8s %12s %12s" % ('category', 'count', 'total (s)', 'mean (ms)'))
+    for category in sorted(categories, key=lambda c: categories[c]['total'], reverse=True):
+        summary = categories[category]
+        print("%-18s %8d %12.4f %12.3f" % (category, summary['count'], summary['total'],
+                                           summary['total'] / summary['count'] * 1000))
+        if args.names:
+            names = summary['names']
+            for name in sorted(names, key=lambda n: names[n]['total'], reverse=True):
+                print("  %-16s %8d %12.4f %12.3f" % (name, names[name]['count'], names[name]['total'],
+                                                     names[name]['total'] / names[name]['count'] * 1000))
+    print("\nNote: spans are nested: commands contain tokens, tokens contain send, sleep")
+    print("and reset spans, which contain usb spans.")
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+# A transport for the iBuddy that talks to the device directly through the
+# usbfs interface of the Linux kernel (/dev/bus/usb/BBB/DDD) with ioctls,
+# instead of through pyusb and libusb. This saves the work that pyusb does
+# in Python for every transfer, which matters on small hosts that send a
+# lot of frames (or drive several devices).
+#
+# The device behaves like a pyusb device as far as py3buddy uses it, so it
+# can be used by passing find() to the iBuddy, or by setting 'transport' to
+# 'usbfs' in the configuration file:
+#
+# ibuddy = py3buddy.iBuddy(buddy_config, find=py3buddyusbfs.find)
+#
+# The request for a control transfer and the buffer for the data are
+# allocated once and reused for every transfer.
+#
+# This only works on Linux. The ioctl numbers are those of architectures
+# using the generic ioctl layout (such as x86 and ARM).
+#
+# Copyright 2017-2019 - Armijn Hemel for Tjaldur Software Governance Solutions
+# SPDX-Identifier: MIT
+
+import ctypes
+import errno
+import fcntl
+import os
+import struct
+import usb.core
+
+# directories with USB devices
+sysfsdevices = '/sys/bus/usb/devices'
+usbfsdevices = '/dev/bus/usb'
+
+# the layout of the ioctls (see linux/usbdevice_fs.h)
+ctrltransferformat = struct.Struct('@BBHHHIP')
+ifaceioctlformat = struct.Struct('@iiP')
+getdriverformat = struct.Struct('@I256s')
+uintformat = struct.Struct('@I')
+
+# ioctl directions
+IOC_WRITE = 1
+IOC_READ = 2
+
+
+def ioc(direction, number, size):
+    return (direction << 30) | (size << 16) | (ord('U') << 8) | number
+
+USBDEVFS_CONTROL = ioc(IOC_READ | IOC_WRITE, 0, ctrltransferformat.size)
+USBDEVFS_SETCONFIGURATION = ioc(IOC_READ, 5, uintformat.size)
+USBDEVFS_GETDRIVER = ioc(IOC_WRITE, 8, getdriverformat.size)
+USBDEVFS_CLAIMINTERFACE = ioc(IOC_READ, 15, uintformat.size)
+USBDEVFS_RELEASEINTERFACE = ioc(IOC_READ, 16, uintformat.size)
+USBDEVFS_IOCTL = ioc(IOC_READ | IOC_WRITE, 18, ifaceioctlformat.size)
+USBDEVFS_DISCONNECT = ioc(0, 22, 0)
+USBDEVFS_CONNECT = ioc(0, 23, 0)
+
+# the maximum size of the data of a control transfer
+maxdata = 64
+
+# default timeout of a transfer, in milliseconds
+defaulttimeout = 1000
+
+
+def usberror(error):
+    # turn an OSError into the error pyusb would raise, so
+    # errors are classified the same way (see classifyerror())
+    return usb.core.USBError(os.strerror(error.errno), None, error.errno)
+
+
+class UsbfsDevice:
+    def __init__(self, path, sysfspath, idVendor, idProduct, bus, address,
+                 ioctl=fcntl.ioctl):
+        self.path = path
+        self.sysfspath = sysfspath
+        self.idVendor = idVendor
+        self.idProduct = idProduct
+        self.bus = bus
+        self.address = address
+        self.ioctl = ioctl
+        self.fd = None
+
+        # the buffer for the data, and requests for control
+        # transfers, packed once per kind of transfer
+        self.data = bytearray(maxdata)
+        self.databuffer = (ctypes.c_char * maxdata).from_buffer(self.data)
+        self.dataaddress = ctypes.addressof(self.databuffer)
+        self.requests = {}
+
+        # claiming and releasing interfaces is done through the
+        # context of a device in pyusb (see usb.util.claim_interface())
+        self._ctx = self
+        self.claimed = set()
+
+    def fileno(self):
+        if self.fd is None:
+            try:
+                self.fd = os.open(self.path, os.O_RDWR)
+            except OSError as e:
+                raise usberror(e)
+        return self.fd
+
+    def ctrl_transfer(self, bmRequestType, bRequest, wValue=0, wIndex=0,
+                      data_or_wLength=None, timeout=None):
+        # only transfers from host to device (with data) are needed
+        length = len(data_or_wLength)
+        if length > maxdata:
+            raise ValueError("too much data for a single control transfer")
+        key = (bmRequestType, bRequest, wValue, wIndex, length, timeout)
+        request = self.requests.get(key)
+        if request is None:
+            if timeout is None:
+                timeout = defaulttimeout
+            request = bytearray(ctrltransferformat.pack(bmRequestType, bRequest, wValue, wIndex,
+                                                        length, timeout, self.dataaddress))
+            self.requests[key] = request
+        self.data[:length] = data_or_wLength
+        try:
+            return self.ioctl(self.fd if self.fd is not None else self.fileno(),
+                              USBDEVFS_CONTROL, request, True)
+        except OSError as e:
+            raise usberror(e)
+
+    def ifaceioctl(self, interface, code):
+        request = bytearray(ifaceioctlformat.pack(interface, code, 0))
+        try:
+            self.ioctl(self.fileno(), USBDEVFS_IOCTL, request, True)
+        except OSError as e:
+            raise usberror(e)
+
+    def is_kernel_driver_active(self, interface):
+        request = bytearray(getdriverformat.pack(interface, b''))
+        try:
+            self.ioctl(self.fileno(), USBDEVFS_GETDRIVER, request, True)
+        except OSError as e:
+            if e.errno == errno.ENODATA:
+                return False
+            raise usberror(e)
+        return True
+
+    def detach_kernel_driver(self, interface):
+        self.ifaceioctl(interface, USBDEVFS_DISCONNECT)
+
+    def attach_kernel_driver(self, interface):
+        self.ifaceioctl(interface, USBDEVFS_CONNECT)
+
+    def get_active_configuration(self):
+        try:
+            with open(os.path.join(self.sysfspath, 'bConfigurationValue'), 'r') as configfile:
+                configuration = configfile.read().strip()
+        except OSError as e:
+            raise usberror(e)
+        if not configuration:
+            raise usb.core.USBError('Configuration not set')
+        return int(configuration)
+
+    def set_configuration(self, configuration=1):
+        try:
+            self.ioctl(self.fileno(), USBDEVFS_SETCONFIGURATION,
+                       bytearray(uintformat.pack(configuration)), True)
+        except OSError as e:
+            raise usberror(e)
+
+    def managed_claim_interface(self, device, interface):
+        if interface in self.claimed:
+            return
+        try:
+            self.ioctl(self.fileno(), USBDEVFS_CLAIMINTERFACE,
+                       bytearray(uintformat.pack(interface)), True)
+        except OSError as e:
+            raise usberror(e)
+        self.claimed.add(interface)
+
+    def managed_release_interface(self, device, interface):
+        if interface not in self.claimed:
+            return
+        self.claimed.discard(interface)
+        try:
+            self.ioctl(self.fileno(), USBDEVFS_RELEASEINTERFACE,
+                       bytearray(uintformat.pack(interface)), True)
+        except OSError as e:
+            raise usberror(e)
+
+    def dispose(self, device, close_handle=True):
+        # closing the file releases all interfaces
+        self.claimed = set()
+        if self.fd is not None:
+            try:
+                os.close(self.fd)
+            except OSError:
+                pass
+            self.fd = None
+
+
+def readattribute(path, name, base=10):
+    try:
+        with open(os.path.join(path, name), 'r') as attributefile:
+            return int(attributefile.read().strip(), base)
+    except (OSError, ValueError):
+        return None
+
+
+def finddevice(sysfspath, idVendor=None, idProduct=None):
+    # a device for the device in sysfs, if it matches
+    vendor = readattribute(sysfspath, 'idVendor', 16)
+    product = readattribute(sysfspath, 'idProduct', 16)
+    if vendor is None or product is None:
+        return None
+    if idVendor is not None and vendor != idVendor:
+        return None
+    if idProduct is not None and product != idProduct:
+        return None
+    bus = readattribute(sysfspath, 'busnum')
+    address = readattribute(sysfspath, 'devnum')
+    if bus is None or address is None:
+        return None
+    path = os.path.join(usbfsdevices, '%03d' % bus, '%03d' % address)
+    return UsbfsDevice(path, sysfspath, vendor, product, bus, address)
+
+
+def find(idVendor=None, idProduct=None, sysfspath=None, **kwargs):
+    # replacement for usb.core.find(): search the USB devices in sysfs and
+    # return a device for the first device that matches, or None. If the
+    # path in sysfs where the device was found before is known it is tried
+    # first, which avoids reading the attributes of all USB devices.
+    if sysfspath is not None:
+        dev = finddevice(sysfspath, idVendor, idProduct)
+        if dev is not None:
+            return dev
+    try:
+        names = sorted(os.listdir(sysfsdevices))
+    except OSError:
+        return None
+    for name in names:
+        # skip interfaces (such as 1-1:1.0)
+        if ':' in name:
+            continue
+        dev = finddevice(os.path.join(sysfsdevices, name), idVendor, idProduct)
+        if dev is not None:
+            return dev
+    return None
@@ -0,0 +1,32 @@
+# Fixtures for the py3buddy tests, which run against a simulated iBuddy
+# (see py3buddysim.py), so no device is needed. pyusb is needed though,
+# tests are skipped if it is not installed.
+#
+# Copyright 2017-2019 - Armijn Hemel for Tjaldur Software Governance Solutions
+# SPDX-Identifier: MIT
+
+import sys
+import os
+import pytest
+
+# the py3buddy modules are not installed as a package,
+# so make sure they can be imported
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'py3buddy'))
+
+
+@pytest.fixture
+def sim():
+    pytest.importorskip('usb.core')
+    import py3buddysim
+    return py3buddysim.SimulatedDevice(keepmessages=True)
+
+
+@pytest.fixture
+def sentstates(sim):
+    # the state bytes that were sent to the simulated device (so
+    # without the setup messages)
+    import py3buddy
+
+    def states():
+        return [msg[-1] for msg in sim.messages if msg[0] == py3buddy.messagebytes[0]]
+    return states
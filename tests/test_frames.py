@@ -0,0 +1,68 @@
+# Tests for frames that are committed from several threads.
+#
+# Copyright 2017-2019 - Armijn Hemel for Tjaldur Software Governance Solutions
+# SPDX-Identifier: MIT
+
+import threading
+import time
+import pytest
+
+usb = pytest.importorskip('usb.core')
+import py3buddy
+
+
+def test_commits_are_coalesced(sim, sentstates):
+    sim.latency = 0.05
+    ibuddy = py3buddy.iBuddy({}, find=sim.find)
+
+    def red():
+        with ibuddy.frame() as frame:
+            frame.setcolour(py3buddy.RED)
+    thread = threading.Thread(target=red)
+    thread.start()
+    time.sleep(0.02)
+
+    # the first thread is sending, so these do not wait for the device
+    start = time.monotonic()
+    with ibuddy.frame() as frame:
+        frame.toggleheart(True)
+    with ibuddy.frame() as frame:
+        frame.wings('high')
+    assert time.monotonic() - start < 0.05
+    thread.join()
+
+    # the frame of the first thread, then both frames at once
+    assert sentstates() == [0xef, 0x67]
+    assert not ibuddy.pending
+
+
+def test_failed_commit_stays_pending(sim, sentstates):
+    ibuddy = py3buddy.iBuddy({'retries': 0}, find=sim.find)
+    sim.failnext('access')
+    with pytest.raises(usb.USBError):
+        with ibuddy.frame() as frame:
+            frame.setcolour(py3buddy.BLUE)
+    assert ibuddy.pending
+    assert sentstates() == []
+
+    ibuddy.flush()
+    assert not ibuddy.pending
+    assert sentstates() == [0xbf]
+
+
+def test_setters_and_frames_do_not_lose_updates(sim):
+    ibuddy = py3buddy.iBuddy({}, find=sim.find)
+    count = 2000
+
+    def heart():
+        for i in range(count):
+            ibuddy.toggleheart(i % 2 == 0)
+    thread = threading.Thread(target=heart)
+    thread.start()
+    for i in range(count):
+        with ibuddy.frame() as frame:
+            frame.wings('high' if i % 2 == 0 else 'low')
+    thread.join()
+    # the last update of both threads is kept
+    assert ibuddy.state.heart is False
+    assert ibuddy.state.wings == 'low'
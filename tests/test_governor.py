@@ -0,0 +1,50 @@
+# Tests for the duty cycle governor.
+#
+# Copyright 2017-2019 - Armijn Hemel for Tjaldur Software Governance Solutions
+# SPDX-Identifier: MIT
+
+import pytest
+
+usb = pytest.importorskip('usb.core')
+import py3buddy
+
+
+def test_resend_does_not_send_pending_changes(sim, sentstates):
+    # the heart may only be on for 50 ms, so the governor switches it
+    # off during the sleep, but RED is only sent with the second GO
+    ibuddy = py3buddy.iBuddy({'governor': True, 'governor_budgets': {'heart': 0.05}},
+                             find=sim.find)
+    ibuddy.executecommand('HEART:GO:RED:SHORTSLEEP:GO')
+    assert sentstates() == [0x7f, 0xff, 0xef]
+
+
+def test_leds_are_not_limited_by_default():
+    governor = py3buddy.Governor()
+    assert governor.filter(0x5f) == 0x5f
+    # long after the window the LEDs are still allowed
+    now = governor.onsince['head'] + 2 * governor.window
+    assert governor.allowed('head', now)
+    assert governor.allowed('heart', now)
+    assert governor.holdlimit() is None
+
+
+def test_wings_are_limited():
+    governor = py3buddy.Governor(budgets={'wings': 0.0})
+    assert governor.filter(0xfb) == 0xff
+    assert governor.blocked['wings'] == 1
+
+
+def test_old_interval_does_not_extend_the_budget():
+    # the wings were on from 0 to 3 and are switched on again at 9. The
+    # interval from 0 to 3 falls out of the window, but is not pruned as
+    # no frame is recorded after 9, and must not count as negative usage.
+    governor = py3buddy.Governor(window=10, budgets={'wings': 5})
+    governor.record(0xfb, 0)
+    governor.record(0xff, 3)
+    governor.record(0xfb, 9)
+    assert governor.usage('wings', 11) == 4.0
+    assert governor.allowed('wings', 11)
+    assert governor.usage('wings', 14) == 5.0
+    assert not governor.allowed('wings', 14)
+    assert governor.usage('wings', 30) == 10.0
+    assert not governor.allowed('wings', 30)
@@ -0,0 +1,70 @@
+# Tests for the metrics and their exposition format.
+#
+# Copyright 2017-2019 - Armijn Hemel for Tjaldur Software Governance Solutions
+# SPDX-Identifier: MIT
+
+import pytest
+
+import py3buddymetrics
+
+
+def samples(exposition):
+    # the sample lines of an exposition, without comments
+    return [line for line in exposition.splitlines() if not line.startswith('#')]
+
+
+def test_counters_and_histograms():
+    metrics = py3buddymetrics.Metrics(buckets=[0.01, 0.1])
+    metrics.inc('commands_total')
+    metrics.inc('commands_total', 2)
+    metrics.observe('command_seconds', 0.005)
+    metrics.observe('command_seconds', 0.05)
+    metrics.observe('command_seconds', 5)
+    exposition = metrics.exposition()
+    assert '# TYPE py3buddy_commands_total counter' in exposition
+    assert samples(exposition) == [
+        'py3buddy_commands_total 3',
+        'py3buddy_command_seconds_bucket{le="0.01"} 1',
+        'py3buddy_command_seconds_bucket{le="0.1"} 2',
+        'py3buddy_command_seconds_bucket{le="+Inf"} 3',
+        'py3buddy_command_seconds_sum 5.055',
+        'py3buddy_command_seconds_count 3']
+
+
+def test_collector_samples_are_grouped_and_escaped():
+    metrics = py3buddymetrics.Metrics()
+    metrics.addcollector(lambda: [
+        ('client_commands_total', 'counter', {'client': 'a"b\\c\nd'}, 1),
+        ('client_queued', 'gauge', {'client': 'a"b\\c\nd'}, 0),
+        ('client_commands_total', 'counter', {'client': 'e'}, 2),
+        ('client_queued', 'gauge', {'client': 'e'}, True)])
+    lines = metrics.exposition().splitlines()
+    assert lines == [
+        '# TYPE py3buddy_client_commands_total counter',
+        'py3buddy_client_commands_total{client="a\\"b\\\\c\\nd"} 1',
+        'py3buddy_client_commands_total{client="e"} 2',
+        '# TYPE py3buddy_client_queued gauge',
+        'py3buddy_client_queued{client="a\\"b\\\\c\\nd"} 0',
+        'py3buddy_client_queued{client="e"} 1']
+
+
+def test_client_collector(sim):
+    pytest.importorskip('usb.core')
+    import py3buddy
+    import py3buddyplayer
+    ibuddy = py3buddy.iBuddy({}, find=sim.find)
+    player = py3buddyplayer.Player(ibuddy)
+    player.start()
+    try:
+        player.submit('RED:GO', client='demo').wait(5)
+        player.submit('NOSUCHTOKEN', client='demo').wait(5)
+    finally:
+        player.shutdown()
+    metrics = py3buddymetrics.Metrics()
+    metrics.addcollector(py3buddymetrics.clientcollector(player))
+    exposition = metrics.exposition()
+    assert 'py3buddy_client_commands_total{client="demo"} 2' in exposition
+    assert 'py3buddy_client_invalid_total{client="demo"} 1' in exposition
+    assert 'py3buddy_client_cancelled_total{client="demo"} 0' in exposition
+    assert '# TYPE py3buddy_client_queue_wait_p99_seconds gauge' in exposition
+    assert 'quantile=' not in exposition
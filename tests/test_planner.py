@@ -0,0 +1,57 @@
+# Tests for the motion planner of the wiggle motor.
+#
+# Copyright 2017-2019 - Armijn Hemel for Tjaldur Software Governance Solutions
+# SPDX-Identifier: MIT
+
+import pytest
+
+usb = pytest.importorskip('usb.core')
+import py3buddy
+
+
+def test_middle_after_left_turns_right_first(sim, sentstates):
+    ibuddy = py3buddy.iBuddy({}, find=sim.find)
+    ibuddy.executecommand('LEFT:GO:MIDDLE:GO')
+    assert sentstates() == [0xfd, 0xfe, 0xfc]
+    assert ibuddy.pose == 'middle'
+
+
+def test_planner_can_be_disabled(sim, sentstates):
+    ibuddy = py3buddy.iBuddy({'motion_planner': False}, find=sim.find)
+    ibuddy.executecommand('LEFT:GO:MIDDLE:GO')
+    assert sentstates() == [0xfd, 0xfc]
+
+
+def test_no_plan_after_reconnect(sim, sentstates):
+    ibuddy = py3buddy.iBuddy({}, find=sim.find)
+    ibuddy.executecommand('RIGHT:GO:MIDDLE:GO')
+    del sim.messages[:]
+    assert ibuddy.reconnect()
+    ibuddy.executecommand('HEART:GO')
+    # only the state that is replayed after reconnecting, and the new state
+    assert sentstates() == [0xfc, 0x7c]
+
+
+def test_no_plan_after_idle_release(sim, sentstates):
+    ibuddy = py3buddy.iBuddy({}, find=sim.find)
+    ibuddy.executecommand('RIGHT:GO:MIDDLE:GO')
+    ibuddy.release()
+    del sim.messages[:]
+    ibuddy.executecommand('RED:GO')
+    assert sentstates() == [0xec]
+
+
+def test_reset_plan_goes_through_governor(sim, sentstates):
+    ibuddy = py3buddy.iBuddy({'reset_position': True, 'governor': True},
+                             find=sim.find)
+    ibuddy.reset()
+    assert sentstates() == [0xfe, 0xfc, 0xff]
+    assert ibuddy.governor.counters['frames'] == 2
+    assert ibuddy.pose == 'middle'
+
+
+def test_reset_leaves_unknown_pose_without_planner(sim, sentstates):
+    ibuddy = py3buddy.iBuddy({'reset_position': True, 'motion_planner': False},
+                             find=sim.find)
+    ibuddy.reset()
+    assert sentstates() == [0xff]
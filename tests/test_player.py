@@ -0,0 +1,100 @@
+# Tests for the player: priorities, preemption, stopping and the
+# statistics per client.
+#
+# Copyright 2017-2019 - Armijn Hemel for Tjaldur Software Governance Solutions
+# SPDX-Identifier: MIT
+
+import time
+import pytest
+
+usb = pytest.importorskip('usb.core')
+import py3buddy
+import py3buddyplayer
+
+
+@pytest.fixture
+def player(sim):
+    ibuddy = py3buddy.iBuddy({'retries': 0}, find=sim.find)
+    player = py3buddyplayer.Player(ibuddy)
+    player.start()
+    yield player
+    player.shutdown()
+
+
+def waitplaying(player, playback):
+    # wait until the player started playing 'playback'
+    deadline = time.monotonic() + 5
+    while player.current is not playback:
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def test_higher_priority_preempts(player, sim):
+    slow = player.submit('RED:GO:GLACIAL', client='slow')
+    waitplaying(player, slow)
+    alert = player.submit('BLUE:GO', priority=5, client='alert')
+    assert alert.wait(5)
+    assert slow.wait(5)
+    assert alert.completed
+    assert not slow.completed
+    assert slow.cancelled.is_set()
+    stats = player.clientstats()
+    assert stats['slow']['cancelled'] == 1
+    assert stats['slow']['completed'] == 0
+    assert stats['alert']['completed'] == 1
+    # the player resets after every command
+    assert sim.state == 0xff
+
+
+def test_same_priority_does_not_preempt(player):
+    first = player.submit('RED:GO:50MS', client='a')
+    waitplaying(player, first)
+    second = player.submit('BLUE:GO', client='b')
+    assert second.wait(5)
+    assert first.completed
+    assert second.completed
+
+
+def test_stop_cancels_everything(player, sim):
+    playing = player.submit('RED:GO:GLACIAL', client='a')
+    waitplaying(player, playing)
+    queued = [player.submit('BLUE:GO', client='a') for i in range(3)]
+    player.stop()
+    for playback in [playing] + queued:
+        assert playback.wait(5)
+        assert not playback.completed
+    assert player.queuedepth() == 0
+    stats = player.clientstats()['a']
+    assert stats['cancelled'] == 4
+    assert stats['queued'] == 0
+    assert sim.state == 0xff
+
+
+def test_errors_and_invalid_commands_are_not_cancelled(player, sim):
+    invalid = player.submit('RED:NOSUCHTOKEN:GO', client='a')
+    assert invalid.wait(5)
+    assert invalid.invalid
+    sim.disconnect()
+    failed = player.submit('RED:GO', client='a')
+    assert failed.wait(5)
+    assert failed.error is not None
+    sim.connect()
+    ok = player.submit('GREEN:GO', client='a')
+    assert ok.wait(5)
+    assert ok.completed
+    stats = player.clientstats()['a']
+    assert stats['invalid'] == 1
+    assert stats['errors'] == 1
+    assert stats['completed'] == 1
+    assert stats['cancelled'] == 0
+
+
+def test_quota(sim):
+    ibuddy = py3buddy.iBuddy({}, find=sim.find)
+    # not started, so everything stays queued
+    player = py3buddyplayer.Player(ibuddy, defaultquota=2)
+    assert player.submit('RED:GO', client='a') is not None
+    assert player.submit('RED:GO', client='a') is not None
+    assert player.submit('RED:GO', client='a') is None
+    assert player.submit('RED:GO', client='b') is not None
+    assert player.clientstats()['a']['rejected'] == 1
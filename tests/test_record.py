@@ -0,0 +1,47 @@
+# Tests for recording and replaying states.
+#
+# Copyright 2017-2019 - Armijn Hemel for Tjaldur Software Governance Solutions
+# SPDX-Identifier: MIT
+
+import io
+import pytest
+
+usb = pytest.importorskip('usb.core')
+import py3buddy
+import py3buddyrecord
+import py3buddysim
+
+
+class KeepOpen(io.BytesIO):
+    # the Recorder closes its file, keep the contents
+    def close(self):
+        pass
+
+
+def test_record_and_replay(sim, sentstates):
+    recording = KeepOpen()
+    ibuddy = py3buddy.iBuddy({}, find=sim.find)
+    ibuddy.recorder = py3buddyrecord.Recorder(recording)
+    assert ibuddy.executecommand('RED:HEART:GO:5MS:WINGSLOW:GO:5MS:NOHEART:GO')
+    ibuddy.recorder.close()
+    recorded = sentstates()
+
+    records = list(py3buddyrecord.iterrecording(recording.getvalue()))
+    assert [state for (delay, state) in records] == recorded
+    assert sum([delay for (delay, state) in records]) >= 0.01
+
+    other = py3buddysim.SimulatedDevice(keepmessages=True)
+    py3buddyrecord.replay(py3buddy.iBuddy({}, find=other.find), records, speed=10)
+    replayed = [msg[-1] for msg in other.messages if msg[0] == py3buddy.messagebytes[0]]
+    assert replayed == recorded
+
+
+def test_compiled_frames():
+    recording = py3buddyrecord.compileframes([(0.1, 0x6f), (0.2, 0x7f)])
+    assert list(py3buddyrecord.iterrecording(recording)) == [
+        (0.0, 0x6f), (0.1, 0x7f), (0.2, 0xff)]
+
+
+def test_not_a_recording():
+    with pytest.raises(ValueError):
+        list(py3buddyrecord.iterrecording(b'nope'))
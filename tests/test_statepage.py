@@ -0,0 +1,67 @@
+# Tests for the live state page.
+#
+# Copyright 2017-2019 - Armijn Hemel for Tjaldur Software Governance Solutions
+# SPDX-Identifier: MIT
+
+import os
+import pytest
+
+usb = pytest.importorskip('usb.core')
+import py3buddy
+import py3buddyplayer
+import py3buddystatepage
+
+
+def test_sequence_number_wraps(tmp_path):
+    path = str(tmp_path / 'state')
+    page = py3buddystatepage.StatePage(path)
+    page.seq = 0xfffffffe
+    page.publish(state=0x7f)
+    page.publish(queuedepth=3)
+
+    reader = py3buddystatepage.StatePageReader(path)
+    result = reader.read()
+    assert result['seq'] == 2
+    assert result['state'] == 0x7f
+    assert result['queuedepth'] == 3
+    reader.close()
+    page.close()
+
+
+def test_page_is_created_exclusively(tmp_path):
+    path = str(tmp_path / 'state')
+    # a symlink at the old, predictable name of the temporary file
+    # should be left alone
+    victim = tmp_path / 'victim'
+    victim.write_text('keep')
+    os.symlink(str(victim), path + '.tmp')
+    page = py3buddystatepage.StatePage(path)
+    assert victim.read_text() == 'keep'
+    assert sorted(os.listdir(str(tmp_path))) == ['state', 'state.tmp', 'victim']
+    page.close()
+
+
+def test_publish_errors_do_not_stop_frames(sim, tmp_path):
+    ibuddy = py3buddy.iBuddy({}, find=sim.find)
+    ibuddy.statepage = py3buddystatepage.StatePage(str(tmp_path / 'state'))
+    ibuddy.statepage.page.close()
+    ibuddy.sendstate(0x6f)
+    assert sim.state == 0x6f
+    assert ibuddy.statepageerrors == 1
+
+
+def test_publish_errors_do_not_stop_the_player(sim, tmp_path):
+    ibuddy = py3buddy.iBuddy({}, find=sim.find)
+    ibuddy.statepage = py3buddystatepage.StatePage(str(tmp_path / 'state'))
+    ibuddy.statepage.page.close()
+    player = py3buddyplayer.Player(ibuddy, resetafter=False)
+    player.start()
+    try:
+        for colour in ['RED', 'BLUE']:
+            playback = player.submit(colour + ':GO')
+            assert playback.wait(5)
+            assert playback.completed
+        assert sim.state == 0xbf
+        assert ibuddy.statepageerrors > 0
+    finally:
+        player.shutdown()
@@ -0,0 +1,24 @@
+# Tests for tracing the tokens of commands.
+#
+# Copyright 2017-2019 - Armijn Hemel for Tjaldur Software Governance Solutions
+# SPDX-Identifier: MIT
+
+import pytest
+
+usb = pytest.importorskip('usb.core')
+import py3buddy
+import py3buddytrace
+
+
+def test_span_per_token(sim, sentstates):
+    # consecutive setters and sleeps are merged when the command is
+    # compiled, but the trace still has a span for every token
+    ibuddy = py3buddy.iBuddy({}, find=sim.find)
+    sink = py3buddytrace.RingBufferSink()
+    ibuddy.tracer = py3buddytrace.Tracer(sink)
+    cmd = 'RED:HEART:WINGSHIGH:GO:1MS:2MS:NOHEART:GO'
+    assert len(py3buddy.compilecommand(cmd)) < len(cmd.split(':'))
+    assert ibuddy.executecommand(cmd)
+    tokens = [span['name'] for span in sink.spans if span['cat'] == 'token']
+    assert tokens == cmd.split(':')
+    assert sentstates()[-2:] == [0x67, 0xe7]